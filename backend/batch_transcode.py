@@ -0,0 +1,188 @@
+"""
+Per-book batch transcoding.
+
+With TRANSCODE_BATCH_SIZE > 1, convert_folder_to_96k hands a book's tracks
+to convert_tracks() instead of running ffprobe + ffmpeg per track:
+
+- bitrates come from the MP3 frame header (Xing/VBRI average for VBR),
+  read in-process; ffprobe only runs for files the parser cannot read
+- tracks that need converting go to ffmpeg in chunks, one process mapping
+  every input of the chunk to its own temp output
+  (-map N:a, -map_metadata N, so tags stay with their track)
+- every output is checked and moved into place on its own; tracks of a
+  failed run fall back to convert_single_file
+"""
+import concurrent.futures
+import os
+import struct
+import subprocess
+import throttle
+from renamer_core import logger, stop_event, get_audio_bitrate, convert_single_file, log_pause, log_resume
+
+TRANSCODE_BATCH_SIZE = int(os.getenv("TRANSCODE_BATCH_SIZE", "0"))
+TARGET_RANGE = (92000, 100000)
+
+# Layer III bitrates (kbps) by bitrate index
+BITRATES_V1 = (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320)
+BITRATES_V2 = (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160)
+SAMPLE_RATES = {3: (44100, 48000, 32000), 2: (22050, 24000, 16000), 0: (11025, 12000, 8000)}
+# First frame is searched this far behind the ID3 tag
+SYNC_SEARCH_BYTES = 64 * 1024
+
+
+def _parse_header(data, pos):
+    """(bitrate, sample_rate, frame_length, is_v1, mono) of a Layer III frame header, or None."""
+    if pos + 4 > len(data):
+        return None
+    b1, b2, b3 = data[pos + 1], data[pos + 2], data[pos + 3]
+    if data[pos] != 0xFF or (b1 & 0xE0) != 0xE0:
+        return None
+    version = (b1 >> 3) & 0x03
+    layer = (b1 >> 1) & 0x03
+    bitrate_index = b2 >> 4
+    rate_index = (b2 >> 2) & 0x03
+    if version == 1 or layer != 1 or bitrate_index in (0, 15) or rate_index == 3:
+        return None
+    is_v1 = version == 3
+    bitrate = (BITRATES_V1 if is_v1 else BITRATES_V2)[bitrate_index] * 1000
+    sample_rate = SAMPLE_RATES[version][rate_index]
+    padding = (b2 >> 1) & 0x01
+    frame_length = (144 if is_v1 else 72) * bitrate // sample_rate + padding
+    mono = (b3 >> 6) == 3
+    return bitrate, sample_rate, frame_length, is_v1, mono
+
+
+def mp3_bitrate(path):
+    """
+    Bitrate as ffprobe reports it (header bitrate for CBR, Xing/VBRI average
+    for VBR), read from the first frame. 0 if the file cannot be parsed.
+    """
+    with open(path, "rb") as f:
+        head = f.read(10)
+        start = 0
+        if len(head) == 10 and head[:3] == b"ID3":
+            size = (head[6] << 21) | (head[7] << 14) | (head[8] << 7) | head[9]
+            start = 10 + size + (10 if head[5] & 0x10 else 0)
+        f.seek(start)
+        data = f.read(SYNC_SEARCH_BYTES)
+        file_size = os.fstat(f.fileno()).st_size
+
+    pos = data.find(b"\xff")
+    while 0 <= pos < len(data) - 4:
+        header = _parse_header(data, pos)
+        # A real frame is followed by another one (or the end of the file)
+        if header and (pos + header[2] >= len(data) or _parse_header(data, pos + header[2])):
+            break
+        pos = data.find(b"\xff", pos + 1)
+    else:
+        return 0
+    bitrate, sample_rate, _, is_v1, mono = header
+    samples_per_frame = 1152 if is_v1 else 576
+
+    side_info = (17 if mono else 32) if is_v1 else (9 if mono else 17)
+    xing = pos + 4 + side_info
+    if data[xing:xing + 4] == b"Xing":
+        flags = struct.unpack(">I", data[xing + 4:xing + 8])[0]
+        offset = xing + 8
+        frames = size = None
+        if flags & 0x01:
+            frames = struct.unpack(">I", data[offset:offset + 4])[0]
+            offset += 4
+        if flags & 0x02:
+            size = struct.unpack(">I", data[offset:offset + 4])[0]
+        size = size or file_size - start - pos
+        if frames:
+            return size * 8 * sample_rate // (frames * samples_per_frame)
+    vbri = pos + 4 + 32
+    if data[vbri:vbri + 4] == b"VBRI":
+        size, frames = struct.unpack(">II", data[vbri + 10:vbri + 18])
+        if frames:
+            return size * 8 * sample_rate // (frames * samples_per_frame)
+    return bitrate
+
+
+def probe_bitrate(path):
+    try:
+        bitrate = mp3_bitrate(path)
+    except (OSError, struct.error):
+        bitrate = 0
+    return bitrate or get_audio_bitrate(path)
+
+
+def _temp_path(file_info):
+    full_path, root, file_name = file_info
+    return os.path.join(root, f"temp_{file_name}")
+
+
+def _remove(path):
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def convert_chunk(chunk, on_done):
+    """One ffmpeg run for the chunk; on_done(file_info) per track that ends up at 96k."""
+    if stop_event.is_set() or not throttle.wait_for_capacity(stop_event, log_pause, log_resume):
+        return
+    names = [info[2] for info in chunk]
+    logger.info(f"Converting {len(chunk)} track(s) to 96k in one ffmpeg run ({names[0]} .. {names[-1]})...")
+
+    cmd = ["ffmpeg", "-y"]
+    for full_path, _, _ in chunk:
+        cmd += ["-i", full_path]
+    for index, info in enumerate(chunk):
+        cmd += [
+            "-map", f"{index}:a", "-map", f"{index}:v?", "-map_metadata", str(index), "-map_chapters", str(index),
+            "-codec:a", "libmp3lame", "-b:a", "96k", _temp_path(info),
+        ]
+    try:
+        result = subprocess.run(throttle.niced(cmd), stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        returncode, stderr = result.returncode, result.stderr
+    except Exception as e:
+        returncode, stderr = -1, str(e)
+
+    fallback = []
+    for info in chunk:
+        temp_path = _temp_path(info)
+        if returncode == 0 and os.path.isfile(temp_path) and os.path.getsize(temp_path) > 0:
+            try:
+                os.replace(temp_path, info[0])
+                on_done(info)
+                continue
+            except OSError as e:
+                logger.error(f"Could not replace {info[2]}: {e}")
+        _remove(temp_path)
+        fallback.append(info)
+
+    if returncode != 0:
+        logger.error(f"FFmpeg batch error ({names[0]} .. {names[-1]}): {stderr[-2000:]}")
+    if fallback:
+        logger.warning(f"Converting {len(fallback)} track(s) one by one after the batch run.")
+    for info in fallback:
+        if convert_single_file(info):
+            on_done(info)
+    if returncode == 0 and not fallback:
+        logger.info(f"Converted {len(chunk)} track(s) successfully.")
+
+
+def convert_tracks(mp3_files, on_done, workers=1, chunk_size=None):
+    """
+    Brings (full_path, root, file_name) tracks to 96k in chunked ffmpeg runs,
+    `workers` chunks at a time. on_done(file_info) is called per finished track.
+    """
+    chunk_size = chunk_size or TRANSCODE_BATCH_SIZE
+    pending = []
+    for info in sorted(mp3_files):
+        if stop_event.is_set():
+            return
+        bitrate = probe_bitrate(info[0])
+        if TARGET_RANGE[0] <= bitrate <= TARGET_RANGE[1]:
+            on_done(info)
+        else:
+            pending.append(info)
+    if not pending:
+        return
+
+    chunks = [pending[i:i + chunk_size] for i in range(0, len(pending), chunk_size)]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        for future in [executor.submit(convert_chunk, chunk, on_done) for chunk in chunks]:
+            future.result()
@@ -0,0 +1,233 @@
+"""
+Benchmark harness for the renamer pipeline.
+
+Generates a synthetic library (see synthetic_library.py), then runs
+run_once end to end and each phase separately on fresh copies. Wall time,
+read/write syscalls, subprocess counts and peak RSS are written as JSON so
+results can be compared across commits.
+
+Usage (from backend/):
+    python -m benchmarks.bench_renamer --work /tmp/bench --books 200 --out bench.json
+    python -m benchmarks.bench_renamer --work /tmp/bench --books 200 --compare old.json
+"""
+import argparse
+import collections
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+from benchmarks import synthetic_library
+
+
+# Wrappers of throttle.niced() and their options that take a value
+WRAPPER_OPTIONS = {
+    "ionice": {"-c", "-n", "--class", "--classdata"},
+    "nice": {"-n", "--adjustment"},
+}
+
+
+def executable_name(args):
+    """Name of the program a command runs, behind any ionice/nice prefix."""
+    parts = [str(a) for a in args] if isinstance(args, (list, tuple)) else str(args).split(" ")
+    i = 0
+    while i < len(parts) and os.path.basename(parts[i]) in WRAPPER_OPTIONS:
+        options = WRAPPER_OPTIONS[os.path.basename(parts[i])]
+        i += 1
+        while i < len(parts) and parts[i].startswith("-"):
+            i += 2 if parts[i] in options else 1
+    return os.path.basename(parts[i]) if i < len(parts) else os.path.basename(parts[0])
+
+
+def check_executable_names():
+    """ffmpeg behind the configured nice/ionice prefix must be counted as ffmpeg."""
+    import throttle
+    name = executable_name(throttle.niced(["ffmpeg", "-i", "in.mp3", "out.mp3"]))
+    if name != "ffmpeg":
+        raise RuntimeError(f"ProcessCounter counts ffmpeg as '{name}'")
+
+
+class ProcessCounter:
+    """Counts subprocesses started through subprocess.Popen (run() uses it too)."""
+
+    def __init__(self):
+        self.counts = collections.Counter()
+        self._original_init = None
+
+    def __enter__(self):
+        counter = self
+        self._original_init = subprocess.Popen.__init__
+        original_init = self._original_init
+
+        def counting_init(popen_self, args, *a, **kw):
+            counter.counts[executable_name(args)] += 1
+            return original_init(popen_self, args, *a, **kw)
+
+        subprocess.Popen.__init__ = counting_init
+        return self
+
+    def __exit__(self, *exc):
+        subprocess.Popen.__init__ = self._original_init
+        return False
+
+
+def read_proc_io():
+    """Returns read/write syscall counters for this process (Linux only)."""
+    try:
+        with open("/proc/self/io") as f:
+            values = dict(line.split(":", 1) for line in f.read().splitlines() if ":" in line)
+        return {"read": int(values["syscr"]), "write": int(values["syscw"])}
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def reset_peak_rss():
+    """Resets VmHWM so ru_maxrss-style peaks are per measurement (Linux only)."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def read_peak_rss_kb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def measure(fn, *args):
+    """Runs fn(*args) and returns its metrics."""
+    reset_peak_rss()
+    io_before = read_proc_io()
+    children_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    with ProcessCounter() as counter:
+        start = time.perf_counter()
+        fn(*args)
+        wall = time.perf_counter() - start
+    io_after = read_proc_io()
+    children_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    syscalls = None
+    if io_before and io_after:
+        syscalls = {k: io_after[k] - io_before[k] for k in io_before}
+
+    return {
+        "wall_seconds": round(wall, 4),
+        "syscalls": syscalls,
+        "subprocesses": dict(counter.counts),
+        "subprocess_total": sum(counter.counts.values()),
+        "children_cpu_seconds": round(
+            (children_after.ru_utime + children_after.ru_stime)
+            - (children_before.ru_utime + children_before.ru_stime), 4),
+        "peak_rss_kb": read_peak_rss_kb(),
+        "peak_child_rss_kb": children_after.ru_maxrss,
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except Exception:
+        return None
+
+
+def run_benchmark(work_dir, authors, books, tracks, seed):
+    """Returns the full result document."""
+    built = synthetic_library.build(work_dir, authors=authors, books=books, tracks=tracks, seed=seed)
+    library_path = built["library_path"]
+
+    # database.py reads DB_PATH at import time, so the core is imported only now
+    os.environ["DB_PATH"] = built["db_path"]
+    import renamer_core
+    import planner
+    from database import SessionLocal
+    check_executable_names()
+
+    def fresh_library():
+        synthetic_library.regenerate_library(work_dir, library_path, authors=authors, books=books,
+                                             tracks=tracks, seed=seed)
+
+    result = {
+        "revision": git_revision(),
+        "timestamp": time.time(),
+        "params": {"authors": authors, "books": books, "tracks": tracks, "seed": seed},
+        "library": built["summary"],
+        "end_to_end": None,
+        "phases": {},
+    }
+
+    renamer_core.stop_event.clear()
+    result["end_to_end"] = measure(renamer_core.run_once, library_path)
+
+    fresh_library()
+    db = SessionLocal()
+    try:
+        plan = {}
+
+        def plan_phase():
+            plan.update(planner.build_plan(db, library_path))
+
+        result["phases"]["build_plan"] = measure(plan_phase)
+        for phase in (0, 1, 2):
+            result["phases"][f"execute_phase_{phase}"] = measure(planner.execute_phase, library_path, plan, phase)
+    finally:
+        db.close()
+
+    return result
+
+
+def compare(current, previous):
+    """Prints wall time and subprocess deltas against an earlier result file."""
+    rows = [("end_to_end", current["end_to_end"], previous.get("end_to_end"))]
+    for name, metrics in current["phases"].items():
+        rows.append((name, metrics, previous.get("phases", {}).get(name)))
+
+    print(f"{'phase':36} {'old s':>9} {'new s':>9} {'delta':>8} {'procs old/new':>15}")
+    for name, new, old in rows:
+        if not old:
+            print(f"{name:36} {'-':>9} {new['wall_seconds']:>9.3f}")
+            continue
+        delta = ((new["wall_seconds"] - old["wall_seconds"]) / old["wall_seconds"] * 100) if old["wall_seconds"] else 0.0
+        procs = f"{old['subprocess_total']}/{new['subprocess_total']}"
+        print(f"{name:36} {old['wall_seconds']:>9.3f} {new['wall_seconds']:>9.3f} {delta:>7.1f}% {procs:>15}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the renamer pipeline on a synthetic library.")
+    parser.add_argument("--work", required=True, help="Scratch directory (library + metadata.db)")
+    parser.add_argument("--authors", type=int, default=10)
+    parser.add_argument("--books", type=int, default=100)
+    parser.add_argument("--tracks", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", help="Write result JSON to this file")
+    parser.add_argument("--compare", help="Earlier result JSON to compare against")
+    args = parser.parse_args()
+
+    result = run_benchmark(args.work, args.authors, args.books, args.tracks, args.seed)
+
+    text = json.dumps(result, indent=2)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text)
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(result, json.load(f))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,97 @@
+"""
+Per-file vs. per-book batch transcoding on the synthetic library.
+
+Runs convert_folder_to_96k over every book folder of a fresh synthetic
+library, once per track (ffprobe + ffmpeg each) and once with
+TRANSCODE_BATCH_SIZE chunks (see batch_transcode.py), and reports wall
+time, subprocess counts and child CPU time for both. The fixtures are
+128 kbps, so every track gets converted.
+
+Usage (from backend/):
+    python -m benchmarks.bench_transcode --work /tmp/bench_tc --books 20 --tracks 48
+    python -m benchmarks.bench_transcode --work /tmp/bench_tc --chunk 16 --workers 2 --out tc.json
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+from benchmarks import synthetic_library
+from benchmarks.bench_renamer import measure, git_revision, check_executable_names
+
+
+def book_folders(library_path):
+    """Folders that directly contain MP3s (placed books and EAN drops)."""
+    folders = []
+    for root, dirs, files in os.walk(library_path):
+        dirs[:] = [d for d in dirs if not d.startswith("_")]
+        if any(name.lower().endswith(".mp3") for name in files):
+            folders.append(root)
+    return sorted(folders)
+
+
+def run_benchmark(work_dir, authors, books, tracks, seed, chunk, workers):
+    built = synthetic_library.build(work_dir, authors=authors, books=books, tracks=tracks, seed=seed)
+    library_path = built["library_path"]
+
+    # database.py reads DB_PATH at import time, so the core is imported only now
+    os.environ["DB_PATH"] = built["db_path"]
+    import renamer_core
+    import batch_transcode
+    check_executable_names()
+
+    def transcode_all():
+        for folder in book_folders(library_path):
+            renamer_core.convert_folder_to_96k(folder, workers=workers)
+
+    result = {
+        "revision": git_revision(),
+        "timestamp": time.time(),
+        "params": {"authors": authors, "books": books, "tracks": tracks, "seed": seed,
+                   "chunk": chunk, "workers": workers},
+        "folders": len(book_folders(library_path)),
+        "modes": {},
+    }
+    renamer_core.stop_event.clear()
+    for mode, batch_size in (("per_file", 0), ("batch", chunk)):
+        synthetic_library.regenerate_library(work_dir, library_path, authors=authors, books=books,
+                                             tracks=tracks, seed=seed)
+        batch_transcode.TRANSCODE_BATCH_SIZE = batch_size
+        result["modes"][mode] = measure(transcode_all)
+    return result
+
+
+def print_comparison(result):
+    per_file, batch = result["modes"]["per_file"], result["modes"]["batch"]
+    print(f"{'mode':10} {'wall s':>9} {'child cpu s':>12} {'procs':>7}  by name")
+    for name, metrics in (("per_file", per_file), ("batch", batch)):
+        print(f"{name:10} {metrics['wall_seconds']:>9.3f} {metrics['children_cpu_seconds']:>12.3f} "
+              f"{metrics['subprocess_total']:>7}  {metrics['subprocesses']}")
+    if per_file["wall_seconds"]:
+        delta = (batch["wall_seconds"] - per_file["wall_seconds"]) / per_file["wall_seconds"] * 100
+        print(f"batch vs per_file: {delta:+.1f}% wall time")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare per-file and batch transcoding.")
+    parser.add_argument("--work", required=True, help="Scratch directory (library + metadata.db)")
+    parser.add_argument("--authors", type=int, default=5)
+    parser.add_argument("--books", type=int, default=20)
+    parser.add_argument("--tracks", type=int, default=48)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--chunk", type=int, default=16, help="Tracks per ffmpeg run in batch mode")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--out", help="Write result JSON to this file")
+    args = parser.parse_args()
+
+    result = run_benchmark(args.work, args.authors, args.books, args.tracks, args.seed, args.chunk, args.workers)
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(result, f, indent=2)
+    print_comparison(result)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,286 @@
+"""
+Load generator for the ABS provider and inventory APIs.
+
+Starts the FastAPI app on a local uvicorn against a generated catalog and
+replays a realistic /api/abs/search mix (ISBN hits, title+author, abridged
+keywords, misses) plus /api/inventory calls. Optionally runs a scan and a
+DB sync in the background while measuring. Reports p50/p95/p99 and
+throughput per scenario as JSON.
+
+Usage (from backend/):
+    python -m benchmarks.load_abs --work /tmp/load --catalog 5000 --requests 2000 --concurrency 8
+    python -m benchmarks.load_abs --work /tmp/load --catalog 5000 --background
+"""
+import argparse
+import http.client
+import http.server
+import json
+import os
+import random
+import shutil
+import socket
+import sys
+import threading
+import time
+import urllib.parse
+import concurrent.futures
+
+from benchmarks import synthetic_library
+
+# Default request mix for /api/abs/search
+DEFAULT_SEARCH_MIX = {"isbn": 0.4, "title_author": 0.3, "abridged": 0.15, "miss": 0.15}
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    k = (len(sorted_values) - 1) * pct / 100.0
+    lo = int(k)
+    hi = min(lo + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (k - lo)
+
+
+def summarize(latencies, errors, elapsed):
+    values = sorted(latencies)
+    ms = lambda v: round(v * 1000, 2) if v is not None else None
+    return {
+        "requests": len(values),
+        "errors": errors,
+        "throughput_rps": round(len(values) / elapsed, 1) if elapsed else None,
+        "p50_ms": ms(percentile(values, 50)),
+        "p95_ms": ms(percentile(values, 95)),
+        "p99_ms": ms(percentile(values, 99)),
+        "max_ms": ms(values[-1] if values else None),
+    }
+
+
+def build_search_paths(rows, count, mix, seed=1):
+    """Returns `count` request paths for /api/abs/search following `mix`."""
+    rng = random.Random(seed)
+    kinds = list(mix)
+    weights = [mix[k] for k in kinds]
+    paths = []
+    for _ in range(count):
+        kind = rng.choices(kinds, weights)[0]
+        row = rng.choice(rows)
+        if kind == "isbn":
+            params = {"isbn": row["ean"], "mediaType": "book"}
+        elif kind == "title_author":
+            params = {"title": row["title"], "author": row["author"].split(",")[0], "mediaType": "book"}
+        elif kind == "abridged":
+            params = {"q": f"{row['title']} {rng.choice(['ungekürzt', 'gekürzt', 'unabridged'])}"}
+        else:
+            params = {"title": f"Nichtvorhanden {rng.randint(0, 10**6)}", "author": "Niemand"}
+        paths.append("/api/abs/search?" + urllib.parse.urlencode(params))
+    return paths
+
+
+def replay(port, paths, concurrency):
+    """Sends all paths with `concurrency` keep-alive clients. Returns summary dict."""
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    chunks = [paths[i::concurrency] for i in range(concurrency)]
+
+    def client(chunk):
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=120)
+        local = []
+        local_errors = 0
+        for path in chunk:
+            start = time.perf_counter()
+            try:
+                conn.request("GET", path)
+                resp = conn.getresponse()
+                resp.read()
+                if resp.status != 200:
+                    local_errors += 1
+            except Exception:
+                local_errors += 1
+                conn.close()
+                conn = http.client.HTTPConnection("127.0.0.1", port, timeout=120)
+                continue
+            local.append(time.perf_counter() - start)
+        conn.close()
+        with lock:
+            latencies.extend(local)
+            errors[0] += local_errors
+
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(client, chunks))
+    return summarize(latencies, errors[0], time.perf_counter() - start)
+
+
+def to_n8n_items(rows):
+    """Maps catalog rows back to the field names n8n delivers."""
+    items = []
+    for row in rows:
+        items.append({
+            "EAN": row["ean"],
+            "Autor": row["author"],
+            "Titel": row["title"],
+            "Sprecher": row["narrator"],
+            "VÖ_digital": row["release_date"],
+            "Abridged": row["abridged_status"],
+            "Beschreibung": row["description"],
+            "Takedown": "ja" if row["takedown"] else "",
+        })
+    return items
+
+
+def serve_catalog(items):
+    """Serves `items` as a fake n8n webhook. Returns (url, server)."""
+    payload = json.dumps(items).encode("utf-8")
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}/webhook", server
+
+
+class BackgroundLoad:
+    """Loops a scan and a DB sync while the measurement runs."""
+
+    def __init__(self, main_module, regenerate):
+        self.main = main_module
+        self.regenerate = regenerate
+        self.stop = threading.Event()
+        self.cycles = {"scan": 0, "db_sync": 0}
+        self.threads = []
+
+    def _scan_loop(self):
+        while not self.stop.is_set():
+            self.regenerate()
+            # LIBRARY_PATH points the configured roots at the synthetic library
+            self.main.run_roots(self.main.get_library_roots())
+            self.cycles["scan"] += 1
+
+    def _sync_loop(self):
+        while not self.stop.is_set():
+            self.main.update_database_from_url()
+            self.cycles["db_sync"] += 1
+
+    def __enter__(self):
+        for target in (self._scan_loop, self._sync_loop):
+            t = threading.Thread(target=target, daemon=True)
+            t.start()
+            self.threads.append(t)
+        return self
+
+    def __exit__(self, *exc):
+        self.stop.set()
+        self.main.stop_event.set()
+        for t in self.threads:
+            t.join(timeout=120)
+        self.main.stop_event.clear()
+        return False
+
+
+def run_load_test(work_dir, catalog_size, on_disk, requests_total, inventory_requests, concurrency,
+                  background, seed=1):
+    os.makedirs(work_dir, exist_ok=True)
+    rows = synthetic_library.make_catalog(max(1, catalog_size // 8), catalog_size, seed=seed)
+    db_path = os.path.join(work_dir, "metadata.db")
+    synthetic_library.write_metadata_db(db_path, rows)
+
+    library_path = os.path.join(work_dir, "library")
+    disk_rows = rows[:on_disk]
+    mp3_path, jpg_path = synthetic_library.make_fixtures(os.path.join(work_dir, "fixtures"))
+
+    def regenerate():
+        kinds = synthetic_library.assign_kinds(disk_rows, synthetic_library.DEFAULT_MIX, seed=seed)
+        kinds = ["placed" if k in ("unknown", "takedown") else k for k in kinds]
+        if os.path.exists(library_path):
+            shutil.rmtree(library_path)
+        synthetic_library.generate_library(library_path, disk_rows, kinds, mp3_path, jpg_path, tracks=1, seed=seed)
+
+    regenerate()
+
+    # main.py reads DB_PATH and LIBRARY_PATH at import time
+    os.environ["DB_PATH"] = db_path
+    os.environ["LIBRARY_PATH"] = library_path
+    import main
+    import uvicorn
+
+    webhook_url, webhook_server = serve_catalog(to_n8n_items(rows))
+    main.config["n8n_webhook_url"] = webhook_url
+
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(main.app, host="127.0.0.1", port=port, log_level="warning"))
+    server_thread = threading.Thread(target=server.run, daemon=True)
+    server_thread.start()
+    while not server.started:
+        time.sleep(0.05)
+
+    search_paths = build_search_paths(rows, requests_total, DEFAULT_SEARCH_MIX, seed=seed)
+    inventory_paths = ["/api/inventory"] * inventory_requests
+
+    result = {
+        "params": {"catalog": catalog_size, "on_disk": len(disk_rows), "requests": requests_total,
+                   "inventory_requests": inventory_requests, "concurrency": concurrency,
+                   "search_mix": DEFAULT_SEARCH_MIX},
+        "scenarios": {},
+    }
+    try:
+        result["scenarios"]["search"] = replay(port, search_paths, concurrency)
+        if inventory_paths:
+            result["scenarios"]["inventory"] = replay(port, inventory_paths, min(concurrency, len(inventory_paths)))
+
+        if background:
+            with BackgroundLoad(main, regenerate) as bg:
+                result["scenarios"]["search_with_background"] = replay(port, search_paths, concurrency)
+                if inventory_paths:
+                    result["scenarios"]["inventory_with_background"] = replay(
+                        port, inventory_paths, min(concurrency, len(inventory_paths)))
+            result["background_cycles"] = bg.cycles
+    finally:
+        server.should_exit = True
+        server_thread.join(timeout=10)
+        webhook_server.shutdown()
+
+    return result
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Load-test the ABS provider and inventory APIs.")
+    parser.add_argument("--work", required=True, help="Scratch directory (catalog + library)")
+    parser.add_argument("--catalog", type=int, default=2000, help="Catalog size (books)")
+    parser.add_argument("--on-disk", type=int, default=None, help="Books present in the library (default 10%%)")
+    parser.add_argument("--requests", type=int, default=1000, help="Search requests per scenario")
+    parser.add_argument("--inventory-requests", type=int, default=10)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--background", action="store_true", help="Also measure with scan + DB sync running")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", help="Write result JSON to this file")
+    args = parser.parse_args()
+
+    on_disk = args.on_disk if args.on_disk is not None else max(1, args.catalog // 10)
+    result = run_load_test(args.work, args.catalog, on_disk, args.requests, args.inventory_requests,
+                           args.concurrency, args.background, seed=args.seed)
+
+    text = json.dumps(result, indent=2)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text)
+    print(text)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -0,0 +1,229 @@
+"""
+Synthetic library generator for benchmarks.
+
+Builds a library tree that exercises every phase of run_once:
+zipped and unzipped EAN drops, placed books, legacy '_<timestamp>'
+duplicate folders, takedowns and unknown EANs. A matching metadata.db
+is written next to it.
+
+Usage (from backend/):
+    python -m benchmarks.synthetic_library --out /tmp/synth --authors 20 --books 200
+"""
+import argparse
+import os
+import random
+import re
+import shutil
+import sqlite3
+import subprocess
+import zipfile
+
+# Mix of drop types, as fractions of the total book count
+DEFAULT_MIX = {
+    "zip": 0.15,
+    "ean_folder": 0.15,
+    "placed": 0.55,
+    "duplicate": 0.05,
+    "takedown": 0.05,
+    "unknown": 0.05,
+}
+
+FIRST_NAMES = ["Rita", "Jonas", "Eva", "Klaus", "Marie", "Paul", "Anna", "Jan", "Lea", "Tom"]
+LAST_NAMES = ["Falk", "Rausch", "Berger", "Huber", "Winter", "Krause", "Lang", "Sommer", "Vogel", "Roth"]
+WORDS = ["Schweinekopf", "al", "dente", "Sauerkraut", "Koma", "Nacht", "Wald", "Mord", "Sommer",
+         "Grießnockerl", "Affäre", "Leberkäs", "Junkie", "Zwetschgen", "Dieb", "Kaiser", "Schmarrn"]
+ABRIDGED = [None, "Gekürzt", "Ungekürzt", "Hörspiel"]
+
+
+def make_fixtures(fixture_dir, duration=2, bitrate="128k", cover_size=1200):
+    """Creates one small MP3 and one oversized JPEG with ffmpeg's sine/color sources."""
+    os.makedirs(fixture_dir, exist_ok=True)
+    mp3_path = os.path.join(fixture_dir, "track.mp3")
+    jpg_path = os.path.join(fixture_dir, "cover.jpg")
+
+    try:
+        if not os.path.exists(mp3_path):
+            subprocess.run(
+                ["ffmpeg", "-v", "error", "-f", "lavfi", "-i", f"sine=frequency=440:duration={duration}",
+                 "-codec:a", "libmp3lame", "-b:a", bitrate, "-y", mp3_path],
+                check=True,
+            )
+        if not os.path.exists(jpg_path):
+            subprocess.run(
+                ["ffmpeg", "-v", "error", "-f", "lavfi", "-i", f"color=c=steelblue:s={cover_size}x{cover_size}",
+                 "-frames:v", "1", "-y", jpg_path],
+                check=True,
+            )
+    except FileNotFoundError:
+        # No ffmpeg on this host: placeholders still exercise the filesystem phases.
+        print("WARNING: ffmpeg not found, writing placeholder fixtures.", flush=True)
+        with open(mp3_path, "wb") as f:
+            f.write(b"ID3" + os.urandom(32 * 1024))
+        with open(jpg_path, "wb") as f:
+            f.write(b"\xff\xd8\xff\xe0" + os.urandom(64 * 1024))
+
+    return mp3_path, jpg_path
+
+
+def make_catalog(authors, books, seed=1):
+    """Returns a deterministic list of catalog rows (dicts keyed like the books table)."""
+    rng = random.Random(seed)
+    author_names = []
+    for i in range(authors):
+        author_names.append(f"{rng.choice(LAST_NAMES)}, {rng.choice(FIRST_NAMES)} {i}")
+
+    rows = []
+    for i in range(books):
+        title = " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 4))) + f" {i}"
+        rows.append({
+            "ean": f"978{i:010d}",
+            "author": author_names[i % authors],
+            "title": title,
+            "takedown": False,
+            "release_date": f"{rng.randint(1995, 2026)}-{rng.randint(1, 12):02d}-01",
+            "abridged_status": rng.choice(ABRIDGED),
+            "narrator": f"{rng.choice(LAST_NAMES)}, {rng.choice(FIRST_NAMES)}",
+            "description": "Synthetic benchmark title.",
+        })
+    return rows
+
+
+def assign_kinds(rows, mix, seed=1):
+    rng = random.Random(seed)
+    kinds = []
+    for kind, share in mix.items():
+        kinds.extend([kind] * int(round(share * len(rows))))
+    kinds.extend(["placed"] * (len(rows) - len(kinds)))
+    kinds = kinds[:len(rows)]
+    rng.shuffle(kinds)
+    return kinds
+
+
+def write_metadata_db(db_path, rows):
+    """Writes the catalog with the same schema as models.Book."""
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    conn = sqlite3.connect(db_path)
+    try:
+        conn.execute(
+            "CREATE TABLE books (ean VARCHAR NOT NULL PRIMARY KEY, author VARCHAR, title VARCHAR, "
+            "takedown BOOLEAN, release_date VARCHAR, abridged_status VARCHAR, narrator VARCHAR, "
+            "description VARCHAR)"
+        )
+        conn.execute("CREATE INDEX ix_books_ean ON books (ean)")
+        conn.executemany(
+            "INSERT INTO books VALUES (:ean, :author, :title, :takedown, :release_date, "
+            ":abridged_status, :narrator, :description)",
+            rows,
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def _write_book_files(folder, ean, mp3_path, jpg_path, tracks):
+    os.makedirs(folder, exist_ok=True)
+    for n in range(1, tracks + 1):
+        shutil.copyfile(mp3_path, os.path.join(folder, f"{n:02d} - Track.mp3"))
+    shutil.copyfile(jpg_path, os.path.join(folder, f"{ean}.jpg"))
+
+
+def _sanitize(name):
+    # Same rule as renamer_core.sanitize_filename (importing it would open the DB)
+    return re.sub(r'[<>:"/\\|?*]', "", str(name)).strip()
+
+
+def _placed_folder(library_path, row):
+    return os.path.join(library_path, _sanitize(row["author"] or "Unknown"), _sanitize(row["title"] or "Unknown"))
+
+
+def generate_library(library_path, rows, kinds, mp3_path, jpg_path, tracks=3, seed=1):
+    """Materializes the library tree. Returns a summary of what was created."""
+    rng = random.Random(seed)
+    os.makedirs(library_path, exist_ok=True)
+    summary = {kind: 0 for kind in DEFAULT_MIX}
+
+    for row, kind in zip(rows, kinds):
+        ean = row["ean"]
+        if kind == "zip":
+            # Zip drops usually wrap everything in a single subfolder
+            staging = os.path.join(library_path, f".staging_{ean}")
+            _write_book_files(os.path.join(staging, ean), ean, mp3_path, jpg_path, tracks)
+            with zipfile.ZipFile(os.path.join(library_path, f"{ean}.zip"), "w", zipfile.ZIP_STORED) as zf:
+                for root, _, files in os.walk(staging):
+                    for name in files:
+                        full = os.path.join(root, name)
+                        zf.write(full, os.path.relpath(full, staging))
+            shutil.rmtree(staging)
+        elif kind in ("ean_folder", "unknown"):
+            _write_book_files(os.path.join(library_path, ean), ean, mp3_path, jpg_path, tracks)
+        elif kind in ("placed", "takedown"):
+            _write_book_files(_placed_folder(library_path, row), ean, mp3_path, jpg_path, tracks)
+        elif kind == "duplicate":
+            base = _placed_folder(library_path, row)
+            _write_book_files(base, ean, mp3_path, jpg_path, tracks)
+            stamp = rng.randint(1_700_000_000, 1_799_999_999)
+            _write_book_files(f"{base}_{stamp}", ean, mp3_path, jpg_path, tracks)
+        summary[kind] += 1
+
+    return summary
+
+
+def build(out_dir, authors=10, books=100, tracks=3, mix=None, seed=1, fixture_dir=None):
+    """
+    Generates <out_dir>/metadata.db and <out_dir>/library.
+    Returns a dict with paths and the drop-type summary.
+    """
+    mix = mix or DEFAULT_MIX
+    os.makedirs(out_dir, exist_ok=True)
+    fixture_dir = fixture_dir or os.path.join(out_dir, "fixtures")
+    mp3_path, jpg_path = make_fixtures(fixture_dir)
+
+    rows = make_catalog(authors, books, seed=seed)
+    kinds = assign_kinds(rows, mix, seed=seed)
+    for row, kind in zip(rows, kinds):
+        if kind == "takedown":
+            row["takedown"] = True
+
+    # Unknown EANs are on disk but not in the catalog
+    db_rows = [row for row, kind in zip(rows, kinds) if kind != "unknown"]
+    db_path = os.path.join(out_dir, "metadata.db")
+    write_metadata_db(db_path, db_rows)
+
+    library_path = os.path.join(out_dir, "library")
+    if os.path.exists(library_path):
+        shutil.rmtree(library_path)
+    summary = generate_library(library_path, rows, kinds, mp3_path, jpg_path, tracks=tracks, seed=seed)
+
+    return {"db_path": db_path, "library_path": library_path, "summary": summary,
+            "fixtures": {"mp3": mp3_path, "jpg": jpg_path}}
+
+
+def regenerate_library(out_dir, library_path, authors=10, books=100, tracks=3, mix=None, seed=1):
+    """Recreates only the library tree (same seed, same layout) for a fresh benchmark run."""
+    mix = mix or DEFAULT_MIX
+    mp3_path, jpg_path = make_fixtures(os.path.join(out_dir, "fixtures"))
+    rows = make_catalog(authors, books, seed=seed)
+    kinds = assign_kinds(rows, mix, seed=seed)
+    if os.path.exists(library_path):
+        shutil.rmtree(library_path)
+    return generate_library(library_path, rows, kinds, mp3_path, jpg_path, tracks=tracks, seed=seed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic audiobook library.")
+    parser.add_argument("--out", required=True, help="Output directory")
+    parser.add_argument("--authors", type=int, default=10)
+    parser.add_argument("--books", type=int, default=100)
+    parser.add_argument("--tracks", type=int, default=3, help="MP3 tracks per book")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    result = build(args.out, authors=args.authors, books=args.books, tracks=args.tracks, seed=args.seed)
+    print(f"Library: {result['library_path']}")
+    print(f"Catalog: {result['db_path']}")
+    print(f"Summary: {result['summary']}")
+
+
+if __name__ == "__main__":
+    main()
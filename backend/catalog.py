@@ -0,0 +1,159 @@
+"""
+Read-optimized in-memory catalog snapshot.
+
+The read endpoints (ABS search, inventory, status) use this instead of
+opening a session per request. The snapshot is immutable once built;
+rebuild_snapshot() loads the books table once and swaps the new
+snapshot in atomically, so readers never see a half-built catalog.
+"""
+import os
+import sys
+import threading
+import time
+from database import SessionLocal
+from models import Book
+
+
+class CatalogRecord:
+    """One catalog row. Lowercased search keys are precomputed."""
+    __slots__ = (
+        "ean", "author", "title", "takedown", "release_date", "abridged_status",
+        "narrator", "description", "title_key", "author_key", "status_key",
+    )
+
+    def __init__(self, ean, author, title, takedown, release_date, abridged_status, narrator, description):
+        self.ean = ean
+        self.author = author
+        self.title = title
+        self.takedown = bool(takedown)
+        self.release_date = release_date
+        self.abridged_status = abridged_status
+        self.narrator = narrator
+        self.description = description
+        self.title_key = (title or "").lower()
+        self.author_key = (author or "").lower()
+        self.status_key = (abridged_status or "").lower()
+
+
+# Token -> matching record positions, shared by all searches on one snapshot
+POSTING_CACHE_SIZE = int(os.getenv("CATALOG_POSTING_CACHE", "4096"))
+
+COLUMNS = ("ean", "author", "title", "takedown", "release_date", "abridged_status", "narrator", "description")
+
+
+class CatalogSnapshot:
+    __slots__ = ("records", "by_ean", "by_author", "built_at", "build_seconds", "memory_bytes", "postings")
+
+    def __init__(self, records, build_seconds=0.0):
+        self.records = tuple(records)
+        # EAN hash index
+        self.by_ean = {r.ean: r for r in self.records}
+        # Non-takedown records in author order (stable, like the old sort)
+        self.by_author = tuple(sorted((r for r in self.records if not r.takedown), key=lambda r: r.author_key))
+        self.built_at = time.time()
+        self.build_seconds = build_seconds
+        self.memory_bytes = self._measure()
+        self.postings = {}
+
+    def __len__(self):
+        return len(self.records)
+
+    def get(self, ean):
+        return self.by_ean.get(ean)
+
+    def active(self):
+        """Non-takedown records sorted by author."""
+        return self.by_author
+
+    def _postings(self, field, token):
+        """Positions of non-takedown records whose `field` contains token (cached)."""
+        key = (field, token)
+        positions = self.postings.get(key)
+        if positions is None:
+            positions = frozenset(i for i, r in enumerate(self.records)
+                                  if not r.takedown and token in getattr(r, field))
+            if len(self.postings) >= POSTING_CACHE_SIZE:
+                self.postings.clear()
+            self.postings[key] = positions
+        return positions
+
+    def search(self, title_tokens, author_tokens=(), status_keywords=()):
+        """
+        AND of substring matches on title and author, like the old
+        lower(col).contains(token) filters. status_keywords is an OR list.
+        Takedowns are never returned. Each token's matches are computed once
+        per snapshot, so repeated words across searches are set lookups.
+        """
+        candidates = None
+        for field, tokens in (("title_key", title_tokens), ("author_key", author_tokens)):
+            for token in tokens:
+                positions = self._postings(field, token.lower())
+                candidates = positions if candidates is None else candidates & positions
+                if not candidates:
+                    return []
+        if candidates is None:
+            candidates = (i for i, r in enumerate(self.records) if not r.takedown)
+        matches = []
+        for i in sorted(candidates):
+            r = self.records[i]
+            if status_keywords and not any(k in r.status_key for k in status_keywords):
+                continue
+            matches.append(r)
+        return matches
+
+    def _measure(self):
+        """Approximate bytes held by the snapshot (records, strings, indexes)."""
+        total = sys.getsizeof(self.records) + sys.getsizeof(self.by_ean) + sys.getsizeof(self.by_author)
+        seen = set()
+        for r in self.records:
+            total += sys.getsizeof(r)
+            for name in CatalogRecord.__slots__:
+                value = getattr(r, name)
+                if id(value) in seen:
+                    continue
+                seen.add(id(value))
+                total += sys.getsizeof(value)
+        return total
+
+    def stats(self):
+        return {
+            "records": len(self.records),
+            "active": len(self.by_author),
+            "memory_bytes": self.memory_bytes,
+            "built_at": self.built_at,
+            "build_seconds": round(self.build_seconds, 3),
+            "cached_tokens": len(self.postings),
+        }
+
+
+_snapshot = None
+_build_lock = threading.Lock()
+
+
+def load_snapshot():
+    """Reads the whole books table once into a new snapshot."""
+    started = time.perf_counter()
+    db = SessionLocal()
+    try:
+        columns = [getattr(Book, c) for c in COLUMNS]
+        records = [CatalogRecord(*row) for row in db.query(*columns)]
+    finally:
+        db.close()
+    return CatalogSnapshot(records, time.perf_counter() - started)
+
+
+def rebuild_snapshot():
+    """Builds a fresh snapshot and swaps it in. Call after every DB sync."""
+    global _snapshot
+    with _build_lock:
+        snapshot = load_snapshot()
+        _snapshot = snapshot
+    return snapshot
+
+
+def get_snapshot():
+    """Current snapshot; built on first use."""
+    snapshot = _snapshot
+    if snapshot is None:
+        snapshot = rebuild_snapshot()
+    return snapshot
@@ -0,0 +1,244 @@
+"""
+Writing catalog rows into the books table.
+
+Both the hourly pull (update_database_from_url) and the push endpoint
+(POST /api/catalog/ingest) go through map_catalog_item() and apply_items(),
+so n8n rows mean the same thing on either path. The push endpoint feeds
+NDJSON lines into an IngestSession, which commits every INGEST_BATCH_SIZE
+rows while the request is still streaming. A batch id that finished once
+is not applied again.
+"""
+import json
+import os
+import time
+import fuzzy
+import run_state
+from database import SessionLocal, engine
+from models import Book, IngestBatch
+from renamer_core import logger, CATALOG_CHUNK_SIZE
+
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "500"))
+
+RELEASE_KEYS = ("VÖ_digital", "VOE_digital", "Release Date", "ET")
+TRUE_VALUES = ("ja", "yes", "true", "1")
+
+_table_ready = False
+
+
+def map_catalog_item(item):
+    """n8n row -> dict of Book columns, or None without a usable EAN."""
+    raw_ean = item.get("EAN")
+    if not raw_ean:
+        # Try alternate mapping just in case
+        raw_ean = item.get("EAN_digital")
+    if not raw_ean:
+        return None
+
+    ean_str = str(raw_ean).strip()
+    if ean_str.endswith('.0'):
+        ean_str = ean_str[:-2]  # Fix Excel number formatting if present
+    if not ean_str:
+        return None
+
+    # Check VÖ/VÖ_digital AND Release Date
+    release_str = None
+    for key in RELEASE_KEYS:
+        if item.get(key):
+            release_str = str(item.get(key)).strip()
+            break
+
+    abridged_str = str(item.get("Abridged") or "").strip() or None
+    if not abridged_str:
+        # Fallback for German field name from n8n
+        abridged_str = str(item.get("Gekuerzt_Ungekuerzt") or "").strip() or None
+
+    takedown_val = item.get("Takedown")
+    is_takedown = bool(takedown_val) and str(takedown_val).lower().strip() in TRUE_VALUES
+
+    return {
+        "ean": ean_str,
+        "author": str(item.get("Autor") or "Unknown").strip(),
+        "title": str(item.get("Titel") or "Unknown").strip(),
+        "takedown": is_takedown,
+        "release_date": release_str,
+        "abridged_status": abridged_str,
+        "narrator": str(item.get("Sprecher") or "").strip() or None,
+        "description": str(item.get("Beschreibung") or "").strip() or None,
+    }
+
+
+def is_deletion(item):
+    """Push rows delete a book with {"_deleted": true} or {"op": "delete"}."""
+    if item.get("_deleted") in (True, 1) or str(item.get("_deleted", "")).lower() in TRUE_VALUES:
+        return True
+    return str(item.get("op") or "").lower() == "delete"
+
+
+def apply_items(db, items, changed_eans, counts=None):
+    """
+    Upserts (and deletes) raw n8n rows in the given session; the caller
+    commits. Existing rows are fetched with chunked IN queries. EANs whose
+    metadata.json content changes (narrator / abridged status) are added to
+    changed_eans.
+    """
+    counts = counts if counts is not None else {"inserted": 0, "updated": 0, "deleted": 0, "skipped": 0}
+    mapped = []
+    for item in items:
+        fields = map_catalog_item(item) if isinstance(item, dict) else None
+        if fields is None:
+            counts["skipped"] += 1
+            continue
+        mapped.append((fields, is_deletion(item)))
+
+    eans = sorted({fields["ean"] for fields, _ in mapped})
+    existing = {}
+    for i in range(0, len(eans), CATALOG_CHUNK_SIZE):
+        for book in db.query(Book).filter(Book.ean.in_(eans[i:i + CATALOG_CHUNK_SIZE])):
+            existing[book.ean] = book
+
+    for fields, delete in mapped:
+        ean = fields["ean"]
+        book = existing.get(ean)
+        if delete:
+            if book is not None:
+                if book in db.new:
+                    # Inserted earlier in this batch: never reached the table, so nothing to delete
+                    db.expunge(book)
+                    counts["inserted"] -= 1
+                else:
+                    db.delete(book)
+                    counts["deleted"] += 1
+                existing.pop(ean)
+                changed_eans.discard(ean)
+            continue
+        if book is not None:
+            if (book.narrator, book.abridged_status) != (fields["narrator"], fields["abridged_status"]):
+                changed_eans.add(ean)
+            for key, value in fields.items():
+                setattr(book, key, value)
+            counts["updated"] += 1
+        else:
+            book = existing[ean] = Book(**fields)
+            db.add(book)
+            counts["inserted"] += 1
+    return counts
+
+
+def finish_sync(changed_eans, library_paths):
+    """Snapshot rebuild, trigram index update and metadata.json refresh after any catalog write."""
+    from catalog import rebuild_snapshot
+    from sidecars import rewrite_metadata
+    snapshot = rebuild_snapshot()
+    logger.info(f"Catalog snapshot rebuilt: {len(snapshot)} books, {snapshot.memory_bytes // 1024} KiB.")
+    fuzzy.index.sync(snapshot)
+    logger.info(f"Trigram index: {fuzzy.index.last_sync['changed']} re-indexed, "
+                f"{fuzzy.index.last_sync['removed']} removed.")
+    # Other API workers rebuild their own snapshot
+    run_state.bus.publish("catalog_changed")
+    if changed_eans:
+        rewrite_metadata(changed_eans, library_paths)
+
+
+def ensure_table():
+    global _table_ready
+    if not _table_ready:
+        IngestBatch.__table__.create(bind=engine, checkfirst=True)
+        _table_ready = True
+
+
+def batch_result(batch_id):
+    """Stored result of a finished batch, or None."""
+    ensure_table()
+    db = SessionLocal()
+    try:
+        batch = db.get(IngestBatch, batch_id)
+        if batch is None:
+            return None
+        return {"batch_id": batch.batch_id, "rows": batch.rows, "inserted": batch.inserted,
+                "updated": batch.updated, "deleted": batch.deleted, "skipped": batch.skipped,
+                "finished_at": batch.finished_at}
+    finally:
+        db.close()
+
+
+class BatchInProgress(Exception):
+    pass
+
+
+class IngestSession:
+    """
+    One streamed batch. feed() takes raw body chunks, splits NDJSON lines and
+    commits every INGEST_BATCH_SIZE rows; finish() applies the rest, records
+    the batch id and runs finish_sync(). A batch that fails half way is not
+    recorded, so the client can resend it; re-applied rows are plain upserts.
+    """
+
+    def __init__(self, batch_id, batch_size=INGEST_BATCH_SIZE):
+        self.batch_id = batch_id
+        self.batch_size = batch_size
+        self.buffer = b""
+        self.pending = []
+        self.line_no = 0
+        self.rows = 0
+        self.counts = {"inserted": 0, "updated": 0, "deleted": 0, "skipped": 0}
+        self.changed_eans = set()
+        # Lease instead of a local set: the same batch may reach two API workers
+        self.lease = run_state.acquire(f"ingest:{batch_id}", "ingest")
+        if self.lease is None:
+            raise BatchInProgress(batch_id)
+
+    def close(self):
+        self.lease.release()
+
+    def _parse(self, line):
+        self.line_no += 1
+        line = line.strip()
+        if not line:
+            return
+        try:
+            item = json.loads(line)
+        except ValueError as e:
+            raise ValueError(f"line {self.line_no}: invalid JSON ({e})")
+        self.pending.append(item)
+        self.rows += 1
+
+    def feed(self, chunk):
+        """Returns True when a full batch is ready for flush()."""
+        self.buffer += chunk
+        *lines, self.buffer = self.buffer.split(b"\n")
+        for line in lines:
+            self._parse(line)
+        return len(self.pending) >= self.batch_size
+
+    def flush(self):
+        """Applies the buffered rows in one transaction."""
+        while self.pending:
+            items, self.pending = self.pending[:self.batch_size], self.pending[self.batch_size:]
+            db = SessionLocal()
+            try:
+                apply_items(db, items, self.changed_eans, self.counts)
+                db.commit()
+            except Exception:
+                db.rollback()
+                raise
+            finally:
+                db.close()
+
+    def finish(self, library_paths=()):
+        self._parse(self.buffer)
+        self.buffer = b""
+        self.flush()
+
+        ensure_table()
+        result = {"batch_id": self.batch_id, "rows": self.rows, **self.counts, "finished_at": time.time()}
+        db = SessionLocal()
+        try:
+            db.merge(IngestBatch(**result))
+            db.commit()
+        finally:
+            db.close()
+        logger.info(f"Catalog ingest {self.batch_id}: {self.rows} rows, {self.counts['inserted']} new, "
+                    f"{self.counts['updated']} updated, {self.counts['deleted']} deleted, "
+                    f"{self.counts['skipped']} skipped.")
+        finish_sync(self.changed_eans, library_paths)
+        return {**result, "changed": len(self.changed_eans)}
@@ -0,0 +1,72 @@
+"""
+In-process cover resizing with Pillow.
+
+JPEGs are decoded in draft mode (the decoder scales by 1/2, 1/4 or 1/8
+while decoding), so a 3000px scan never gets decoded at full size.
+Output JPEGs are progressive. Pillow is optional: without it, or for
+formats it cannot decode, resize_cover raises UnsupportedImage and the
+caller falls back to ffmpeg.
+"""
+import concurrent.futures
+import os
+
+try:
+    from PIL import Image, UnidentifiedImageError
+except ImportError:  # ffmpeg fallback only
+    Image = None
+    UnidentifiedImageError = OSError
+
+COVER_WORKERS = int(os.getenv("COVER_WORKERS", "4"))
+JPEG_QUALITY = 85
+
+_pool = None
+
+
+class UnsupportedImage(Exception):
+    """Pillow is missing or cannot decode this file."""
+
+
+def cover_pool():
+    """Shared pool for cover work across all books of a cycle."""
+    global _pool
+    if _pool is None:
+        _pool = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, COVER_WORKERS),
+                                                      thread_name_prefix="cover")
+    return _pool
+
+
+def resize_cover(src_path, dst_path, max_width, force=False, output_format=None):
+    """
+    Scales src to max_width (never upscales) and writes dst_path.
+    Nothing is written if the image is already narrow enough, unless force.
+    output_format defaults to the source format. Returns the source width.
+    """
+    if Image is None:
+        raise UnsupportedImage("Pillow not installed")
+    try:
+        img = Image.open(src_path)
+    except (UnidentifiedImageError, OSError) as e:
+        raise UnsupportedImage(str(e))
+
+    with img:
+        width, height = img.size
+        if width <= max_width and not force:
+            return width
+        output_format = output_format or img.format
+        target = (min(width, max_width), max(1, round(height * min(width, max_width) / width)))
+        try:
+            if img.format == "JPEG":
+                img.draft("RGB", target)
+            img.load()
+        except OSError as e:
+            raise UnsupportedImage(str(e))
+
+        if img.size != target:
+            img = img.resize(target, Image.LANCZOS)
+        if output_format == "JPEG":
+            if img.mode not in ("RGB", "L"):
+                img = img.convert("RGB")
+            img.save(dst_path, "JPEG", quality=JPEG_QUALITY, progressive=True, optimize=True)
+        else:
+            img.save(dst_path, output_format, optimize=True)
+    return width
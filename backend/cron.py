@@ -0,0 +1,81 @@
+"""
+Minimal 5-field cron expressions (minute hour day-of-month month day-of-week).
+
+Supports '*', lists 'a,b', ranges 'a-b' and steps '*/n' / 'a-b/n'.
+Day-of-week 0 and 7 are Sunday. As in cron, if both day fields are
+restricted a day matches when either does.
+"""
+import datetime
+
+_FIELDS = (
+    ("minute", 0, 59),
+    ("hour", 0, 23),
+    ("day", 1, 31),
+    ("month", 1, 12),
+    ("weekday", 0, 7),
+)
+
+
+def _parse_field(text, low, high):
+    values = set()
+    for part in text.split(","):
+        step = 1
+        if "/" in part:
+            part, step_text = part.split("/", 1)
+            step = int(step_text)
+            if step < 1:
+                raise ValueError(f"Invalid step in '{text}'")
+        if part == "*":
+            start, end = low, high
+        elif "-" in part:
+            start, end = (int(v) for v in part.split("-", 1))
+        else:
+            start = end = int(part)
+        if start < low or end > high or start > end:
+            raise ValueError(f"Value out of range in '{text}' ({low}-{high})")
+        values.update(range(start, end + 1, step))
+    return frozenset(values)
+
+
+class CronSchedule:
+    __slots__ = ("expr", "minute", "hour", "day", "month", "weekday", "day_any", "weekday_any")
+
+    def __init__(self, expr):
+        parts = expr.split()
+        if len(parts) != 5:
+            raise ValueError(f"Cron expression needs 5 fields: '{expr}'")
+        self.expr = expr
+        for (name, low, high), text in zip(_FIELDS, parts):
+            setattr(self, name, _parse_field(text, low, high))
+        if 7 in self.weekday:
+            self.weekday = self.weekday | {0}
+        self.day_any = parts[2] == "*"
+        self.weekday_any = parts[4] == "*"
+
+    def matches(self, dt):
+        if dt.minute not in self.minute or dt.hour not in self.hour or dt.month not in self.month:
+            return False
+        day_ok = dt.day in self.day
+        weekday_ok = (dt.isoweekday() % 7) in self.weekday
+        if self.day_any or self.weekday_any:
+            return day_ok and weekday_ok
+        return day_ok or weekday_ok
+
+    def next_after(self, dt, limit_days=366):
+        """First matching minute strictly after dt (None if none within limit_days)."""
+        candidate = dt.replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+        end = candidate + datetime.timedelta(days=limit_days)
+        while candidate < end:
+            if candidate.month not in self.month:
+                candidate = (candidate.replace(day=1, hour=0, minute=0) + datetime.timedelta(days=32)).replace(day=1)
+                continue
+            if candidate.hour not in self.hour or not self.matches(candidate.replace(minute=min(self.minute))):
+                candidate = candidate.replace(minute=0) + datetime.timedelta(hours=1)
+                continue
+            if self.matches(candidate):
+                return candidate
+            candidate += datetime.timedelta(minutes=1)
+        return None
+
+    def __str__(self):
+        return self.expr
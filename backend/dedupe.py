@@ -0,0 +1,281 @@
+"""
+Library-wide duplicate finder.
+
+Files are grouped by size first; only sizes that occur more than once are
+hashed (BLAKE2b over mmap'ed chunks, in a thread pool). Digests are cached
+in `file_hashes` by device + inode, valid while size and mtime match, so
+later runs only hash new or changed files. Book folders whose audio files
+are all byte-identical to another folder's are reported as duplicate books
+and can be quarantined into _DUPLICATES_TO_DELETE.
+"""
+import collections
+import concurrent.futures
+import hashlib
+import json
+import mmap
+import os
+import time
+from database import DB_PATH, SessionLocal, engine
+from models import FileHash
+from renamer_core import logger, stop_event
+import mover
+
+HASH_CHUNK = 8 * 1024 * 1024
+HASH_WORKERS = int(os.getenv("DEDUPE_HASH_WORKERS", "4"))
+# Smaller files (metadata.json, tiny covers) are not worth reporting
+MIN_FILE_BYTES = int(os.getenv("DEDUPE_MIN_BYTES", str(64 * 1024)))
+REPORT_PATH = os.getenv("DEDUPE_REPORT_PATH", os.path.join(os.path.dirname(DB_PATH) or ".", "duplicates_report.json"))
+
+TRASH_DIR_NAME = "_DUPLICATES_TO_DELETE"
+AUDIO_EXTENSIONS = (".mp3",)
+
+last_report = None
+_report_mtime = None
+
+
+def hash_file(path):
+    """BLAKE2b hex digest of a file, read through mmap in HASH_CHUNK slices."""
+    digest = hashlib.blake2b(digest_size=20)
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return digest.hexdigest()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            with memoryview(mapped) as view:
+                for offset in range(0, size, HASH_CHUNK):
+                    # hashlib releases the GIL for large updates, so workers hash in parallel
+                    digest.update(view[offset:offset + HASH_CHUNK])
+    return digest.hexdigest()
+
+
+def load_hash_cache(db):
+    """Returns {(dev, inode): (size, mtime_ns, digest)}."""
+    FileHash.__table__.create(bind=engine, checkfirst=True)
+    return {(r.dev, r.inode): (r.size, r.mtime_ns, r.digest) for r in db.query(FileHash).all()}
+
+
+def save_hash_cache(db, rows):
+    for dev, inode, size, mtime_ns, digest, path in rows:
+        db.merge(FileHash(dev=dev, inode=inode, size=size, mtime_ns=mtime_ns, digest=digest, path=path))
+    db.commit()
+
+
+def _collect_files(library_path):
+    """
+    Returns {size: [(path, stat)]} for every file outside the quarantine.
+    Hardlinks share their data, so only one path per device + inode is kept.
+    """
+    from planner import scan_library
+    by_size = collections.defaultdict(list)
+    seen = set()
+    for _, node in sorted(scan_library(library_path).items()):
+        for entry in node["files"]:
+            try:
+                st = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            if st.st_size < MIN_FILE_BYTES or (st.st_dev, st.st_ino) in seen:
+                continue
+            seen.add((st.st_dev, st.st_ino))
+            by_size[st.st_size].append((entry.path, st))
+    return by_size
+
+
+def _book_groups(digests, sizes, library_path):
+    """Folders whose complete set of audio files is identical, grouped."""
+    audio_by_dir = collections.defaultdict(list)
+    for path in digests:
+        if path.lower().endswith(AUDIO_EXTENSIONS):
+            audio_by_dir[os.path.dirname(path)].append(path)
+
+    by_content = collections.defaultdict(list)
+    for folder, hashed in audio_by_dir.items():
+        try:
+            names = [n for n in os.listdir(folder) if n.lower().endswith(AUDIO_EXTENSIONS)]
+        except OSError:
+            continue
+        # Only folders where every audio file collided with another file can be duplicates
+        if len(names) != len(hashed):
+            continue
+        key = tuple(sorted(digests[p] for p in hashed))
+        by_content[key].append(folder)
+
+    groups = []
+    for key, folders in by_content.items():
+        if len(folders) < 2:
+            continue
+        size = sum(sizes[p] for p in audio_by_dir[folders[0]])
+        groups.append({
+            "folders": sorted(os.path.relpath(f, library_path) for f in folders),
+            "audio_files": len(key),
+            "bytes": size,
+            "wasted_bytes": size * (len(folders) - 1),
+        })
+    groups.sort(key=lambda g: g["wasted_bytes"], reverse=True)
+    return groups
+
+
+def find_duplicates(db, library_path, workers=HASH_WORKERS):
+    """Scans the library and returns the duplicate report (also kept in last_report)."""
+    global last_report
+    started = time.perf_counter()
+    by_size = _collect_files(library_path)
+    candidates = [f for group in by_size.values() if len(group) > 1 for f in group]
+
+    sizes = {path: st.st_size for path, st in candidates}
+    cache = load_hash_cache(db)
+    digests = {}
+    to_hash = []
+    for path, st in candidates:
+        cached = cache.get((st.st_dev, st.st_ino))
+        if cached and cached[0] == st.st_size and cached[1] == st.st_mtime_ns:
+            digests[path] = cached[2]
+        else:
+            to_hash.append((path, st))
+
+    logger.info(f"Duplicate scan: {len(candidates)} size-colliding file(s), "
+                f"{len(digests)} cached, {len(to_hash)} to hash.")
+
+    new_rows = []
+    hashed_bytes = 0
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            futures = {pool.submit(hash_file, path): (path, st) for path, st in to_hash}
+            for future in concurrent.futures.as_completed(futures):
+                path, st = futures[future]
+                try:
+                    digest = future.result()
+                except OSError as e:
+                    logger.warning(f"Could not hash {path}: {e}")
+                    digest = None
+                if digest is not None:
+                    digests[path] = digest
+                    hashed_bytes += st.st_size
+                    new_rows.append((st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, digest, path))
+                if stop_event.is_set():
+                    # Cancelled futures would still come out of as_completed and raise
+                    for pending in futures:
+                        pending.cancel()
+                    break
+    finally:
+        # Digests computed before a stop (or an error) are kept for the next run
+        save_hash_cache(db, new_rows)
+
+    by_digest = collections.defaultdict(list)
+    for path, digest in digests.items():
+        by_digest[(sizes[path], digest)].append(path)
+    file_groups = [
+        {
+            "digest": digest,
+            "size": size,
+            "files": sorted(os.path.relpath(p, library_path) for p in paths),
+            "wasted_bytes": size * (len(paths) - 1),
+        }
+        for (size, digest), paths in by_digest.items() if len(paths) > 1
+    ]
+    file_groups.sort(key=lambda g: g["wasted_bytes"], reverse=True)
+    book_groups = _book_groups(digests, sizes, library_path)
+
+    report = {
+        "library_path": library_path,
+        "generated_at": time.time(),
+        "seconds": round(time.perf_counter() - started, 3),
+        "complete": not stop_event.is_set(),
+        "files_considered": sum(len(g) for g in by_size.values()),
+        "files_hashed": len(new_rows),
+        "bytes_hashed": hashed_bytes,
+        "cache_hits": len(candidates) - len(to_hash),
+        "duplicate_files": file_groups,
+        "duplicate_books": book_groups,
+        "wasted_bytes": sum(g["wasted_bytes"] for g in file_groups),
+        "quarantined": [],
+    }
+    logger.info(f"Duplicate scan finished: {len(file_groups)} duplicate file group(s), "
+                f"{len(book_groups)} duplicate book(s), "
+                f"{report['wasted_bytes'] / (1024 * 1024):.1f} MB reclaimable "
+                f"({len(new_rows)} hashed in {report['seconds']}s).")
+    last_report = report
+    save_report(report)
+    return report
+
+
+def _keeper(folders):
+    """The folder to keep: one with metadata.json (placed by us), then the oldest."""
+    def rank(folder):
+        has_metadata = os.path.exists(os.path.join(folder, "metadata.json"))
+        try:
+            mtime = os.path.getmtime(folder)
+        except OSError:
+            mtime = float("inf")
+        return (not has_metadata, mtime, folder)
+    return min(folders, key=rank)
+
+
+def quarantine_duplicates(library_path, report):
+    """Moves every duplicate book folder except one per group into the trash folder."""
+    trash_dir = os.path.join(library_path, TRASH_DIR_NAME)
+    moved = []
+    for group in report["duplicate_books"]:
+        if stop_event.is_set():
+            break
+        folders = [os.path.join(library_path, f) for f in group["folders"]]
+        folders = [f for f in folders if os.path.isdir(f)]
+        if len(folders) < 2:
+            continue
+        keep = _keeper(folders)
+        for folder in folders:
+            if folder == keep:
+                continue
+            os.makedirs(trash_dir, exist_ok=True)
+            target = os.path.join(trash_dir, os.path.basename(folder))
+            if os.path.exists(target):
+                target += f"_{int(time.time())}"
+            try:
+                mover.move_tree(folder, target)
+            except Exception as e:
+                logger.error(f"Failed to quarantine duplicate {folder}: {e}")
+                continue
+            logger.warning(f"Quarantined duplicate '{os.path.relpath(folder, library_path)}' "
+                           f"(kept '{os.path.relpath(keep, library_path)}').")
+            moved.append(os.path.relpath(folder, library_path))
+    report["quarantined"] = moved
+    save_report(report)
+    return moved
+
+
+def run_duplicate_scan(library_path, quarantine=False):
+    db = SessionLocal()
+    try:
+        report = find_duplicates(db, library_path)
+    finally:
+        db.close()
+    if quarantine and report["complete"]:
+        quarantine_duplicates(library_path, report)
+    return report
+
+
+def save_report(report):
+    try:
+        temp_path = REPORT_PATH + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(report, f)
+        os.replace(temp_path, REPORT_PATH)
+    except OSError as e:
+        logger.warning(f"Could not write duplicate report: {e}")
+
+
+def load_report():
+    """The newest report; re-read whenever the file changed (another worker may have scanned)."""
+    global last_report, _report_mtime
+    try:
+        mtime = os.path.getmtime(REPORT_PATH)
+    except OSError:
+        return last_report
+    if mtime != _report_mtime:
+        try:
+            with open(REPORT_PATH, encoding="utf-8") as f:
+                last_report = json.load(f)
+            _report_mtime = mtime
+        except (OSError, json.JSONDecodeError):
+            pass
+    return last_report
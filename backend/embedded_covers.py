@@ -0,0 +1,301 @@
+"""
+Covers from ID3v2 APIC frames.
+
+Books without any loose .jpg get `<EAN>.jpg` from the picture embedded in
+their first track, so the inventory shows a cover and takedown detection
+(which keys on `<EAN>.jpg`) recognizes the book. read_apic() is a small
+ID3v2.2/2.3/2.4 reader that reads only the tag bytes at the start of the
+file. The picture goes through the same 600px normalization as loose
+covers. Results per first track are cached in `cover_scans` (device +
+inode, valid while size and mtime match), so a track without a picture
+is never parsed twice.
+"""
+import concurrent.futures
+import json
+import os
+import struct
+import time
+import zlib
+import covers
+from database import SessionLocal, engine
+from models import CoverScan
+from renamer_core import logger, stop_event, resize_image_if_needed, book_target_path
+from thumbnails import make_thumbnail
+
+COVER_MAX_WIDTH = 600
+# Front cover first, then any other picture type
+FRONT_COVER = 3
+MIME_EXTENSIONS = {"image/jpeg": ".jpg", "image/jpg": ".jpg", "image/png": ".png", "jpg": ".jpg", "png": ".png"}
+AUDIO_EXTENSIONS = (".mp3",)
+COVER_EXTENSIONS = (".jpg", ".jpeg")
+
+_table_ready = False
+
+
+def _syncsafe(data):
+    return (data[0] << 21) | (data[1] << 14) | (data[2] << 7) | data[3]
+
+
+def _unsync(data):
+    return data.replace(b"\xff\x00", b"\xff")
+
+
+def _split_description(body, encoding):
+    """Skips the null-terminated description; returns the bytes after it."""
+    if encoding in (1, 2):  # UTF-16: two-byte terminator on an even offset
+        i = 0
+        while i + 1 < len(body):
+            if body[i] == 0 and body[i + 1] == 0:
+                return body[i + 2:]
+            i += 2
+        return b""
+    end = body.find(b"\x00")
+    return body[end + 1:] if end >= 0 else b""
+
+
+def _parse_picture(frame_id, body):
+    """Returns (picture_type, mime, data) of an APIC/PIC frame body."""
+    if len(body) < 4:
+        return None
+    encoding = body[0]
+    if frame_id == b"PIC":
+        mime = body[1:4].decode("latin-1").lower()
+        rest = body[4:]
+    else:
+        end = body.find(b"\x00", 1)
+        if end < 0:
+            return None
+        mime = body[1:end].decode("latin-1").lower()
+        rest = body[end + 1:]
+    if not rest:
+        return None
+    picture_type = rest[0]
+    data = _split_description(rest[1:], encoding)
+    return (picture_type, mime, data) if data else None
+
+
+def _frames(tag, major, tag_unsync):
+    """Yields (frame_id, body) of every readable frame."""
+    pos = 0
+    header_size = 6 if major == 2 else 10
+    while pos + header_size <= len(tag):
+        if major == 2:
+            frame_id = tag[pos:pos + 3]
+            size = int.from_bytes(tag[pos + 3:pos + 6], "big")
+            flags = 0
+        else:
+            frame_id = tag[pos:pos + 4]
+            size = _syncsafe(tag[pos + 4:pos + 8]) if major == 4 else struct.unpack(">I", tag[pos + 4:pos + 8])[0]
+            flags = tag[pos + 9]
+        if not frame_id.strip(b"\x00") or size <= 0:
+            return  # padding
+        body = tag[pos + header_size:pos + header_size + size]
+        pos += header_size + size
+
+        if major == 3:
+            if flags & 0x40:  # encrypted
+                continue
+            extra = (4 if flags & 0x80 else 0) + (1 if flags & 0x20 else 0)
+            if flags & 0x80:
+                try:
+                    body = zlib.decompress(body[extra:])
+                except zlib.error:
+                    continue
+            else:
+                body = body[extra:]
+        elif major == 4:
+            if flags & 0x04:  # encrypted
+                continue
+            extra = (1 if flags & 0x40 else 0) + (4 if flags & 0x01 else 0)
+            body = body[extra:]
+            if flags & 0x02 or tag_unsync:
+                body = _unsync(body)
+            if flags & 0x08:
+                try:
+                    body = zlib.decompress(body)
+                except zlib.error:
+                    continue
+        yield frame_id, body
+
+
+def read_apic(path):
+    """(mime, bytes) of the embedded cover, or None. Reads only the ID3v2 tag."""
+    with open(path, "rb") as f:
+        header = f.read(10)
+        if len(header) < 10 or header[:3] != b"ID3":
+            return None
+        major, flags = header[3], header[5]
+        if major not in (2, 3, 4):
+            return None
+        tag = f.read(_syncsafe(header[6:10]))
+
+    if major == 2 and flags & 0x40:  # v2.2 compression was never defined
+        return None
+    if major < 4 and flags & 0x80:
+        tag = _unsync(tag)
+    if major >= 3 and flags & 0x40 and len(tag) >= 4:  # extended header
+        if major == 3:
+            tag = tag[4 + struct.unpack(">I", tag[:4])[0]:]
+        else:
+            tag = tag[_syncsafe(tag[:4]):]
+
+    best = None
+    for frame_id, body in _frames(tag, major, major == 4 and bool(flags & 0x80)):
+        if frame_id not in (b"APIC", b"PIC"):
+            continue
+        picture = _parse_picture(frame_id, body)
+        if picture is None:
+            continue
+        if picture[0] == FRONT_COVER:
+            return picture[1], picture[2]
+        if best is None:
+            best = (picture[1], picture[2])
+    return best
+
+
+def write_cover(folder, ean, mime, data):
+    """Writes `<EAN>.jpg` through the cover normalization. Returns True on success."""
+    extension = MIME_EXTENSIONS.get(mime, ".jpg")
+    cover_path = os.path.join(folder, f"{ean}.jpg")
+    temp_path = os.path.join(folder, f"temp_embedded_{ean}{extension}")
+    with open(temp_path, "wb") as f:
+        f.write(data)
+    try:
+        if extension == ".jpg":
+            os.replace(temp_path, cover_path)
+            if not resize_image_if_needed((cover_path, folder, f"{ean}.jpg")):
+                # The cover is written; only the 600px normalization is missing
+                logger.warning(f"Could not resize embedded cover for {ean}; kept it at full size.")
+            return True
+        # PNG and friends: converted to JPEG (Pillow, else ffmpeg)
+        return make_thumbnail(temp_path, cover_path, COVER_MAX_WIDTH)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def ensure_table():
+    global _table_ready
+    if not _table_ready:
+        CoverScan.__table__.create(bind=engine, checkfirst=True)
+        _table_ready = True
+
+
+def _first_track(file_names):
+    tracks = sorted(n for n in file_names if n.lower().endswith(AUDIO_EXTENSIONS))
+    return tracks[0] if tracks else None
+
+
+def _extract(folder, ean, track_path):
+    """Returns True if a cover was written."""
+    try:
+        picture = read_apic(track_path)
+    except OSError as e:
+        logger.warning(f"Could not read ID3 tag of {track_path}: {e}")
+        return False
+    if picture is None:
+        return False
+    mime, data = picture
+    try:
+        if write_cover(folder, ean, mime, data):
+            logger.info(f"Extracted embedded cover for {ean} from {os.path.basename(track_path)}.")
+            return True
+    except OSError as e:
+        logger.warning(f"Could not write embedded cover for {ean}: {e}")
+    return False
+
+
+def _metadata_ean(folder):
+    """The isbn from a metadata.json we wrote earlier, or None."""
+    try:
+        with open(os.path.join(folder, "metadata.json"), encoding="utf-8") as f:
+            ean = json.load(f).get("isbn")
+    except (OSError, ValueError, AttributeError):
+        return None
+    return str(ean) if ean else None
+
+
+def extract_missing_covers(library_path, tree=None, since=None):
+    """
+    `<EAN>.jpg` for every book folder in library_path (folders with tracks,
+    from the scan snapshot) that has no .jpg yet. The EAN comes from the
+    placements table, else from the catalog's Author/Title path, else from
+    metadata.json, so books placed before placements were tracked or copied
+    in by hand are covered too. Books placed at or after `since` are listed
+    fresh. Runs on the cover pool.
+    """
+    from catalog import get_snapshot
+    from planner import scan_library
+    from sidecars import placements_below
+    ensure_table()
+    db = SessionLocal()
+    try:
+        placements = placements_below(db, library_path)
+        cache = {(c.dev, c.inode): c for c in db.query(CoverScan).all()}
+    finally:
+        db.close()
+    if tree is None:
+        tree = scan_library(library_path)
+
+    placed = {folder: (ean, updated_at) for ean, (folder, updated_at) in placements.items()}
+    catalog_paths = None
+    folders = {path for path, node in tree.items()
+               if path != library_path and _first_track(e.name for e in node["files"])}
+    folders.update(placed)
+
+    books = []
+    for folder in sorted(folders):
+        ean, updated_at = placed.get(folder, (None, None))
+        node = tree.get(folder)
+        if node is not None and (since is None or updated_at is None or updated_at < since):
+            names = [e.name for e in node["files"]]
+        else:
+            try:
+                names = os.listdir(folder)
+            except OSError:
+                continue
+        if any(n.lower().endswith(COVER_EXTENSIONS) for n in names):
+            continue
+        first = _first_track(names)
+        if first is None:
+            continue
+        if ean is None:
+            if catalog_paths is None:
+                catalog_paths = {book_target_path(library_path, book)[1]: book.ean
+                                 for book in get_snapshot().active()}
+            ean = catalog_paths.get(folder) or _metadata_ean(folder)
+            if ean is None:
+                continue
+        track_path = os.path.join(folder, first)
+        try:
+            st = os.stat(track_path)
+        except OSError:
+            continue
+        cached = cache.get((st.st_dev, st.st_ino))
+        if cached and cached.size == st.st_size and cached.mtime_ns == st.st_mtime_ns:
+            continue
+        books.append((folder, ean, track_path, st))
+
+    if not books:
+        return 0
+
+    extracted = 0
+    rows = []
+    futures = {covers.cover_pool().submit(_extract, folder, ean, track_path): (track_path, st)
+               for folder, ean, track_path, st in books if not stop_event.is_set()}
+    for future in concurrent.futures.as_completed(futures):
+        track_path, st = futures[future]
+        found = future.result()
+        extracted += found
+        rows.append(CoverScan(dev=st.st_dev, inode=st.st_ino, size=st.st_size, mtime_ns=st.st_mtime_ns,
+                              found=found, path=track_path, checked_at=time.time()))
+
+    db = SessionLocal()
+    try:
+        for row in rows:
+            db.merge(row)
+        db.commit()
+    finally:
+        db.close()
+    logger.info(f"Embedded covers: {extracted} extracted, {len(books) - extracted} book(s) without a picture.")
+    return extracted
@@ -0,0 +1,142 @@
+"""
+Typo-tolerant fallback for the ABS title search.
+
+A character-trigram index over normalized titles and authors (lowercase,
+umlauts folded to ae/oe/ue/ss, accents and punctuation stripped). It is
+only asked when the exact token search finds nothing. sync() brings the
+index up to date with a catalog snapshot by re-indexing just the records
+whose title, author or takedown flag changed since the last sync.
+"""
+import collections
+import itertools
+import os
+import re
+import threading
+import time
+import unicodedata
+
+SIMILARITY_THRESHOLD = float(os.getenv("FUZZY_THRESHOLD", "0.45"))
+MAX_RESULTS = int(os.getenv("FUZZY_MAX_RESULTS", "10"))
+# Weight of the author in the score when the query has one
+AUTHOR_WEIGHT = 1 / 3
+
+FOLD = str.maketrans({"ä": "ae", "ö": "oe", "ü": "ue", "ß": "ss"})
+
+
+def normalize(text):
+    text = (text or "").lower().translate(FOLD)
+    text = unicodedata.normalize("NFKD", text)
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return " ".join(re.sub(r"[\W_]+", " ", text).split())
+
+
+def trigrams(text):
+    """Trigrams of every word padded like pg_trgm ("  w", " wo", ..., "rd ")."""
+    grams = set()
+    for word in normalize(text).split():
+        padded = f"  {word} "
+        for i in range(len(padded) - 2):
+            grams.add(padded[i:i + 3])
+    return frozenset(grams)
+
+
+def similarity(shared, a, b):
+    """Dice coefficient from the shared trigram count and both set sizes."""
+    return 2 * shared / (a + b) if a + b else 0.0
+
+
+class TrigramIndex:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}  # ean -> (key, title grams, author grams)
+        self.title_postings = collections.defaultdict(set)
+        self.author_postings = collections.defaultdict(set)
+        self.built_at = None
+        self.last_sync = {"changed": 0, "removed": 0, "seconds": 0.0}
+
+    def _remove(self, ean):
+        _, title_grams, author_grams = self.entries.pop(ean)
+        for gram in title_grams:
+            self.title_postings[gram].discard(ean)
+        for gram in author_grams:
+            self.author_postings[gram].discard(ean)
+
+    def sync(self, snapshot):
+        """Re-indexes records that changed since the last synced snapshot."""
+        if self.built_at == snapshot.built_at:
+            return
+        started = time.perf_counter()
+        with self.lock:
+            if self.built_at == snapshot.built_at:
+                return
+            changed = removed = 0
+            seen = set()
+            for r in snapshot.records:
+                if r.takedown:
+                    continue
+                seen.add(r.ean)
+                key = (r.title_key, r.author_key)
+                entry = self.entries.get(r.ean)
+                if entry is not None and entry[0] == key:
+                    continue
+                if entry is not None:
+                    self._remove(r.ean)
+                title_grams = trigrams(r.title)
+                author_grams = trigrams(r.author)
+                self.entries[r.ean] = (key, title_grams, author_grams)
+                for gram in title_grams:
+                    self.title_postings[gram].add(r.ean)
+                for gram in author_grams:
+                    self.author_postings[gram].add(r.ean)
+                changed += 1
+            for ean in [e for e in self.entries if e not in seen]:
+                self._remove(ean)
+                removed += 1
+            self.built_at = snapshot.built_at
+            self.last_sync = {"changed": changed, "removed": removed,
+                              "seconds": round(time.perf_counter() - started, 3)}
+
+    def search(self, snapshot, title, author=None, status_keywords=(), threshold=None, limit=MAX_RESULTS):
+        """Records ranked by trigram similarity, best first, at or above threshold."""
+        self.sync(snapshot)
+        threshold = SIMILARITY_THRESHOLD if threshold is None else threshold
+        query_title = trigrams(title)
+        if not query_title:
+            return []
+        query_author = trigrams(author) if author else frozenset()
+
+        with self.lock:
+            shared_title = collections.Counter(itertools.chain.from_iterable(
+                self.title_postings.get(gram, ()) for gram in query_title))
+            shared_author = collections.Counter(itertools.chain.from_iterable(
+                self.author_postings.get(gram, ()) for gram in query_author))
+
+            scored = []
+            for ean, shared in shared_title.items():
+                _, title_grams, author_grams = self.entries[ean]
+                score = similarity(shared, len(query_title), len(title_grams))
+                if query_author:
+                    author_score = similarity(shared_author.get(ean, 0), len(query_author), len(author_grams))
+                    score = (1 - AUTHOR_WEIGHT) * score + AUTHOR_WEIGHT * author_score
+                if score >= threshold:
+                    scored.append((score, ean))
+
+        scored.sort(key=lambda item: (-item[0], item[1]))
+        matches = []
+        for score, ean in scored:
+            r = snapshot.get(ean)
+            if r is None or r.takedown:
+                continue
+            if status_keywords and not any(k in r.status_key for k in status_keywords):
+                continue
+            matches.append(r)
+            if len(matches) >= limit:
+                break
+        return matches
+
+    def stats(self):
+        return {"indexed": len(self.entries), "trigrams": len(self.title_postings) + len(self.author_postings),
+                "threshold": SIMILARITY_THRESHOLD, **self.last_sync}
+
+
+index = TrigramIndex()
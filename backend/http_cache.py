@@ -0,0 +1,52 @@
+"""
+Conditional file responses: ETag/Last-Modified validators, 304 handling
+and Cache-Control for files served from the library and the caches.
+"""
+import hashlib
+import os
+from email.utils import formatdate, parsedate_to_datetime
+from fastapi import Request, Response
+from fastapi.responses import FileResponse
+
+# Library URLs are not versioned, so a week rather than a year; after that
+# the browser revalidates and usually gets a 304.
+LONG_CACHE = "public, max-age=604800"
+
+
+def file_validators(stat_result):
+    """Returns (etag, last_modified) for a stat result."""
+    etag_base = f"{stat_result.st_mtime_ns}-{stat_result.st_size}"
+    etag = f'"{hashlib.md5(etag_base.encode()).hexdigest()}"'
+    return etag, formatdate(stat_result.st_mtime, usegmt=True)
+
+
+def is_not_modified(request: Request, etag, stat_result):
+    """RFC 9110: If-None-Match wins over If-Modified-Since."""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        if if_none_match.strip() == "*":
+            return True
+        tags = [t.strip() for t in if_none_match.split(",")]
+        # Weak comparison: W/"x" matches "x"
+        return any(t.removeprefix("W/") == etag for t in tags)
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            since = parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+        return int(stat_result.st_mtime) <= since
+    return False
+
+
+def conditional_file_response(request: Request, path, cache_control=LONG_CACHE, media_type=None):
+    """FileResponse with validators; answers 304 when the client copy is current."""
+    stat_result = os.stat(path)
+    etag, last_modified = file_validators(stat_result)
+    headers = {"ETag": etag, "Last-Modified": last_modified, "Cache-Control": cache_control}
+
+    if request is not None and request.method in ("GET", "HEAD") and is_not_modified(request, etag, stat_result):
+        return Response(status_code=304, headers=headers)
+
+    return FileResponse(path, media_type=media_type, headers=headers, stat_result=stat_result)
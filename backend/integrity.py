@@ -0,0 +1,238 @@
+"""
+Library integrity scan.
+
+Every MP3 is decoded once with `ffmpeg -v error -f null` in a thread pool
+(INTEGRITY_WORKERS, default one per CPU, paused under host pressure like
+the transcoder). Zips are CRC-checked before the cycle deletes them.
+Verdicts are cached in `file_verdicts` by device + inode and stay valid
+while size and mtime match, so a repeat scan only decodes new or changed
+files. Failures end up in the JSON report behind GET /api/integrity.
+"""
+import concurrent.futures
+import json
+import os
+import subprocess
+import time
+import zipfile
+import throttle
+from database import DB_PATH, SessionLocal, engine
+from models import FileVerdict
+from renamer_core import logger, stop_event
+
+INTEGRITY_WORKERS = int(os.getenv("INTEGRITY_WORKERS", str(os.cpu_count() or 1)))
+REPORT_PATH = os.getenv("INTEGRITY_REPORT_PATH", os.path.join(os.path.dirname(DB_PATH) or ".", "integrity_report.json"))
+AUDIO_EXTENSIONS = (".mp3",)
+# ffmpeg can print thousands of lines for a broken file
+MAX_ERROR_CHARS = 1000
+
+last_report = None
+_report_mtime = None
+_table_ready = False
+
+
+def ensure_table():
+    global _table_ready
+    if not _table_ready:
+        FileVerdict.__table__.create(bind=engine, checkfirst=True)
+        _table_ready = True
+
+
+def decode_check(path):
+    """Decodes the whole file without output. Returns (ok, error)."""
+    cmd = throttle.niced(["ffmpeg", "-v", "error", "-i", path, "-f", "null", "-"])
+    try:
+        result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, errors="replace")
+    except OSError as e:
+        return False, str(e)
+    errors = result.stderr.strip()
+    if result.returncode != 0 or errors:
+        return False, (errors or f"ffmpeg exited with {result.returncode}")[:MAX_ERROR_CHARS]
+    return True, None
+
+
+def verify_zip(zip_path):
+    """CRC-checks every member. Returns None if the zip is intact, else the error."""
+    try:
+        with zipfile.ZipFile(zip_path, "r") as zf:
+            bad = zf.testzip()
+    except (OSError, zipfile.BadZipFile, EOFError) as e:
+        return str(e)
+    return f"Bad CRC-32 for {bad}" if bad else None
+
+
+def _is_current(verdict, st):
+    return verdict is not None and verdict.size == st.st_size and verdict.mtime_ns == st.st_mtime_ns
+
+
+def record_verdict(path, ok, error=None, st=None):
+    ensure_table()
+    try:
+        st = st or os.stat(path)
+    except OSError:
+        return
+    db = SessionLocal()
+    try:
+        db.merge(FileVerdict(dev=st.st_dev, inode=st.st_ino, size=st.st_size, mtime_ns=st.st_mtime_ns,
+                             ok=ok, error=error, path=path, checked_at=time.time()))
+        db.commit()
+    except Exception as e:
+        logger.warning(f"Could not record integrity verdict for {path}: {e}")
+    finally:
+        db.close()
+
+
+def known_bad(path):
+    """The cached error if path failed a check and has not changed since, else None."""
+    ensure_table()
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    db = SessionLocal()
+    try:
+        verdict = db.get(FileVerdict, (st.st_dev, st.st_ino))
+        if _is_current(verdict, st) and not verdict.ok:
+            return verdict.error or "failed integrity check"
+        return None
+    finally:
+        db.close()
+
+
+def check_zip_before_delete(zip_path):
+    """True if the zip may be deleted; a failed CRC check is logged and cached."""
+    error = verify_zip(zip_path)
+    if error is None:
+        return True
+    logger.error(f"Zip '{os.path.basename(zip_path)}' failed the CRC check ({error}). Keeping it.")
+    record_verdict(zip_path, False, error)
+    return False
+
+
+def _collect_tracks(library_path):
+    from planner import scan_library
+    tracks = []
+    for node in scan_library(library_path).values():
+        for entry in node["files"]:
+            if entry.name.lower().endswith(AUDIO_EXTENSIONS):
+                try:
+                    tracks.append((entry.path, entry.stat(follow_symlinks=False)))
+                except OSError:
+                    continue
+    return tracks
+
+
+def _checked(path):
+    """Decode check that waits while the host is under pressure."""
+    if not throttle.wait_for_capacity(stop_event):
+        return None
+    return decode_check(path)
+
+
+def check_library(db, library_path, workers=INTEGRITY_WORKERS):
+    """Decode-checks every track not covered by a current cached verdict. Returns the report."""
+    ensure_table()
+    started = time.perf_counter()
+    tracks = _collect_tracks(library_path)
+    cache = {(v.dev, v.inode): v for v in db.query(FileVerdict).all()}
+
+    failures = []
+    to_check = []
+    for path, st in tracks:
+        verdict = cache.get((st.st_dev, st.st_ino))
+        if _is_current(verdict, st):
+            if not verdict.ok:
+                failures.append({"path": os.path.relpath(path, library_path), "error": verdict.error})
+        else:
+            to_check.append((path, st))
+
+    logger.info(f"Integrity scan: {len(tracks)} track(s), {len(tracks) - len(to_check)} cached, "
+                f"{len(to_check)} to decode ({workers} worker(s)).")
+
+    checked = 0
+    complete = False
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            futures = {pool.submit(_checked, path): (path, st) for path, st in to_check}
+            for future in concurrent.futures.as_completed(futures):
+                result = future.result()
+                if result is not None:
+                    path, st = futures[future]
+                    ok, error = result
+                    checked += 1
+                    db.merge(FileVerdict(dev=st.st_dev, inode=st.st_ino, size=st.st_size, mtime_ns=st.st_mtime_ns,
+                                         ok=ok, error=error, path=path, checked_at=time.time()))
+                    if not ok:
+                        logger.error(f"Integrity: {os.path.relpath(path, library_path)} does not decode cleanly.")
+                        failures.append({"path": os.path.relpath(path, library_path), "error": error})
+                if stop_event.is_set():
+                    # Cancelled futures would still come out of as_completed and raise
+                    for pending in futures:
+                        pending.cancel()
+                    break
+        complete = not stop_event.is_set()
+    finally:
+        # Verdicts and the report of a stopped or failed scan are kept, too
+        db.commit()
+        report = _build_report(library_path, started, complete, tracks, to_check, checked, failures, cache)
+    return report
+
+
+def _build_report(library_path, started, complete, tracks, to_check, checked, failures, cache):
+    global last_report
+    # Zips that failed their CRC check before deletion and are still there
+    zip_failures = [
+        {"path": v.path, "error": v.error, "checked_at": v.checked_at}
+        for v in cache.values() if not v.ok and v.path.lower().endswith(".zip") and os.path.exists(v.path)
+    ]
+    failures.sort(key=lambda f: f["path"])
+    report = {
+        "library_path": library_path,
+        "generated_at": time.time(),
+        "seconds": round(time.perf_counter() - started, 3),
+        "complete": complete,
+        "tracks": len(tracks),
+        "tracks_checked": checked,
+        "cache_hits": len(tracks) - len(to_check),
+        "failures": failures,
+        "zip_failures": zip_failures,
+    }
+    logger.info(f"Integrity scan {'finished' if complete else 'stopped'}: {len(failures)} damaged track(s), "
+                f"{len(zip_failures)} bad zip(s) ({checked} decoded in {report['seconds']}s).")
+    last_report = report
+    save_report(report)
+    return report
+
+
+def run_integrity_scan(library_path):
+    db = SessionLocal()
+    try:
+        return check_library(db, library_path)
+    finally:
+        db.close()
+
+
+def save_report(report):
+    try:
+        temp_path = REPORT_PATH + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(report, f)
+        os.replace(temp_path, REPORT_PATH)
+    except OSError as e:
+        logger.warning(f"Could not write integrity report: {e}")
+
+
+def load_report():
+    """The newest report; re-read whenever the file changed (another worker may have scanned)."""
+    global last_report, _report_mtime
+    try:
+        mtime = os.path.getmtime(REPORT_PATH)
+    except OSError:
+        return last_report
+    if mtime != _report_mtime:
+        try:
+            with open(REPORT_PATH, encoding="utf-8") as f:
+                last_report = json.load(f)
+            _report_mtime = mtime
+        except (OSError, json.JSONDecodeError):
+            pass
+    return last_report
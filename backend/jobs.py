@@ -0,0 +1,200 @@
+"""
+Crash-safe job table for scan cycles.
+
+Every book a cycle touches gets a row in `jobs` with a stage cursor:
+
+    pending -> extracted (zip only) -> placed -> optimized -> metadata_written -> (row deleted)
+
+Optimized files are recorded one by one, so a cycle interrupted by a
+restart or stop_event resumes from the last completed stage instead of
+re-extracting, re-moving and re-probing the whole book.
+"""
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+from database import SessionLocal, engine
+from models import Job
+from renamer_core import logger
+
+STAGE_PENDING = "pending"
+STAGE_EXTRACTED = "extracted"
+STAGE_PLACED = "placed"
+STAGE_OPTIMIZED = "optimized"
+STAGE_METADATA = "metadata_written"
+
+# ffmpeg output next to its original (renamer_core.temp_name)
+TEMP_NAME = re.compile(r"temp_(?:q\d+-\d+_)?(.+)")
+
+# Stages after which the book sits in its final folder
+PLACED_STAGES = (STAGE_PLACED, STAGE_OPTIMIZED, STAGE_METADATA)
+
+# Zip extraction happens here; keep it on a persistent volume to resume extracted zips
+WORK_DIR = os.getenv("RENAMER_WORK_DIR", tempfile.gettempdir())
+WORK_PREFIX = "renamer_"
+
+_table_ready = False
+_write_lock = threading.Lock()
+
+# EANs currently being placed by some library root (one process, several roots)
+_placing = set()
+_placing_lock = threading.Lock()
+
+
+class JobState:
+    """In-memory view of a job row; changes are persisted through the functions below."""
+    __slots__ = ("id", "ean", "kind", "source", "stage", "temp_dir", "final_path", "book", "done_files")
+
+    def __init__(self, row):
+        self.id = row.id
+        self.ean = row.ean
+        self.kind = row.kind
+        self.source = row.source
+        self.stage = row.stage
+        self.temp_dir = row.temp_dir
+        self.final_path = row.final_path
+        self.book = json.loads(row.book) if row.book else None
+        self.done_files = set(json.loads(row.done_files or "[]"))
+
+
+def ensure_table():
+    global _table_ready
+    if not _table_ready:
+        Job.__table__.create(bind=engine, checkfirst=True)
+        _table_ready = True
+
+
+def load_unfinished():
+    """Returns {source: JobState} for every job that did not complete."""
+    ensure_table()
+    db = SessionLocal()
+    try:
+        return {row.source: JobState(row) for row in db.query(Job).all()}
+    finally:
+        db.close()
+
+
+def open_job(ean, kind, source, book, existing=None):
+    """Returns the unfinished job for `source`, or creates a new one."""
+    if existing is not None:
+        return existing
+    ensure_table()
+    now = time.time()
+    with _write_lock:
+        db = SessionLocal()
+        try:
+            row = Job(ean=ean, kind=kind, source=source, stage=STAGE_PENDING,
+                      book=json.dumps(book), done_files="[]", created_at=now, updated_at=now)
+            db.add(row)
+            db.commit()
+            return JobState(row)
+        finally:
+            db.close()
+
+
+def update_job(job, **fields):
+    """Persists stage/temp_dir/final_path/error changes."""
+    with _write_lock:
+        db = SessionLocal()
+        try:
+            db.query(Job).filter(Job.id == job.id).update(dict(fields, updated_at=time.time()))
+            db.commit()
+        finally:
+            db.close()
+    for key, value in fields.items():
+        if key in JobState.__slots__:
+            setattr(job, key, value)
+
+
+def add_done_file(job, rel_path):
+    """Records one optimized file (called from the optimizer's worker threads)."""
+    with _write_lock:
+        job.done_files.add(rel_path)
+        db = SessionLocal()
+        try:
+            db.query(Job).filter(Job.id == job.id).update(
+                {"done_files": json.dumps(sorted(job.done_files)), "updated_at": time.time()})
+            db.commit()
+        finally:
+            db.close()
+
+
+def finish_job(job):
+    with _write_lock:
+        db = SessionLocal()
+        try:
+            db.query(Job).filter(Job.id == job.id).delete()
+            db.commit()
+        finally:
+            db.close()
+
+
+def claim_ean(ean):
+    """Reserves an EAN for placement. False if another root is placing it right now."""
+    with _placing_lock:
+        if ean in _placing:
+            return False
+        _placing.add(ean)
+        return True
+
+
+def release_ean(ean):
+    with _placing_lock:
+        _placing.discard(ean)
+
+
+def make_work_dir(ean):
+    os.makedirs(WORK_DIR, exist_ok=True)
+    return tempfile.mkdtemp(prefix=f"{WORK_PREFIX}{ean}_", dir=WORK_DIR)
+
+
+def collect_orphans(library_path, tree=None):
+    """
+    Startup cleanup after a crash: deletes 'temp_<name>' ffmpeg outputs (and
+    'temp_q<job>-<attempt>_<name>' of queue attempts) whose original '<name>'
+    still sits next to them and is not leased to a transcode worker, and
+    extraction dirs that no unfinished job points at. With a scan tree
+    (planner.scan_library) no walk is needed; removed files are dropped from
+    the tree.
+    """
+    if tree is None:
+        from planner import scan_library
+        tree = scan_library(library_path)
+    # Files a transcode worker is converting right now: their temp output is live
+    from transcode_queue import queue
+    leased = queue.leased_paths()
+
+    removed_files = 0
+    for node_path, node in tree.items():
+        names = {entry.name for entry in node["files"]}
+        kept = []
+        for entry in node["files"]:
+            match = TEMP_NAME.match(entry.name)
+            original = match.group(1) if match else None
+            if original in names and os.path.join(node_path, original) not in leased:
+                try:
+                    os.remove(entry.path)
+                    removed_files += 1
+                    continue
+                except OSError as e:
+                    logger.warning(f"Could not remove orphaned {entry.name}: {e}")
+            kept.append(entry)
+        node["files"] = kept
+
+    referenced = {job.temp_dir for job in load_unfinished().values() if job.temp_dir}
+    removed_dirs = 0
+    try:
+        with os.scandir(WORK_DIR) as it:
+            for entry in it:
+                if entry.is_dir() and entry.name.startswith(WORK_PREFIX) and entry.path not in referenced:
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                    removed_dirs += 1
+    except OSError:
+        pass
+
+    if removed_files or removed_dirs:
+        logger.info(f"Startup cleanup: removed {removed_files} orphaned temp file(s), "
+                    f"{removed_dirs} stale extraction dir(s).")
@@ -1,21 +1,34 @@
 from fastapi import FastAPI, WebSocket, Request, Response, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel
-from typing import Optional
+from typing import List, Optional
 import threading
 import time
 import os
 import json
 import asyncio
+from sqlalchemy.exc import OperationalError
 from database import SessionLocal, engine, Base
-from models import Book
-from sqlalchemy import func, or_
+import models  # registers every table for create_all below
 from datetime import datetime
 
-# Create Tables
-Base.metadata.create_all(bind=engine)
-
-from renamer_core import run_once as run_renamer, logger, stop_event
+# Create Tables (uvicorn workers starting together can race on the same CREATE TABLE)
+for _ in range(3):
+    try:
+        Base.metadata.create_all(bind=engine)
+        break
+    except OperationalError:
+        time.sleep(0.2)
+
+from renamer_core import logger, stop_event
+import run_state
+from catalog import get_snapshot
+from catalog_sync import apply_items, finish_sync, batch_result, IngestSession, BatchInProgress
+from cron import CronSchedule
+import throttle
+import fuzzy
+from roots import parse_roots, run_roots, all_metrics
 
 # -----------------
 # 1. DATABASE UPDATE LOGIC (Updated for n8n Webhook)
@@ -56,79 +69,19 @@ def update_database_from_url():
 
         # Database Update
         db = SessionLocal()
-        count_updated = 0
-        count_inserted = 0
-        
+        # EANs whose metadata.json content changes (narrator / abridged status)
+        changed_eans = set()
+
         try:
-            for item in items:
-                # 1. READ FIELDS (Safe get)
-                raw_ean = item.get("EAN")
-                if not raw_ean: 
-                    # Try alternate mapping just in case
-                    raw_ean = item.get("EAN_digital")
-                
-                if not raw_ean: continue
-                
-                ean_str = str(raw_ean).strip()
-                if ean_str.endswith('.0'): ean_str = ean_str[:-2] # Fix Excel number formatting if present
-                if not ean_str: continue
-
-                # Map other fields from JSON
-                author_str = str(item.get("Autor") or "Unknown").strip()
-                title_str = str(item.get("Titel") or "Unknown").strip()
-                narrator_str = str(item.get("Sprecher") or "").strip() or None
-                
-                # FIX: Check VÖ/VÖ_digital AND Release Date 
-                release_str = None
-                for key in ["VÖ_digital", "VOE_digital", "Release Date", "ET"]:
-                    if item.get(key):
-                        release_str = str(item.get(key)).strip()
-                        break
-                        
-                abridged_str = str(item.get("Abridged") or "").strip() or None
-                if not abridged_str:
-                     # Fallback for German field name from n8n
-                     abridged_str = str(item.get("Gekuerzt_Ungekuerzt") or "").strip() or None
-                desc_str = str(item.get("Beschreibung") or "").strip() or None
-                
-                # Takedown logic
-                takedown_val = item.get("Takedown")
-                is_takedown = False
-                if takedown_val:
-                    t_str = str(takedown_val).lower().strip()
-                    if t_str in ["ja", "yes", "true", "1"]:
-                         is_takedown = True
-
-                # 2. UPDATE OR INSERT
-                existing = db.query(Book).filter(Book.ean == ean_str).first()
-                if existing:
-                    existing.author = author_str
-                    existing.title = title_str
-                    existing.takedown = is_takedown
-                    existing.release_date = release_str
-                    existing.abridged_status = abridged_str
-                    existing.narrator = narrator_str
-                    existing.description = desc_str
-                    count_updated += 1
-                else:
-                    new_book = Book(
-                        ean=ean_str, 
-                        author=author_str, 
-                        title=title_str, 
-                        takedown=is_takedown,
-                        release_date=release_str,
-                        abridged_status=abridged_str,
-                        narrator=narrator_str,
-                        description=desc_str
-                    )
-                    db.add(new_book)
-                    count_inserted += 1
-            
+            counts = apply_items(db, items, changed_eans)
             db.commit()
-            logger.info(f"DB Update success. Updated: {count_updated}, New: {count_inserted}")
-            
+            logger.info(f"DB Update success. Updated: {counts['updated']}, New: {counts['inserted']}")
+
         finally:
             db.close()
+
+        finish_sync(changed_eans, [root.path for root in get_library_roots()])
+        return changed_eans
                 
     except Exception as e:
         logger.error(f"DB Update Failed: {e}")
@@ -151,10 +104,14 @@ app.add_middleware(
 # Config
 CONFIG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "config.json")
 
+# Cron expressions (minute hour day month weekday), local time
+DEFAULT_SCHEDULES = {"db_refresh_schedule": "0 * * * *", "scan_schedule": "0 * * * *"}
+
 # 1. Defaults
 final_config = {
     "library_path": "/data/audiobooks",
-    "n8n_webhook_url": ""
+    "n8n_webhook_url": "",
+    **DEFAULT_SCHEDULES,
 }
 
 # 2. Override with Config File (Prioritized for local use)
@@ -177,24 +134,48 @@ env_webhook = os.getenv("N8N_WEBHOOK_URL")
 if env_webhook: 
     final_config["n8n_webhook_url"] = env_webhook
 
+for key in DEFAULT_SCHEDULES:
+    if os.getenv(key.upper()):
+        final_config[key] = os.getenv(key.upper())
+
 # Apply
 config = final_config
 
-# State
-is_running = False
+# Run state (scan lease, stop flag, scheduler) is shared by all uvicorn workers
+run_state.start_bus()
+if run_state.API_WORKERS > 1 and os.getenv("TRANSCODE_QUEUE", "0") == "1":
+    logger.warning("TRANSCODE_QUEUE keeps its jobs in one process; run it with UVICORN_WORKERS=1.")
 
 class ConfigModel(BaseModel):
     library_path: str
     n8n_webhook_url: Optional[str] = None
+    db_refresh_schedule: Optional[str] = None
+    scan_schedule: Optional[str] = None
+    # [{"name", "path", "drop_path", "workers"}]; replaces library_path when set
+    library_roots: Optional[List[dict]] = None
 
 
-def resolve_library_path():
-    user_path = config.get("library_path", "")
+def resolve_library_path(user_path=None):
+    if user_path is None:
+        user_path = config.get("library_path", "")
     if os.path.exists("/host_mnt") and user_path and not user_path.startswith("/host_mnt"):
         clean_path = user_path.lstrip("/")
         return os.path.join("/host_mnt", clean_path)
     return user_path
 
+def get_library_roots():
+    return parse_roots(config, resolve_library_path)
+
+def get_root(name=None):
+    """The named root, or the first one (single-library endpoints)."""
+    roots = get_library_roots()
+    if name is None:
+        return roots[0]
+    for root in roots:
+        if root.name == name:
+            return root
+    raise HTTPException(status_code=404, detail=f"Unknown library root: {name}")
+
 @app.get("/api/config")
 def get_config():
     return config
@@ -203,19 +184,45 @@ def get_config():
 def set_config(new_conf: ConfigModel):
     global config
     logger.info(f"Saving new config: {new_conf.dict()}")
-    config = new_conf.dict()
+    for key in DEFAULT_SCHEDULES:
+        value = getattr(new_conf, key)
+        if value is None:
+            continue
+        try:
+            CronSchedule(value)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=f"{key}: {e}")
+    for entry in new_conf.library_roots or []:
+        if not entry.get("path"):
+            raise HTTPException(status_code=400, detail="library_roots: every root needs a path")
+    new_config = new_conf.dict()
+    for key in DEFAULT_SCHEDULES:
+        if new_config[key] is None:
+            new_config[key] = config.get(key) or DEFAULT_SCHEDULES[key]
+    if new_config["library_roots"] is None:
+        new_config["library_roots"] = config.get("library_roots")
+    config = new_config
     try:
         with open(CONFIG_FILE, 'w') as f:
             json.dump(config, f)
         logger.info("Config saved successfully.")
+        run_state.bus.publish("config_changed", config)
     except Exception as e:
         logger.error(f"Failed to save config: {e}")
         return {"status": "error", "message": str(e)}
     return config
 
+def apply_shared_config(new_config):
+    """Config saved by another worker."""
+    global config
+    config = new_config
+
+run_state.bus.on("config_changed", apply_shared_config)
+
 @app.get("/api/status")
 def get_status():
-    return {"running": is_running}
+    task = run_state.holder()
+    return {"running": task is not None, "task": task}
 
 # MANUAL TRIGGER FOR DATABASE UPDATE
 @app.post("/api/update_db")
@@ -231,43 +238,76 @@ def trigger_update_db():
     return {"status": "DB Update Started"}
 
 
+# PUSH INGEST: NDJSON rows from n8n, same field mapping as the pull
+@app.post("/api/catalog/ingest")
+async def ingest_catalog(request: Request, batch_id: Optional[str] = None):
+    batch_id = batch_id or request.headers.get("X-Batch-Id")
+    if not batch_id:
+        raise HTTPException(status_code=400, detail="batch_id (query) or X-Batch-Id header required")
+
+    previous = await run_in_threadpool(batch_result, batch_id)
+    if previous:
+        logger.info(f"Catalog ingest {batch_id} already applied; returning stored result.")
+        return {**previous, "duplicate": True}
+
+    try:
+        # Acquiring (and releasing) the batch lease hits SQLite; keep it off the event loop
+        session = await run_in_threadpool(IngestSession, batch_id)
+    except BatchInProgress:
+        raise HTTPException(status_code=409, detail=f"Batch {batch_id} is already being ingested")
+    try:
+        async for chunk in request.stream():
+            if session.feed(chunk):
+                await run_in_threadpool(session.flush)
+        library_paths = [root.path for root in get_library_roots()]
+        result = await run_in_threadpool(session.finish, library_paths)
+    except ValueError as e:
+        # Rows before the bad line stay applied; the batch id is not recorded, so a resend is safe
+        raise HTTPException(status_code=400, detail=str(e))
+    finally:
+        await run_in_threadpool(session.close)
+    return {**result, "duplicate": False}
+
+
 @app.post("/api/start")
 def start_renamer():
-    global is_running
-    if is_running:
+    if run_state.is_running():
         return {"status": "Already running"}
 
-    user_path = config["library_path"]
-    internal_path = resolve_library_path()
-    if internal_path != user_path:
-        logger.info(f"Using host path mapping: {user_path} -> {internal_path}")
-
-    if not os.path.exists(internal_path):
-         logger.error(f"Path not found: {internal_path} (Check if path exists on Server)")
-         return {"status": "Error: Path not found"}
-
+    roots = []
+    for root in get_library_roots():
+        if not os.path.exists(root.path):
+            logger.error(f"Path not found: {root.path} (Check if path exists on Server)")
+            continue
+        roots.append(root)
+    if not roots:
+        return {"status": "Error: Path not found"}
+
+    lease = run_state.acquire_scan("cycle")
+    if lease is None:
+        return {"status": "Already running"}
     stop_event.clear()
-    is_running = True
 
     # DEBUG: List contents to verify mount
-    try:
-        msg = f"DEBUG: Checking content of {internal_path}..."
-        logger.info(msg)
-        print(msg, flush=True) # Double safety
-        
-        contents = os.listdir(internal_path)
-        
-        msg2 = f"DEBUG: Found {len(contents)} items: {contents[:10]}..."
-        logger.info(msg2)
-        print(msg2, flush=True)
-    except Exception as e:
-        err_msg = f"DEBUG: Error reading directory: {e}"
-        logger.error(err_msg)
-        print(err_msg, flush=True)
+    for root in roots:
+        internal_path = root.path
+        try:
+            msg = f"DEBUG: Checking content of {internal_path}..."
+            logger.info(msg)
+            print(msg, flush=True) # Double safety
+            
+            contents = os.listdir(internal_path)
+            
+            msg2 = f"DEBUG: Found {len(contents)} items: {contents[:10]}..."
+            logger.info(msg2)
+            print(msg2, flush=True)
+        except Exception as e:
+            err_msg = f"DEBUG: Error reading directory: {e}"
+            logger.error(err_msg)
+            print(err_msg, flush=True)
 
 
     def worker():
-        global is_running
         logger.info("Renamer Core: Starting processing cycle...")
         
         # 1. NO AUTO UPDATE - Database is manual now
@@ -277,75 +317,308 @@ def start_renamer():
         # 2. RUN RENAME
         logger.info("Scanning Folder Structure...")
         try:
-            run_renamer(internal_path)
+            run_roots(roots)
         except Exception as e:
             logger.error(f"Renamer Service crashed: {e}")
         finally:
-            is_running = False
+            lease.release()
             logger.info("Renamer Service Cycle Completed.")
 
     threading.Thread(target=worker, daemon=True).start()
     return {"status": "Started"}
 
-# Scheduler State
-scheduler_active = False
+# Scheduler: the on/off flag is shared; one worker holds the scheduler lease and fires the slots
 scheduler_thread = None
 
+def get_schedule(key):
+    try:
+        return CronSchedule(config.get(key) or DEFAULT_SCHEDULES[key])
+    except ValueError as e:
+        logger.error(f"Invalid {key} '{config.get(key)}': {e}. Using default.")
+        return CronSchedule(DEFAULT_SCHEDULES[key])
+
+def start_scheduled_cycle(refresh_due, scan_due):
+    """Starts one scheduled cycle unless a scan is running in any worker."""
+    roots = []
+    if scan_due:
+        for root in get_library_roots():
+            if os.path.exists(root.path):
+                roots.append(root)
+            else:
+                logger.error(f"Scheduler: Library path not found: {root.path}")
+        scan_due = bool(roots)
+    if not (refresh_due or scan_due):
+        return
+
+    lease = run_state.acquire_scan("scheduled cycle")
+    if lease is None:
+        logger.info("Scheduler: previous cycle still running, skipping this slot.")
+        return
+    stop_event.clear()
+
+    def scheduled_worker():
+        try:
+            if refresh_due:
+                logger.info("Scheduler: Refreshing metadata from n8n...")
+                update_database_from_url()
+            if scan_due:
+                logger.info("Scheduler: Starting folder scan...")
+                run_roots(roots, trigger="scheduler")
+        except Exception as e:
+            logger.error(f"Scheduled cycle failed: {e}")
+        finally:
+            lease.release()
+            logger.info("Scheduler: Cycle finished.")
+
+    threading.Thread(target=scheduled_worker, daemon=True).start()
+
 def scheduler_loop():
-    global scheduler_active, is_running
-    logger.info("Auto-Scan Scheduler Started (runs every 60 min).")
-    while scheduler_active:
-        if not is_running:
-             logger.info("Scheduler: Triggering scheduled cycle...")
-             internal_path = resolve_library_path()
-
-             if not os.path.exists(internal_path):
-                logger.error(f"Scheduler: Library path not found: {internal_path}")
-             else:
-                stop_event.clear()
-                is_running = True
-
-                def scheduled_worker():
-                    global is_running
-                    try:
-                        logger.info("Scheduler: Refreshing metadata from n8n before scan...")
-                        update_database_from_url()
-                        logger.info("Scheduler: Starting folder scan...")
-                        run_renamer(internal_path)
-                    except Exception as e:
-                        logger.error(f"Scheduled scan failed: {e}")
-                    finally:
-                        is_running = False
-                        logger.info("Scheduler: Cycle finished. Waiting 60 min.")
-
-                threading.Thread(target=scheduled_worker, daemon=True).start()
-        
-        # Sleep in chunks to allow faster stopping
-        for _ in range(60): 
-            if not scheduler_active: break
-            time.sleep(60) # 60 * 60s = 1 hour
+    """
+    Checks both cron schedules once per minute. A DB refresh and a scan due
+    in the same minute run in that order in one cycle; a slot that comes up
+    while a cycle is still running is skipped. With several workers only the
+    holder of the scheduler lease fires slots; the others take over if it dies.
+    """
+    logger.info(f"Scheduler started (DB refresh: '{get_schedule('db_refresh_schedule')}', "
+                f"scan: '{get_schedule('scan_schedule')}').")
+    last_slot = None
+    lease = None
+    while run_state.get_flag("scheduler_active"):
+        if lease is None or lease.lost:
+            lease = run_state.acquire(run_state.SCHEDULER, "scheduler")
+        if lease is not None:
+            slot = datetime.now().replace(second=0, microsecond=0)
+            if slot != last_slot:
+                last_slot = slot
+                refresh_due = get_schedule("db_refresh_schedule").matches(slot)
+                scan_due = get_schedule("scan_schedule").matches(slot)
+                if (refresh_due or scan_due) and run_state.is_running():
+                    logger.info("Scheduler: previous cycle still running, skipping this slot.")
+                elif refresh_due or scan_due:
+                    start_scheduled_cycle(refresh_due, scan_due)
+
+        # Wake up shortly after the next minute starts (and stop quickly when disabled)
+        time.sleep(min(5, 60 - datetime.now().second + 0.5))
+    if lease is not None:
+        lease.release()
+
+def start_scheduler_thread():
+    global scheduler_thread
+    if scheduler_thread is None or not scheduler_thread.is_alive():
+        scheduler_thread = threading.Thread(target=scheduler_loop, daemon=True)
+        scheduler_thread.start()
 
 @app.post("/api/scheduler")
 def toggle_scheduler(enable: bool):
-    global scheduler_active, scheduler_thread
-    scheduler_active = enable
-    
+    was_active = run_state.get_flag("scheduler_active")
+    run_state.set_flag("scheduler_active", enable)
+
     if enable:
-        if scheduler_thread is None or not scheduler_thread.is_alive():
-            scheduler_thread = threading.Thread(target=scheduler_loop, daemon=True)
-            scheduler_thread.start()
+        start_scheduler_thread()
+        if not was_active:
+            # Switching it on runs one cycle right away instead of waiting for the first slot
+            logger.info("Scheduler: Enabled, running a first cycle now...")
+            start_scheduled_cycle(True, True)
         return {"status": "Scheduler Enabled"}
     else:
-        # Loop will exit on next check
+        # Loops in every worker exit on their next check
         return {"status": "Scheduler Disabled"}
 
+# A worker started while the scheduler is on joins in (and takes over if the lease holder dies)
+if run_state.get_flag("scheduler_active"):
+    start_scheduler_thread()
+
 @app.get("/api/scheduler")
 def get_scheduler_status():
-    return {"active": scheduler_active}
+    now = datetime.now()
+    schedules = {}
+    for key in DEFAULT_SCHEDULES:
+        schedule = get_schedule(key)
+        next_run = schedule.next_after(now)
+        schedules[key] = {"expr": str(schedule), "next_run": next_run.isoformat() if next_run else None}
+    return {
+        "active": run_state.get_flag("scheduler_active"),
+        "schedules": schedules,
+        "pressure": throttle.pressure(),
+        "transcoding_paused": throttle.is_paused(),
+    }
+
+@app.get("/api/roots")
+def get_roots():
+    """Configured library roots with the metrics of their last cycles."""
+    metrics = all_metrics()
+    return [
+        {**root.as_dict(), "exists": os.path.exists(root.path), "metrics": metrics.get(root.name)}
+        for root in get_library_roots()
+    ]
+
+@app.get("/api/plan")
+def get_plan(root: Optional[str] = None):
+    """Dry run: everything the next cycle would do, without touching disk."""
+    library_root = get_root(root)
+    if not os.path.exists(library_root.path):
+        raise HTTPException(status_code=404, detail="Library path not found")
+
+    from planner import build_plan
+    db = SessionLocal()
+    try:
+        return build_plan(db, library_root.path, drop_path=library_root.drop_path)
+    finally:
+        db.close()
+
+RUNS_PAGE_MAX = 500
+
+@app.get("/api/runs")
+def get_runs(limit: int = 50, offset: int = 0, root: Optional[str] = None,
+             trigger: Optional[str] = None, status: Optional[str] = None):
+    """Stored cycles, newest first, with phase durations and plan summary."""
+    import run_history
+    db = SessionLocal()
+    try:
+        return run_history.list_runs(db, max(1, min(limit, RUNS_PAGE_MAX)), max(0, offset), root, trigger, status)
+    finally:
+        db.close()
+
+@app.get("/api/runs/{run_id}")
+def get_run(run_id: int, limit: int = 100, offset: int = 0, order: str = "seconds"):
+    """One cycle with a page of its books (order: seconds, transcode, bytes, processed)."""
+    import run_history
+    if order not in run_history.BOOK_ORDERS:
+        raise HTTPException(status_code=400, detail=f"order must be one of {', '.join(run_history.BOOK_ORDERS)}")
+    db = SessionLocal()
+    try:
+        run = run_history.get_run(db, run_id, max(1, min(limit, RUNS_PAGE_MAX)), max(0, offset), order)
+    finally:
+        db.close()
+    if run is None:
+        raise HTTPException(status_code=404, detail="Run not found")
+    return run
+
+@app.get("/api/duplicates")
+def get_duplicates():
+    """Last duplicate report (content-hash based)."""
+    from dedupe import load_report
+    report = load_report()
+    if report is None:
+        raise HTTPException(status_code=404, detail="No duplicate scan yet")
+    return report
+
+@app.post("/api/duplicates/scan")
+def scan_duplicates(quarantine: bool = False, root: Optional[str] = None):
+    """Hashes the library in the background; runs instead of a cycle, never next to one."""
+    if run_state.is_running():
+        return {"status": "Already running"}
+
+    internal_path = get_root(root).path
+    if not os.path.exists(internal_path):
+        raise HTTPException(status_code=404, detail="Library path not found")
+
+    lease = run_state.acquire_scan("duplicate scan")
+    if lease is None:
+        return {"status": "Already running"}
+    stop_event.clear()
+
+    def worker():
+        from dedupe import run_duplicate_scan
+        try:
+            run_duplicate_scan(internal_path, quarantine=quarantine)
+        except Exception as e:
+            logger.error(f"Duplicate scan failed: {e}")
+        finally:
+            lease.release()
+
+    threading.Thread(target=worker, daemon=True).start()
+    return {"status": "Duplicate scan started"}
+
+@app.get("/api/integrity")
+def get_integrity():
+    """Last integrity report (decode check of tracks, CRC failures of zips)."""
+    from integrity import load_report
+    report = load_report()
+    if report is None:
+        raise HTTPException(status_code=404, detail="No integrity scan yet")
+    return report
+
+@app.post("/api/integrity/scan")
+def scan_integrity(root: Optional[str] = None):
+    """Decode-checks new or changed tracks in the background; runs instead of a cycle."""
+    if run_state.is_running():
+        return {"status": "Already running"}
+
+    internal_path = get_root(root).path
+    if not os.path.exists(internal_path):
+        raise HTTPException(status_code=404, detail="Library path not found")
+
+    lease = run_state.acquire_scan("integrity scan")
+    if lease is None:
+        return {"status": "Already running"}
+    stop_event.clear()
+
+    def worker():
+        from integrity import run_integrity_scan
+        try:
+            run_integrity_scan(internal_path)
+        except Exception as e:
+            logger.error(f"Integrity scan failed: {e}")
+        finally:
+            lease.release()
+
+    threading.Thread(target=worker, daemon=True).start()
+    return {"status": "Integrity scan started"}
+
+# Transcode queue: remote workers pull jobs (transcode_worker.py)
+CLAIM_POLL_SECONDS = 0.25
+
+class ClaimRequest(BaseModel):
+    worker_id: str
+    kinds: Optional[List[str]] = None
+    wait: float = 0.0
+
+class WorkerRequest(BaseModel):
+    worker_id: str
+
+class ResultRequest(BaseModel):
+    worker_id: str
+    ok: bool
+    error: Optional[str] = None
+
+@app.post("/api/transcode/claim")
+async def claim_transcode_job(req: ClaimRequest):
+    from transcode_queue import queue
+    # Long-poll on the event loop: an idle worker must not hold a threadpool thread.
+    # Capped so a request never outlives a lease.
+    deadline = time.time() + min(max(req.wait, 0.0), 25.0)
+    while True:
+        job = queue.claim(req.worker_id, req.kinds)
+        if job is not None:
+            return job.as_dict()
+        if time.time() >= deadline:
+            return Response(status_code=204)
+        await asyncio.sleep(CLAIM_POLL_SECONDS)
+
+@app.post("/api/transcode/{job_id}/heartbeat")
+def heartbeat_transcode_job(job_id: int, req: WorkerRequest):
+    from transcode_queue import queue
+    if not queue.heartbeat(job_id, req.worker_id):
+        raise HTTPException(status_code=409, detail="Lease lost")
+    return {"status": "ok"}
+
+@app.post("/api/transcode/{job_id}/result")
+def report_transcode_result(job_id: int, req: ResultRequest):
+    from transcode_queue import queue
+    if not queue.complete(job_id, req.worker_id, req.ok, req.error):
+        raise HTTPException(status_code=409, detail="Lease lost")
+    return {"status": "ok"}
+
+@app.get("/api/transcode/status")
+def transcode_status():
+    from transcode_queue import queue
+    return queue.stats()
 
 @app.post("/api/stop")
 def stop_renamer():
     stop_event.set()
+    run_state.request_stop()
     logger.info("Stopping request received...")
     return {"status": "Stopping..."}
 
@@ -382,28 +655,62 @@ async def websocket_endpoint(websocket: WebSocket):
 # -----------------
 # 3. INVENTORY & STATIC FILE SERVING
 # -----------------
-from fastapi.responses import HTMLResponse, FileResponse
+from fastapi.responses import HTMLResponse
+from http_cache import conditional_file_response
+from thumbnails import thumbnail_cache
+from previews import preview_cache, PREVIEW_MINUTES
 import re
 
-@app.get("/files/{file_path:path}")
-def get_library_file(file_path: str):
-    lib_root = resolve_library_path()
-    if not lib_root or not os.path.exists(lib_root):
+def resolve_library_target(file_path, want_dir=False):
+    """Absolute path of file_path (a file, or a folder with want_dir) in the library roots or drop folders."""
+    # Library roots first, then drop folders (covers of unprocessed EAN folders)
+    roots = get_library_roots()
+    lib_roots = []
+    for path in [r.path for r in roots] + [r.drop_path for r in roots]:
+        if path and path not in lib_roots and os.path.exists(path):
+            lib_roots.append(path)
+    if not lib_roots:
         raise HTTPException(status_code=404, detail="Library path not found")
 
-    abs_root = os.path.abspath(lib_root)
-    abs_target = os.path.abspath(os.path.join(abs_root, file_path))
+    # Relative paths are the same in every root; the first root holding the file wins
+    for lib_root in lib_roots:
+        abs_root = os.path.abspath(lib_root)
+        candidate = os.path.abspath(os.path.join(abs_root, file_path))
 
-    try:
-        if os.path.commonpath([abs_root, abs_target]) != abs_root:
+        try:
+            if os.path.commonpath([abs_root, candidate]) != abs_root:
+                raise HTTPException(status_code=403, detail="Invalid file path")
+        except ValueError:
             raise HTTPException(status_code=403, detail="Invalid file path")
-    except ValueError:
-        raise HTTPException(status_code=403, detail="Invalid file path")
 
-    if not os.path.isfile(abs_target):
-        raise HTTPException(status_code=404, detail="File not found")
+        if os.path.isfile(candidate) or (want_dir and os.path.isdir(candidate)):
+            return candidate
 
-    return FileResponse(abs_target)
+    raise HTTPException(status_code=404, detail="File not found")
+
+@app.get("/files/{file_path:path}")
+def get_library_file(file_path: str, request: Request, thumb: Optional[int] = None):
+    # Range requests (seeking in MP3s) are answered by FileResponse
+    abs_target = resolve_library_target(file_path)
+
+    # ?thumb=<width>: size-bucketed cover thumbnail from the on-disk cache
+    if thumb and abs_target.lower().endswith((".jpg", ".jpeg", ".png")):
+        thumb_path = thumbnail_cache.get(abs_target, thumb)
+        if thumb_path:
+            return conditional_file_response(request, thumb_path, media_type="image/jpeg")
+
+    return conditional_file_response(request, abs_target)
+
+@app.get("/api/preview/{file_path:path}")
+def get_audio_preview(file_path: str, request: Request, minutes: int = PREVIEW_MINUTES):
+    """32 kbps preview of the first minutes of a track or book folder (Range-capable)."""
+    abs_target = resolve_library_target(file_path, want_dir=True)
+    if os.path.isfile(abs_target) and not abs_target.lower().endswith(".mp3"):
+        raise HTTPException(status_code=400, detail="Previews are only available for MP3 tracks and book folders")
+    preview_path = preview_cache.get(abs_target, minutes)
+    if not preview_path:
+        raise HTTPException(status_code=404, detail="No audio to preview")
+    return conditional_file_response(request, preview_path, media_type="audio/mpeg")
 
 # -----------------
 # 4. AUDIOBOOKSHELF CUSTOM PROVIDER API
@@ -411,197 +718,226 @@ def get_library_file(file_path: str):
 
 @app.get("/api/abs/status")
 def abs_status():
-    return {"status": "ok", "service": "Audiobook Renamer Metadata Provider", "count": SessionLocal().query(Book).count()}
+    snapshot = get_snapshot()
+    return {"status": "ok", "service": "Audiobook Renamer Metadata Provider", "count": len(snapshot),
+            "catalog": snapshot.stats(), "fuzzy": fuzzy.index.stats()}
 
-@app.get("/api/abs/search")
-def abs_search(q: str = None, title: str = None, author: str = None, isbn: str = None, mediaType: str = None, request: Request = None):
-    # Log the incoming request
+KW_UNABRIDGED = ["ungekürzt", "ungekuerzt", "unabridged"]
+KW_ABRIDGED = ["gekürzt", "gekuerzt", "abridged"]
+
+def normalize_isbn(isbn):
+    return isbn.replace("-", "").strip()
+
+def find_abs_matches(snapshot, q=None, title=None, author=None, isbn=None, log=logger.info):
+    """Catalog records for one ABS query (EAN exact match or token search)."""
     clean_q = q or ""
-    logger.info(f"ABS Search Request -> q='{clean_q}', title='{title}', author='{author}', isbn='{isbn}'")
-    
-    db = SessionLocal()
-    try:
-        # 1. Determine Search Strategy
-        # If query is 13 digits, prioritize EAN search
-        is_ean = False
-        if isbn:
-            q_str = isbn.replace("-", "").strip()
-            is_ean = True
-        elif clean_q and re.match(r'^\d{13}$', clean_q.strip()):
-            q_str = clean_q.strip()
-            is_ean = True
+
+    # 1. Determine Search Strategy
+    # If query is 13 digits, prioritize EAN search
+    is_ean = False
+    if isbn:
+        q_str = normalize_isbn(isbn)
+        is_ean = True
+    elif clean_q and re.match(r'^\d{13}$', clean_q.strip()):
+        q_str = clean_q.strip()
+        is_ean = True
+    else:
+        q_str = clean_q.strip()
+
+    # 2. Build Filters
+    if is_ean:
+        log(f"Strategy: EAN Exact Match ({q_str})")
+        hit = snapshot.get(q_str)
+        return [hit] if hit and not hit.takedown else []
+
+    # Token-based Search with "Abridged/Unabridged" Logic
+    # This comes from the old "audiobook shelf" project main.py
+
+    # Use title if q is empty (ABS sometimes sends only title)
+    search_text = q_str if q_str else (title or "")
+
+    clean_text = re.sub(r'[^\w\s]', ' ', search_text)
+    raw_tokens = clean_text.split()
+
+    title_tokens = []
+    status_filters = []
+
+    found_unabridged = False
+    found_abridged = False
+
+    for token in raw_tokens:
+        t_lower = token.lower()
+        if t_lower in KW_UNABRIDGED:
+            found_unabridged = True
+            continue # Do NOT search for this in Title
+        if t_lower in KW_ABRIDGED:
+            found_abridged = True
+            continue # Do NOT search for this in Title
+        title_tokens.append(token)
+
+    # Apply Status Filters (any keyword matches)
+    if found_unabridged:
+        log("Detected 'Unabridged' keyword. Filtering...")
+        status_filters = KW_UNABRIDGED
+    elif found_abridged:
+        log("Detected 'Abridged' keyword. Filtering...")
+        status_filters = KW_ABRIDGED
+
+    title_filters = [token for token in title_tokens if len(token) > 1]
+
+    matches = []
+
+    # ATTEMPT 1: Search with Author (if provided)
+    if author:
+        clean_a = re.sub(r'[^\w\s]', ' ', author)
+        author_filters = [token for token in clean_a.split() if len(token) > 1]
+
+        if author_filters:
+            matches = snapshot.search(title_filters, author_filters, status_filters)
+
+    # ATTEMPT 2 (Fallback): If no matches, search ONLY by Title tokens
+    if not matches and title_filters:
+        matches = snapshot.search(title_filters, (), status_filters)
+
+    # ATTEMPT 3 (Fallback): Typo-tolerant trigram similarity
+    if not matches and title_tokens:
+        matches = fuzzy.index.search(snapshot, " ".join(title_tokens), author, status_filters)
+        if matches:
+            log(f"Trigram fallback: {len(matches)} similar titles.")
+    return matches
+
+def format_narrators(narrator_val):
+    """Flips "Last, First; Last2, First2" -> "First Last, First2 Last2"."""
+    if not narrator_val:
+        return narrator_val
+    processed_narrators = []
+    for n in narrator_val.split(';'):
+        n = n.strip()
+        if "," in n:
+            parts = n.split(",", 1)
+            processed_narrators.append(f"{parts[1].strip()} {parts[0].strip()}")
         else:
-            q_str = clean_q.strip()
-            
-        search_filter = []
-        
-        # 2. Build Filters
-        if is_ean:
-             logger.info(f"Strategy: EAN Exact Match ({q_str})")
-             matches = db.query(Book).filter(Book.takedown == False, Book.ean == q_str).all()
+            processed_narrators.append(n)
+    return ", ".join(processed_narrators)
+
+def format_abs_matches(matches, base_url, roots=None, disk_cache=None):
+    """
+    ABS metadata dicts, books on disk first. disk_cache ({ean: (exists, cover)})
+    lets a batch check every book on disk only once.
+    """
+    response_data = []
+    for b in matches:
+        # Check existence (for sorting and covers)
+        if disk_cache is not None and b.ean in disk_cache:
+            exists, web_cover_path = disk_cache[b.ean]
         else:
-             # Token-based Search with "Abridged/Unabridged" Logic
-             # This comes from the old "audiobook shelf" project main.py
-             
-             # Use title if q is empty (ABS sometimes sends only title)
-             search_text = q_str if q_str else (title or "")
-             
-             clean_text = re.sub(r'[^\w\s]', ' ', search_text)
-             raw_tokens = clean_text.split()
-             
-             title_tokens = []
-             status_filters = []
-             
-             # Keywords to identify Status
-             kw_unabridged = ["ungekürzt", "ungekuerzt", "unabridged"]
-             kw_abridged = ["gekürzt", "gekuerzt", "abridged"]
-             
-             found_unabridged = False
-             found_abridged = False
-             
-             for token in raw_tokens:
-                t_lower = token.lower()
-                if t_lower in kw_unabridged:
-                    found_unabridged = True
-                    continue # Do NOT search for this in Title
-                if t_lower in kw_abridged:
-                    found_abridged = True
-                    continue # Do NOT search for this in Title
-                title_tokens.append(token)
-             
-             # Apply Status Filters
-             if found_unabridged:
-                 logger.info("Detected 'Unabridged' keyword. Filtering...")
-                 status_filters.append(
-                    or_(
-                        func.lower(Book.abridged_status).contains("ungekuerzt"),
-                        func.lower(Book.abridged_status).contains("ungekürzt"),
-                        func.lower(Book.abridged_status).contains("unabridged")
-                    )
-                )
-             elif found_abridged:
-                 logger.info("Detected 'Abridged' keyword. Filtering...")
-                 status_filters.append(
-                    or_(
-                        func.lower(Book.abridged_status).contains("gekuerzt"),
-                        func.lower(Book.abridged_status).contains("gekürzt"),
-                        func.lower(Book.abridged_status).contains("abridged")
-                    )
-                )
-
-             title_filters = []
-             for token in title_tokens:
-                if len(token) > 1: 
-                    title_filters.append(func.lower(Book.title).contains(token.lower()))
-            
-             matches = []
-             
-             # ATTEMPT 1: Search with Author (if provided)
-             if author:
-                 clean_a = re.sub(r'[^\w\s]', ' ', author)
-                 author_tokens = clean_a.split()
-                 author_filters = []
-                 for token in author_tokens:
-                     if len(token) > 1:
-                        author_filters.append(func.lower(Book.author).contains(token.lower()))
-                 
-                 if author_filters:
-                     matches = db.query(Book).filter(
-                         Book.takedown == False, 
-                         *title_filters, 
-                         *author_filters,
-                         *status_filters
-                     ).all()
-            
-             # ATTEMPT 2 (Fallback): If no matches, search ONLY by Title tokens
-             if not matches and title_filters:
-                matches = db.query(Book).filter(
-                    Book.takedown == False, 
-                    *title_filters,
-                    *status_filters
-                ).all()
+            exists, web_cover_path = check_book_on_disk(b, roots)
+            if disk_cache is not None:
+                disk_cache[b.ean] = (exists, web_cover_path)
+
+        # Cover URL calculation
+        cover_url = None
+        if web_cover_path:
+            # web_cover_path comes from check_book_on_disk as /files/path...
+            # We need to prepend base_url to be polite, or ABS might handle relative.
+            # Ideally ABS can handle key 'cover' as URL.
+            cover_url = f"{base_url}{web_cover_path}"
+
+        # Extract year
+        year_str = None
+        if b.release_date:
+            m = re.search(r'\d{4}', str(b.release_date))
+            if m: year_str = m.group(0)
+
+        meta = {
+            "title": b.title,
+            "subtitle": b.abridged_status, # Important for UI!
+            "author": b.author,
+            "isbn": b.ean,
+            "description": b.description,
+            "publishedYear": year_str,
+            "publishedDate": b.release_date,
+            "publisher": "Der Audio Verlag",
+            "narrator": format_narrators(b.narrator),
+            "cover": cover_url,
+            "tags": [],
+            "_exists": exists
+        }
+
+        if b.abridged_status:
+            meta["tags"].append(b.abridged_status)
+
+        response_data.append(meta)
+
+    # SORT: Exists first!
+    response_data.sort(key=lambda x: x["_exists"], reverse=True)
+
+    # Cleanup internal key
+    for m in response_data:
+        del m["_exists"]
+    return response_data
+
+@app.get("/api/abs/search")
+def abs_search(q: str = None, title: str = None, author: str = None, isbn: str = None, mediaType: str = None, request: Request = None):
+    # Log the incoming request
+    logger.info(f"ABS Search Request -> q='{q or ''}', title='{title}', author='{author}', isbn='{isbn}'")
 
+    try:
+        matches = find_abs_matches(get_snapshot(), q, title, author, isbn)
         logger.info(f"ABS Search Found {len(matches)} matches.")
 
-        # 3. Format Response
-        response_data = []
         base_url = str(request.base_url).rstrip('/') if request else ""
-        
-        for b in matches:
-            # Check existence (for sorting and covers)
-            exists, web_cover_path = check_book_on_disk(b)
-            
-            # Format Narrator (Flip "Last, First" -> "First Last")
-            narrator_val = b.narrator
-            if narrator_val:
-                raw_narrators = narrator_val.split(';')
-                processed_narrators = []
-                for n in raw_narrators:
-                    n = n.strip()
-                    if "," in n:
-                        parts = n.split(",", 1)
-                        if len(parts) == 2:
-                            processed_narrators.append(f"{parts[1].strip()} {parts[0].strip()}")
-                        else:
-                            processed_narrators.append(n)
-                    else:
-                         processed_narrators.append(n)
-                narrator_val = ", ".join(processed_narrators)
-            
-            # Cover URL calculation
-            cover_url = None
-            if web_cover_path:
-                # web_cover_path comes from check_book_on_disk as /files/path...
-                # We need to prepend base_url to be polite, or ABS might handle relative.
-                # Ideally ABS can handle key 'cover' as URL.
-                cover_url = f"{base_url}{web_cover_path}"
-
-            try:
-                # Extract year
-                year_str = None
-                if b.release_date:
-                    m = re.search(r'\d{4}', str(b.release_date))
-                    if m: year_str = m.group(0)
-            except:
-                year_str = None
-
-            meta = {
-                "title": b.title,
-                "subtitle": b.abridged_status, # Important for UI!
-                "author": b.author,
-                "isbn": b.ean,
-                "description": b.description,
-                "publishedYear": year_str,
-                "publishedDate": b.release_date,
-                "publisher": "Der Audio Verlag",
-                "narrator": narrator_val,
-                "cover": cover_url,
-                "tags": [],
-                "_exists": exists
-            }
-            
-            if b.abridged_status:
-                meta["tags"].append(b.abridged_status)
-                
-            response_data.append(meta)
-            
-        # SORT: Exists first!
-        response_data.sort(key=lambda x: x["_exists"], reverse=True)
-        
-        # Cleanup internal key
-        for m in response_data:
-            del m["_exists"]
+        # The old code returned {"matches": [...]}.
+        return {"matches": format_abs_matches(matches, base_url)}
 
-        # 4. Return correct wrapper
-        # The old code returned {"matches": [...]}. 
-        return {"matches": response_data}
-        
     except Exception as e:
         logger.error(f"ABS Search Error: {e}")
         return {"matches": []}
-    finally:
-        db.close()
-        
+
+class AbsQuery(BaseModel):
+    q: Optional[str] = None
+    title: Optional[str] = None
+    author: Optional[str] = None
+    isbn: Optional[str] = None
+
+class AbsBatchRequest(BaseModel):
+    queries: List[AbsQuery]
+
+@app.post("/api/abs/search/batch")
+def abs_search_batch(req: AbsBatchRequest, request: Request = None):
+    """
+    Many ABS lookups in one request; results come back in input order.
+    One snapshot, one library-roots lookup and one on-disk check per book
+    serve the whole batch.
+    """
+    started = time.perf_counter()
+    snapshot = get_snapshot()
+    roots = get_library_roots()
+    base_url = str(request.base_url).rstrip('/') if request else ""
+    disk_cache = {}
+
+    # All ISBNs in one pass over the EAN index
+    isbns = {normalize_isbn(query.isbn) for query in req.queries if query.isbn}
+    by_isbn = {isbn: snapshot.get(isbn) for isbn in isbns}
+
+    results = []
+    found = 0
+    for query in req.queries:
+        try:
+            if query.isbn:
+                hit = by_isbn.get(normalize_isbn(query.isbn))
+                matches = [hit] if hit and not hit.takedown else []
+            else:
+                matches = find_abs_matches(snapshot, query.q, query.title, query.author, log=logger.debug)
+            results.append({"matches": format_abs_matches(matches, base_url, roots, disk_cache)})
+            found += bool(matches)
+        except Exception as e:
+            logger.error(f"ABS Batch Search Error ({query.dict()}): {e}")
+            results.append({"matches": []})
+
+    logger.info(f"ABS Batch Search: {len(req.queries)} queries, {found} with matches "
+                f"({time.perf_counter() - started:.3f}s).")
+    return {"results": results}
 
 
 
@@ -609,13 +945,11 @@ def get_internal_library_path():
     """Resolves the user configured path to the internal container path"""
     return resolve_library_path()
 
-def check_book_on_disk(book):
+def check_book_on_disk(book, roots=None):
     """
     Returns (exists: bool, web_cover_path: str|None)
     web_cover_path is a URL path component starting with /files/...
     """
-    lib_path = get_internal_library_path()
-    
     # 1. Sanitize (Need to duplicate sanitize function here or import)
     def clean(n): return re.sub(r'[<>:"/\\|?*]', '', str(n)).strip() if n else "Unknown"
     
@@ -642,21 +976,27 @@ def check_book_on_disk(book):
             final_title = f"{safe_title} ({safe_abridged})"
     
     found_dir = None
-    
-    # Check Author/Title WITH status suffix (new naming scheme)
-    target_dir = os.path.join(lib_path, safe_author, final_title)
-    if os.path.exists(target_dir):
-        found_dir = target_dir
-    # Fallback: Check Author/Title WITHOUT status (old naming scheme without differentiation)
-    elif book.abridged_status:
-        fallback_dir = os.path.join(lib_path, safe_author, safe_title)
-        if os.path.exists(fallback_dir):
-            found_dir = fallback_dir
-    # Check EAN folder (not yet processed)
-    if not found_dir:
-        ean_dir = os.path.join(lib_path, book.ean)
-        if os.path.exists(ean_dir):
-            found_dir = ean_dir
+    lib_root = None
+
+    for root in roots if roots is not None else get_library_roots():
+        lib_path = root.path
+        # Check Author/Title WITH status suffix (new naming scheme)
+        target_dir = os.path.join(lib_path, safe_author, final_title)
+        if os.path.exists(target_dir):
+            found_dir = target_dir
+        # Fallback: Check Author/Title WITHOUT status (old naming scheme without differentiation)
+        elif book.abridged_status:
+            fallback_dir = os.path.join(lib_path, safe_author, safe_title)
+            if os.path.exists(fallback_dir):
+                found_dir = fallback_dir
+        # Check EAN folder (not yet processed)
+        if not found_dir:
+            ean_dir = os.path.join(root.drop_path, book.ean)
+            if os.path.exists(ean_dir):
+                found_dir = ean_dir
+        if found_dir:
+            lib_root = root.drop_path if found_dir == os.path.join(root.drop_path, book.ean) else lib_path
+            break
             
     if found_dir:
         # Look for cover
@@ -679,7 +1019,6 @@ def check_book_on_disk(book):
             # Then prepend /files
             
             full_path = os.path.join(found_dir, cover_file)
-            lib_root = get_internal_library_path()
             
             if full_path.startswith(lib_root):
                 rel_path = full_path.replace(lib_root, "", 1)
@@ -757,7 +1096,7 @@ async def inventory_ui():
                             // For simplicity, just encode spaces? No, full encodeURI might break slashes.
                             // The backend returns a ready-to-use path like /files/DATA/...
                             // Browsers handle most chars automatically in src
-                            imgHtml = `<img src="${book.relative_cover_path}" class="cover" loading="lazy">`;
+                            imgHtml = `<img src="${book.relative_cover_path}?thumb=120" class="cover" loading="lazy">`;
                         }
 
                         tr.innerHTML = `
@@ -786,51 +1125,37 @@ async def inventory_ui():
 
 @app.get("/api/inventory")
 def get_inventory_api():
-    db = SessionLocal()
-    try:
-        # Filter: Exclude Takedowns
-        books = db.query(Book).filter(Book.takedown == False).all()
-        results = []
-        
-        for book in books:
-            exists, cover_path = check_book_on_disk(book)
-            results.append({
-                "ean": book.ean,
-                "author": book.author,
-                "title": book.title,
-                "release_date": book.release_date,
-                "exists": exists,
-                "has_cover": cover_path is not None,
-                "relative_cover_path": cover_path
-            })
-        
-        # Sort by Author
-        results.sort(key=lambda x: (x['author'] or "").lower())
-        return results
-    finally:
-        db.close()
+    # Snapshot is already filtered (no takedowns) and sorted by author
+    results = []
+    for book in get_snapshot().active():
+        exists, cover_path = check_book_on_disk(book)
+        results.append({
+            "ean": book.ean,
+            "author": book.author,
+            "title": book.title,
+            "release_date": book.release_date,
+            "exists": exists,
+            "has_cover": cover_path is not None,
+            "relative_cover_path": cover_path
+        })
+    return results
 
 @app.get("/api/export_inventory")
 def export_inventory():
     # Pandas removed. JSON export instead.
-    db = SessionLocal()
-    try:
-        books = db.query(Book).filter(Book.takedown == False).all()
-        data = []
-        for book in books:
-            exists, _ = check_book_on_disk(book)
-            data.append({
-                "EAN": book.ean,
-                "Author": book.author,
-                "Title": book.title,
-                "Release Date": book.release_date,
-                "Status": "In Library" if exists else "Missing"
-            })
-        
-        # Return JSON direct for now
-        return data
-    finally:
-        db.close()
+    data = []
+    for book in get_snapshot().active():
+        exists, _ = check_book_on_disk(book)
+        data.append({
+            "EAN": book.ean,
+            "Author": book.author,
+            "Title": book.title,
+            "Release Date": book.release_date,
+            "Status": "In Library" if exists else "Missing"
+        })
+    
+    # Return JSON direct for now
+    return data
 
 if __name__ == "__main__":
     import uvicorn
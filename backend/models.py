@@ -1,4 +1,4 @@
-from sqlalchemy import Column, String, Boolean
+from sqlalchemy import Column, String, Boolean, Integer, Float, Text
 from database import Base
 
 class Book(Base):
@@ -12,3 +12,166 @@ class Book(Base):
     abridged_status = Column(String, nullable=True)
     narrator = Column(String, nullable=True)
     description = Column(String, nullable=True)
+
+
+class Job(Base):
+    """One in-flight book of a scan cycle. Rows are deleted once the book is done."""
+    __tablename__ = "jobs"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    ean = Column(String, index=True)
+    kind = Column(String)  # "zip" or "folder"
+    source = Column(String, index=True)
+    stage = Column(String, default="pending")
+    temp_dir = Column(String, nullable=True)
+    final_path = Column(String, nullable=True)
+    book = Column(Text, nullable=True)  # JSON of the BookRecord the job was planned with
+    done_files = Column(Text, default="[]")  # JSON list of optimized paths, relative to final_path
+    error = Column(String, nullable=True)
+    created_at = Column(Float)
+    updated_at = Column(Float)
+
+
+class FileHash(Base):
+    """Content hash cache for the duplicate finder, keyed by device + inode."""
+    __tablename__ = "file_hashes"
+
+    dev = Column(Integer, primary_key=True)
+    inode = Column(Integer, primary_key=True)
+    size = Column(Integer)
+    mtime_ns = Column(Integer)
+    digest = Column(String)
+    path = Column(String)  # last path seen, informational only
+
+
+class Placement(Base):
+    """Where a catalog book was last placed; used to rewrite its metadata.json after syncs."""
+    __tablename__ = "placements"
+
+    ean = Column(String, primary_key=True)
+    path = Column(String)
+    updated_at = Column(Float)
+
+
+class IngestBatch(Base):
+    """A completed push-ingest batch; a repeated batch id returns this result instead of re-applying."""
+    __tablename__ = "ingest_batches"
+
+    batch_id = Column(String, primary_key=True)
+    rows = Column(Integer)
+    inserted = Column(Integer)
+    updated = Column(Integer)
+    deleted = Column(Integer)
+    skipped = Column(Integer)
+    finished_at = Column(Float)
+
+
+class FileVerdict(Base):
+    """Integrity verdict (decode check for tracks, CRC check for zips), keyed by device + inode."""
+    __tablename__ = "file_verdicts"
+
+    dev = Column(Integer, primary_key=True)
+    inode = Column(Integer, primary_key=True)
+    size = Column(Integer)
+    mtime_ns = Column(Integer)
+    ok = Column(Boolean)
+    error = Column(Text, nullable=True)
+    path = Column(String)  # last path seen
+    checked_at = Column(Float)
+
+
+class CoverScan(Base):
+    """Embedded-cover lookup result for a book's first track, keyed by device + inode."""
+    __tablename__ = "cover_scans"
+
+    dev = Column(Integer, primary_key=True)
+    inode = Column(Integer, primary_key=True)
+    size = Column(Integer)
+    mtime_ns = Column(Integer)
+    found = Column(Boolean)
+    path = Column(String)  # last path seen
+    checked_at = Column(Float)
+
+
+class Run(Base):
+    """One run_once cycle of one library root."""
+    __tablename__ = "runs"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    trigger = Column(String)  # "manual" or "scheduler"
+    root = Column(String, nullable=True)
+    library_path = Column(String)
+    started_at = Column(Float, index=True)
+    finished_at = Column(Float, nullable=True)
+    seconds = Column(Float, nullable=True)
+    status = Column(String)  # "ok", "stopped" or "error"
+    error = Column(Text, nullable=True)
+    phases = Column(Text, default="{}")  # JSON {phase: seconds}
+    summary = Column(Text, nullable=True)  # JSON plan summary
+    moves = Column(Text, nullable=True)  # JSON MoveStats
+    books = Column(Integer, default=0)
+
+
+class RunBook(Base):
+    """One book a cycle extracted, placed, resumed or quarantined."""
+    __tablename__ = "run_books"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    run_id = Column(Integer, index=True)
+    ean = Column(String, index=True)
+    action = Column(String)
+    bytes_in = Column(Integer, nullable=True)
+    bytes_out = Column(Integer, nullable=True)
+    seconds = Column(Float)
+    transcode_seconds = Column(Float, nullable=True)
+    error = Column(Text, nullable=True)
+
+
+class RunLease(Base):
+    """Single-flight lease shared by all API worker processes (see run_state)."""
+    __tablename__ = "run_leases"
+
+    name = Column(String, primary_key=True)  # "scan" or "scheduler"
+    owner = Column(String)  # token of the holding lease
+    kind = Column(String)  # what the holder runs, e.g. "cycle"
+    pid = Column(Integer)
+    acquired_at = Column(Float)
+    expires_at = Column(Float)
+    stop_requested = Column(Boolean, default=False)
+
+
+class SharedFlag(Base):
+    __tablename__ = "shared_flags"
+
+    name = Column(String, primary_key=True)
+    value = Column(Boolean)
+    updated_at = Column(Float)
+
+
+class BusEvent(Base):
+    """Log entries and notifications replayed to the other worker processes."""
+    __tablename__ = "bus_events"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    pid = Column(Integer)
+    kind = Column(String)  # "log" or "catalog_changed"
+    payload = Column(Text, nullable=True)  # JSON
+    created_at = Column(Float)
+
+
+class RootMetric(Base):
+    """Cycle counters of one library root, shared by all API workers (see roots)."""
+    __tablename__ = "root_metrics"
+
+    name = Column(String, primary_key=True)
+    path = Column(String)
+    drop_path = Column(String)
+    workers = Column(Integer)
+    running = Column(Boolean, default=False)
+    cycles = Column(Integer, default=0)
+    last_started = Column(Float, nullable=True)
+    last_seconds = Column(Float, nullable=True)
+    last_error = Column(Text, nullable=True)
+    last_summary = Column(Text, nullable=True)  # JSON plan summary
+    last_moves = Column(Text, nullable=True)  # JSON MoveStats
+    total_seconds = Column(Float, default=0.0)
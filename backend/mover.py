@@ -0,0 +1,257 @@
+"""
+Device-aware move engine.
+
+Same-device moves are a single os.rename of the whole tree. Cross-device
+moves copy files in parallel with kernel-side copy_file_range/sendfile,
+verify the copied size and only then delete the source. Merges drop
+incoming files whose bytes already exist at the target instead of copying
+them again.
+"""
+import errno
+import hashlib
+import os
+import shutil
+import threading
+import time
+import concurrent.futures
+import contextlib
+
+COPY_WORKERS = int(os.getenv("MOVE_COPY_WORKERS", "4"))
+COPY_CHUNK = 64 * 1024 * 1024
+HASH_CHUNK = 1024 * 1024
+
+# Errors that mean "this copy method does not work for these files"
+_FALLBACK_ERRNOS = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF}
+
+
+class MoveStats:
+    __slots__ = ("renames", "files_copied", "bytes_copied", "files_skipped", "bytes_skipped", "seconds")
+
+    def __init__(self):
+        self.renames = 0
+        self.files_copied = 0
+        self.bytes_copied = 0
+        self.files_skipped = 0  # identical files dropped during merges
+        self.bytes_skipped = 0
+        self.seconds = 0.0
+
+    def add(self, other):
+        self.renames += other.renames
+        self.files_copied += other.files_copied
+        self.bytes_copied += other.bytes_copied
+        self.files_skipped += other.files_skipped
+        self.bytes_skipped += other.bytes_skipped
+        self.seconds += other.seconds
+
+    def as_dict(self):
+        return {
+            "renames": self.renames,
+            "files_copied": self.files_copied,
+            "bytes_copied": self.bytes_copied,
+            "files_skipped": self.files_skipped,
+            "bytes_skipped": self.bytes_skipped,
+            "seconds": round(self.seconds, 3),
+        }
+
+
+# Per-thread sink so concurrent library roots each get their own cycle totals
+_local = threading.local()
+
+
+@contextlib.contextmanager
+def collect_into(stats):
+    """Moves recorded by the current thread inside this block are also added to stats."""
+    previous = getattr(_local, "sink", None)
+    _local.sink = stats
+    try:
+        yield stats
+    finally:
+        _local.sink = previous
+
+
+def _record(stats):
+    sink = getattr(_local, "sink", None)
+    if sink is not None:
+        sink.add(stats)
+
+
+def same_device(src, dst):
+    """True if src and the directory that will hold dst are on one filesystem."""
+    try:
+        return os.stat(src).st_dev == os.stat(os.path.dirname(os.path.abspath(dst))).st_dev
+    except OSError:
+        return False
+
+
+def _kernel_copy(fd_in, fd_out, size):
+    """copy_file_range, then sendfile. Returns bytes copied, or None if neither is usable."""
+    for method in ("copy_file_range", "sendfile"):
+        if not hasattr(os, method):
+            continue
+        offset = 0
+        try:
+            while offset < size:
+                count = min(COPY_CHUNK, size - offset)
+                if method == "copy_file_range":
+                    n = os.copy_file_range(fd_in, fd_out, count, offset, offset)
+                else:
+                    os.lseek(fd_out, offset, os.SEEK_SET)
+                    n = os.sendfile(fd_out, fd_in, offset, count)
+                if n == 0:
+                    break
+                offset += n
+            return offset
+        except OSError as e:
+            if offset == 0 and e.errno in _FALLBACK_ERRNOS:
+                continue
+            raise
+    return None
+
+
+def copy_file(src, dst):
+    """Copies one file with its metadata and verifies the size. Returns bytes copied."""
+    with open(src, "rb") as fi, open(dst, "wb") as fo:
+        size = os.fstat(fi.fileno()).st_size
+        copied = _kernel_copy(fi.fileno(), fo.fileno(), size)
+        if copied is None:
+            fi.seek(0)
+            shutil.copyfileobj(fi, fo, COPY_CHUNK)
+    shutil.copystat(src, dst)
+    copied_size = os.stat(dst).st_size
+    if copied_size != size:
+        raise OSError(errno.EIO, f"Size mismatch after copy ({copied_size} != {size})", dst)
+    return size
+
+
+def move_file(src, dst):
+    """Moves one file; rename on the same device, verified copy + delete otherwise."""
+    stats = _move_file(src, dst)
+    _record(stats)
+    return stats
+
+
+def _move_file(src, dst):
+    stats = MoveStats()
+    start = time.perf_counter()
+    try:
+        os.rename(src, dst)
+        stats.renames = 1
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        stats.bytes_copied = copy_file(src, dst)
+        stats.files_copied = 1
+        os.remove(src)
+    stats.seconds = time.perf_counter() - start
+    return stats
+
+
+def file_digest(path):
+    """Streamed BLAKE2b digest of a file."""
+    digest = hashlib.blake2b(digest_size=20)
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(HASH_CHUNK)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def same_content(path_a, path_b):
+    """Size first, then a streamed hash of both files."""
+    try:
+        if os.path.getsize(path_a) != os.path.getsize(path_b):
+            return False
+        return file_digest(path_a) == file_digest(path_b)
+    except OSError:
+        return False
+
+
+def drop_identical(src, candidates):
+    """
+    Deletes src if one of the candidate files already holds the same bytes.
+    Returns MoveStats with the skipped file, or None if src must be kept.
+    """
+    for candidate in candidates:
+        if same_content(src, candidate):
+            stats = MoveStats()
+            stats.bytes_skipped = os.path.getsize(src)
+            stats.files_skipped = 1
+            os.remove(src)
+            _record(stats)
+            return stats
+    return None
+
+
+def move_files(pairs, workers=COPY_WORKERS):
+    """Moves (src, dst) file pairs; cross-device copies run in parallel. Returns MoveStats."""
+    stats = MoveStats()
+    if not pairs:
+        return stats
+    errors = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(workers, len(pairs)))) as pool:
+        futures = [pool.submit(_move_file, src, dst) for src, dst in pairs]
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                stats.add(future.result())
+            except Exception as e:
+                errors.append(e)
+    # Recorded from the calling thread so per-root sinks see it
+    _record(stats)
+    if errors:
+        raise errors[0]
+    return stats
+
+
+def move_tree(src, dst, workers=COPY_WORKERS):
+    """
+    Moves a file or directory tree to dst (which must not exist).
+    Returns MoveStats for this move.
+    """
+    if os.path.lexists(dst):
+        raise FileExistsError(errno.EEXIST, "Move target exists", dst)
+    if not os.path.isdir(src):
+        return move_file(src, dst)
+
+    stats = MoveStats()
+    start = time.perf_counter()
+    if same_device(src, dst):
+        try:
+            os.rename(src, dst)
+            stats.renames = 1
+            stats.seconds = time.perf_counter() - start
+            _record(stats)
+            return stats
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+
+    pairs = []
+    for root, dirs, files in os.walk(src):
+        target_root = os.path.join(dst, os.path.relpath(root, src))
+        os.makedirs(target_root, exist_ok=True)
+        pairs.extend((os.path.join(root, name), os.path.join(target_root, name)) for name in files)
+
+    def copy_and_remove(pair):
+        size = copy_file(*pair)
+        os.remove(pair[0])
+        return size
+
+    errors = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        futures = [pool.submit(copy_and_remove, pair) for pair in pairs]
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                stats.bytes_copied += future.result()
+                stats.files_copied += 1
+            except Exception as e:
+                errors.append(e)
+
+    stats.seconds = time.perf_counter() - start
+    _record(stats)
+    if errors:
+        # Sources of failed files are still in place; the caller may retry
+        raise errors[0]
+    shutil.rmtree(src, ignore_errors=True)
+    return stats
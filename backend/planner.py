@@ -0,0 +1,629 @@
+"""
+Cycle planner: computes everything a run_once cycle would do from one
+directory pass and one bulk (chunked) catalog lookup, without touching disk.
+execute_plan applies a plan; run_once is build_plan + execute_plan.
+"""
+import concurrent.futures
+import os
+import re
+import shutil
+import time
+import zipfile
+from sqlalchemy.orm import Session
+import embedded_covers
+import integrity
+import jobs
+import mover
+import run_history
+import sidecars
+from renamer_core import (
+    logger,
+    stop_event,
+    BookRecord,
+    lookup_books,
+    book_target_path,
+    move_book_into_place,
+    convert_folder_to_96k,
+    write_metadata_file,
+    merge_folder_contents,
+    flatten_single_subfolder,
+    cleanup_metadata_files,
+)
+
+TRASH_DIR_NAME = "_DUPLICATES_TO_DELETE"
+EAN_PATTERN = re.compile(r"^\d{13}$")
+SUFFIX_PATTERN = re.compile(r"^(.+)_\d{8,}$")
+AUDIO_EXTENSIONS = (".mp3",)
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+COVER_EXTENSIONS = (".jpg", ".jpeg")
+SCAN_WORKERS = int(os.getenv("SCAN_WORKERS", "8"))
+
+def _scan_subtree(start, tree):
+    stack = [start]
+    while stack:
+        current = stack.pop()
+        dirs, files = [], []
+        try:
+            with os.scandir(current) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            if entry.name == TRASH_DIR_NAME:
+                                continue
+                            dirs.append(entry.name)
+                            stack.append(entry.path)
+                        else:
+                            files.append(entry)
+                    except OSError:
+                        continue
+        except OSError as e:
+            logger.warning(f"Planner: cannot read {current}: {e}")
+        tree[current] = {"dirs": sorted(dirs), "files": files}
+    return tree
+
+
+def scan_library(library_path, workers=SCAN_WORKERS):
+    """
+    Single scandir pass over the library (quarantine excluded); the top-level
+    (author) directories are walked in parallel. Every phase of a cycle
+    consumes this one snapshot instead of walking again.
+    Returns {dir_path: {"dirs": [names], "files": [DirEntry]}}.
+    """
+    tree = {}
+    try:
+        with os.scandir(library_path) as it:
+            entries = list(it)
+    except OSError as e:
+        logger.warning(f"Planner: cannot read {library_path}: {e}")
+        entries = []
+    dirs, files = [], []
+    for entry in entries:
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                if entry.name != TRASH_DIR_NAME:
+                    dirs.append(entry.name)
+            else:
+                files.append(entry)
+        except OSError:
+            continue
+    tree[library_path] = {"dirs": sorted(dirs), "files": files}
+
+    subtrees = [os.path.join(library_path, name) for name in dirs]
+    if workers > 1 and len(subtrees) > 1:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            for part in pool.map(lambda path: _scan_subtree(path, {}), subtrees):
+                tree.update(part)
+    else:
+        for path in subtrees:
+            _scan_subtree(path, tree)
+    return tree
+
+
+def subtree_files(tree, path):
+    """Relative paths of all files below `path`, from the scan."""
+    found = []
+    stack = [path]
+    while stack:
+        current = stack.pop()
+        node = tree.get(current)
+        if not node:
+            continue
+        found.extend(os.path.relpath(entry.path, path) for entry in node["files"])
+        stack.extend(os.path.join(current, name) for name in node["dirs"])
+    return found
+
+
+def subtree_stats(tree, path):
+    """Returns byte and file counts for everything below `path` from the scan."""
+    stats = {"bytes": 0, "files": 0, "mp3_files": 0, "mp3_bytes": 0, "image_files": 0, "image_bytes": 0}
+    stack = [path]
+    while stack:
+        current = stack.pop()
+        node = tree.get(current)
+        if not node:
+            continue
+        for entry in node["files"]:
+            try:
+                size = entry.stat(follow_symlinks=False).st_size
+            except OSError:
+                continue
+            lower = entry.name.lower()
+            stats["bytes"] += size
+            stats["files"] += 1
+            if lower.endswith(AUDIO_EXTENSIONS):
+                stats["mp3_files"] += 1
+                stats["mp3_bytes"] += size
+            elif lower.endswith(IMAGE_EXTENSIONS):
+                stats["image_files"] += 1
+                stats["image_bytes"] += size
+        stack.extend(os.path.join(current, name) for name in node["dirs"])
+    return stats
+
+
+def zip_stats(zip_path):
+    """Reads only the zip's central directory for uncompressed sizes."""
+    stats = {"bytes": 0, "files": 0, "mp3_files": 0, "mp3_bytes": 0, "image_files": 0, "image_bytes": 0}
+    with zipfile.ZipFile(zip_path, "r") as zf:
+        for info in zf.infolist():
+            if info.is_dir():
+                continue
+            lower = info.filename.lower()
+            stats["bytes"] += info.file_size
+            stats["files"] += 1
+            if lower.endswith(AUDIO_EXTENSIONS):
+                stats["mp3_files"] += 1
+                stats["mp3_bytes"] += info.file_size
+            elif lower.endswith(IMAGE_EXTENSIONS):
+                stats["image_files"] += 1
+                stats["image_bytes"] += info.file_size
+    return stats
+
+
+def _is_below(path, roots):
+    for root in roots:
+        if path == root or path.startswith(root + os.sep):
+            return True
+    return False
+
+
+def _placement(library_path, book, ean, planned_targets, tree):
+    """Predicts where a book goes and whether that is a move, merge or quarantine."""
+    if book.takedown:
+        return "quarantine", os.path.join(library_path, TRASH_DIR_NAME, ean)
+    _, final_path = book_target_path(library_path, book)
+    parent = tree.get(os.path.dirname(final_path))
+    exists = parent is not None and os.path.basename(final_path) in parent["dirs"]
+    kind = "merge" if exists or final_path in planned_targets else "place"
+    planned_targets.add(final_path)
+    return kind, final_path
+
+
+def build_plan(db: Session, library_path: str, tree=None, drop_path=None):
+    """
+    Lists every action of a cycle with estimated bytes. Reads only.
+    drop_path: where new zips/EAN folders arrive (default: the library root).
+    """
+    started = time.time()
+    if tree is None:
+        tree = scan_library(library_path)
+    drop_path = drop_path or library_path
+    if drop_path not in tree:
+        # Drop folder outside the library: scanned into the same snapshot
+        tree.update(scan_library(drop_path))
+    root_node = tree.get(drop_path, {"dirs": [], "files": []})
+
+    zip_entries = [e for e in root_node["files"] if e.name.lower().endswith(".zip")]
+    ean_folders = [name for name in root_node["dirs"] if EAN_PATTERN.match(name)]
+
+    # Candidate EANs: root drops plus every cover name (takedown detection)
+    candidates = {os.path.splitext(e.name)[0] for e in zip_entries}
+    candidates.update(ean_folders)
+    for node in tree.values():
+        for entry in node["files"]:
+            if entry.name.lower().endswith(COVER_EXTENSIONS):
+                candidates.add(os.path.splitext(entry.name)[0])
+    catalog = lookup_books(db, candidates)
+
+    actions = []
+    trash_dir = os.path.join(library_path, TRASH_DIR_NAME)
+
+    # Phase 0a: takedown folders anywhere in the library (top-down, first hit wins).
+    # Only book folders below a root: a loose cover in the drop folder must not trash its pending drops
+    quarantined = []
+    for path in sorted(tree):
+        if path in (library_path, drop_path) or _is_below(path, quarantined):
+            continue
+        for entry in tree[path]["files"]:
+            if not entry.name.lower().endswith(COVER_EXTENSIONS):
+                continue
+            ean = os.path.splitext(entry.name)[0]
+            book = catalog.get(ean)
+            if book and book.takedown:
+                quarantined.append(path)
+                actions.append({
+                    "phase": 0, "action": "quarantine", "reason": "takedown", "ean": ean,
+                    "source": path, "target": os.path.join(trash_dir, os.path.basename(path)),
+                    "bytes": subtree_stats(tree, path)["bytes"],
+                })
+                break
+
+    # Phase 0b: legacy 'Title_<timestamp>' duplicates next to their base folder
+    merged = []
+    for path in sorted(tree):
+        if _is_below(path, quarantined) or _is_below(path, merged):
+            continue
+        dirs = tree[path]["dirs"]
+        for name in dirs:
+            match = SUFFIX_PATTERN.match(name)
+            if not match or match.group(1) not in dirs:
+                continue
+            duplicate_path = os.path.join(path, name)
+            if _is_below(duplicate_path, quarantined):
+                continue
+            merged.append(duplicate_path)
+            actions.append({
+                "phase": 0, "action": "merge_duplicate", "source": duplicate_path,
+                "target": os.path.join(path, match.group(1)),
+                "bytes": subtree_stats(tree, duplicate_path)["bytes"],
+            })
+
+    planned_targets = set()
+
+    # Phase 1: zip drops
+    for entry in sorted(zip_entries, key=lambda e: e.name):
+        ean = os.path.splitext(entry.name)[0]
+        book = catalog.get(ean)
+        if not book:
+            actions.append({"phase": 1, "action": "keep_zip", "reason": "unknown_ean", "ean": ean,
+                            "source": entry.path})
+            continue
+        corrupt = integrity.known_bad(entry.path)
+        if corrupt:
+            actions.append({"phase": 1, "action": "keep_zip", "reason": f"corrupt: {corrupt}", "ean": ean,
+                            "source": entry.path})
+            continue
+        try:
+            stats = zip_stats(entry.path)
+        except (OSError, zipfile.BadZipFile) as e:
+            actions.append({"phase": 1, "action": "keep_zip", "reason": f"unreadable: {e}", "ean": ean,
+                            "source": entry.path})
+            continue
+        placement, target = _placement(library_path, book, ean, planned_targets, tree)
+        actions.append({
+            "phase": 1, "action": "extract", "placement": placement, "ean": ean,
+            "source": entry.path, "target": target, "bytes": stats["bytes"],
+            "optimize": _optimize_estimate(stats) if placement != "quarantine" else None,
+            "book": book._asdict(),
+        })
+
+    # Phase 2: EAN folders in the drop folder
+    for name in ean_folders:
+        source = os.path.join(drop_path, name)
+        if _is_below(source, quarantined):
+            continue
+        book = catalog.get(name)
+        if not book:
+            actions.append({"phase": 2, "action": "skip_unknown", "ean": name, "source": source})
+            continue
+        stats = subtree_stats(tree, source)
+        placement, target = _placement(library_path, book, name, planned_targets, tree)
+        actions.append({
+            "phase": 2, "action": placement, "ean": name, "source": source, "target": target,
+            "bytes": stats["bytes"],
+            "optimize": _optimize_estimate(stats) if placement != "quarantine" else None,
+            "book": book._asdict(),
+        })
+
+    return {
+        "library_path": library_path,
+        "drop_path": drop_path,
+        "generated_at": started,
+        "scan_seconds": round(time.time() - started, 3),
+        "directories_scanned": len(tree),
+        "actions": actions,
+        "summary": summarize_plan(actions),
+    }
+
+
+def _optimize_estimate(stats):
+    # Bitrate/width are only known after ffprobe, so these are upper bounds
+    return {
+        "transcode_candidates": stats["mp3_files"],
+        "transcode_bytes": stats["mp3_bytes"],
+        "resize_candidates": stats["image_files"],
+        "resize_bytes": stats["image_bytes"],
+    }
+
+
+def summarize_plan(actions):
+    summary = {
+        "extract": 0, "place": 0, "merge": 0, "quarantine": 0, "merge_duplicate": 0,
+        "keep_zip": 0, "skip_unknown": 0,
+        "bytes_to_move": 0, "transcode_candidates": 0, "transcode_bytes": 0,
+    }
+    for action in actions:
+        kind = action["action"]
+        summary[kind] += 1
+        if kind == "extract":
+            # place/merge/quarantine counts include books that arrive as zips
+            summary[action["placement"]] += 1
+        summary["bytes_to_move"] += action.get("bytes", 0)
+        optimize = action.get("optimize")
+        if optimize:
+            summary["transcode_candidates"] += optimize["transcode_candidates"]
+            summary["transcode_bytes"] += optimize["transcode_bytes"]
+    return summary
+
+
+# -----------------
+# EXECUTOR
+# -----------------
+
+def _quarantine_folder(library_path, action):
+    source = action["source"]
+    if not os.path.isdir(source):
+        return
+    logger.warning(f"Removing takedown content: {action['ean']} in {source}")
+    trash_dir = os.path.join(library_path, TRASH_DIR_NAME)
+    os.makedirs(trash_dir, exist_ok=True)
+    target_path = os.path.join(trash_dir, os.path.basename(source))
+    if os.path.exists(target_path):
+        target_path += f"_{int(time.time())}"
+    try:
+        mover.move_tree(source, target_path)
+    except Exception as e:
+        logger.error(f"Failed to move takedown folder: {e}")
+
+
+def _merge_duplicate(action):
+    source, target = action["source"], action["target"]
+    if not os.path.isdir(source) or not os.path.isdir(target):
+        return False
+    dir_name, base_name = os.path.basename(source), os.path.basename(target)
+    try:
+        logger.warning(f"Merging duplicate folder '{dir_name}' into '{base_name}'.")
+        merge_folder_contents(source, target)
+        shutil.rmtree(source, ignore_errors=True)
+        return True
+    except Exception as dup_err:
+        logger.error(f"Failed to merge duplicate folder '{dir_name}': {dup_err}")
+        return False
+
+
+def _complete_job(job, book, files=None, workers=1):
+    """
+    Runs the stages after placement: per-file optimize, metadata, zip removal.
+    files: the book's relative file paths if known from the scan (no re-walk).
+    workers: transcode budget of the library root.
+    """
+    if job.stage == jobs.STAGE_PLACED:
+        started = time.perf_counter()
+        convert_folder_to_96k(job.final_path, skip=job.done_files,
+                              on_file_done=lambda rel: jobs.add_done_file(job, rel), files=files,
+                              workers=workers)
+        run_history.note_book(transcode_seconds=round(time.perf_counter() - started, 3))
+        if stop_event.is_set():
+            return False
+        jobs.update_job(job, stage=jobs.STAGE_OPTIMIZED)
+
+    if job.stage == jobs.STAGE_OPTIMIZED:
+        try:
+            write_metadata_file(job.final_path, job.ean, book.narrator, book.abridged_status)
+        except Exception as meta_err:
+            logger.warning(f"Could not write metadata.json: {meta_err}")
+        jobs.update_job(job, stage=jobs.STAGE_METADATA)
+
+    # A zip that changed or rotted since extraction is kept for inspection
+    if job.kind == "zip" and os.path.isfile(job.source) and integrity.check_zip_before_delete(job.source):
+        os.remove(job.source)
+    sidecars.record_placement(job.ean, job.final_path)
+    run_history.note_output(job.final_path)
+    jobs.finish_job(job)
+    logger.info(f"Finished: {os.path.basename(job.final_path)}")
+    return True
+
+
+def _place_job(library_path, job, book, source_path):
+    """Moves the book and records the placement. Returns False for takedowns."""
+    final_path = move_book_into_place(library_path, book, job.ean, source_path)
+    if final_path is None:
+        if job.kind == "zip" and os.path.isfile(job.source):
+            os.remove(job.source)
+        jobs.finish_job(job)
+        return False
+    jobs.update_job(job, stage=jobs.STAGE_PLACED, final_path=final_path, temp_dir=None)
+    return True
+
+
+def resume_jobs(library_path, unfinished, workers=1):
+    """Finishes books an earlier cycle already placed; drops jobs whose source is gone."""
+    for job in list(unfinished.values()):
+        if stop_event.is_set():
+            return
+        if job.stage in jobs.PLACED_STAGES and job.final_path and os.path.isdir(job.final_path):
+            if not jobs.claim_ean(job.ean):
+                continue
+            try:
+                logger.info(f"Resuming {job.ean} at stage '{job.stage}'...")
+                with run_history.track_book(job.ean, "resume"):
+                    _complete_job(job, BookRecord(**job.book), workers=workers)
+            finally:
+                jobs.release_ean(job.ean)
+            del unfinished[job.source]
+        elif not os.path.exists(job.source):
+            if job.temp_dir:
+                shutil.rmtree(job.temp_dir, ignore_errors=True)
+            jobs.finish_job(job)
+            del unfinished[job.source]
+
+
+def _claimed(fn):
+    """Runs a placement only while no other library root is placing the same EAN."""
+    def wrapper(library_path, action, *args, **kwargs):
+        if not jobs.claim_ean(action["ean"]):
+            logger.warning(f"{action['ean']} is being placed by another library root. Skipping this cycle.")
+            return
+        try:
+            with run_history.track_book(action["ean"], action["action"], action.get("bytes")):
+                return fn(library_path, action, *args, **kwargs)
+        finally:
+            jobs.release_ean(action["ean"])
+    return wrapper
+
+
+@_claimed
+def _extract_zip(library_path, action, job, workers=1):
+    item_path = action["source"]
+    item = os.path.basename(item_path)
+    ean = action["ean"]
+    if not os.path.isfile(item_path):
+        return
+    book = BookRecord(**action["book"])
+    job = jobs.open_job(ean, "zip", item_path, action["book"], existing=job)
+    try:
+        if job.stage == jobs.STAGE_EXTRACTED and job.temp_dir and os.path.isdir(job.temp_dir):
+            logger.info(f"Resuming {item} from extracted files...")
+        else:
+            # Fresh start, or a crash during extraction left a partial dir
+            if job.temp_dir:
+                shutil.rmtree(job.temp_dir, ignore_errors=True)
+            logger.info(f"Unzipping {item}...")
+            temp_dir = jobs.make_work_dir(ean)
+            jobs.update_job(job, stage=jobs.STAGE_PENDING, temp_dir=temp_dir)
+
+            with zipfile.ZipFile(item_path, "r") as zip_ref:
+                zip_ref.extractall(temp_dir)
+
+            flatten_single_subfolder(temp_dir)
+            jobs.update_job(job, stage=jobs.STAGE_EXTRACTED)
+
+        if stop_event.is_set():
+            return
+        temp_dir = job.temp_dir
+        if _place_job(library_path, job, book, temp_dir):
+            _complete_job(job, book, workers=workers)
+        if temp_dir and os.path.exists(temp_dir):
+            shutil.rmtree(temp_dir, ignore_errors=True)
+    except Exception as e:
+        logger.error(f"Zip extraction error for {item}: {e}")
+        run_history.note_book(error=str(e))
+        if isinstance(e, zipfile.BadZipFile):
+            # Cached until the zip changes, so later cycles do not extract it again
+            integrity.record_verdict(item_path, False, str(e))
+        jobs.update_job(job, error=str(e))
+        if job.stage == jobs.STAGE_PENDING and job.temp_dir:
+            shutil.rmtree(job.temp_dir, ignore_errors=True)
+
+
+@_claimed
+def _place_folder(library_path, action, job, tree=None, workers=1):
+    book = BookRecord(**action["book"])
+    job = jobs.open_job(action["ean"], "folder", action["source"], action["book"], existing=job)
+    # A plain move keeps the folder's layout; merges and quarantines are re-walked
+    files = subtree_files(tree, action["source"]) if tree and action["action"] == "place" else None
+    try:
+        if _place_job(library_path, job, book, action["source"]):
+            _complete_job(job, book, files, workers)
+    except Exception as e:
+        logger.error(f"Error processing {action['ean']}: {e}")
+        run_history.note_book(error=str(e))
+        jobs.update_job(job, error=str(e))
+
+
+def execute_phase(library_path, plan, phase, unfinished=None, tree=None, workers=1):
+    """
+    Applies the actions of one phase. Sources that vanished since planning are skipped.
+    unfinished: {source: JobState} from jobs.load_unfinished() (loaded if not given).
+    tree: the scan the plan was built from, so placed books are not walked again.
+    workers: transcode budget of the library root.
+    """
+    actions = [a for a in plan["actions"] if a["phase"] == phase]
+    if not actions:
+        return
+
+    if unfinished is None and phase in (1, 2):
+        unfinished = _root_jobs(plan)
+
+    if phase == 0:
+        merged_count = 0
+        for action in actions:
+            if stop_event.is_set():
+                return
+            if action["action"] == "quarantine":
+                with run_history.track_book(action["ean"], "quarantine", action["bytes"]):
+                    _quarantine_folder(library_path, action)
+            elif _merge_duplicate(action):
+                merged_count += 1
+        if merged_count > 0:
+            logger.info(f"Maintenance: Merged {merged_count} duplicate folder(s).")
+
+    elif phase == 1:
+        extracts = [a for a in actions if a["action"] == "extract"]
+        if extracts:
+            logger.info(f"Phase 1: Found {len(extracts)} zip(s) to extract.")
+        for action in actions:
+            if stop_event.is_set():
+                break
+            if action["action"] == "keep_zip" and action["reason"] == "unknown_ean":
+                logger.warning(f"No DB match for {action['ean']}. Keeping zip '{os.path.basename(action['source'])}'.")
+            elif action["action"] == "keep_zip":
+                logger.warning(f"Keeping zip '{os.path.basename(action['source'])}' ({action['reason']}).")
+            else:
+                _extract_zip(library_path, action, unfinished.get(action["source"]), workers)
+
+    elif phase == 2:
+        logger.info(f"Phase 2: Processing {len(actions)} book folder(s)...")
+        for action in actions:
+            if stop_event.is_set():
+                break
+            if action["action"] == "skip_unknown":
+                logger.debug(f"Ignored Unknown EAN folder: {action['ean']}")
+                continue
+            if not os.path.isdir(action["source"]):
+                continue
+            _place_folder(library_path, action, unfinished.get(action["source"]), tree, workers)
+
+
+def _log_move_totals(t):
+    if t.renames or t.files_copied:
+        logger.info(f"Moves: {t.renames} rename(s), {t.files_copied} file(s) / "
+                    f"{t.bytes_copied // (1024 * 1024)} MB copied across devices in {t.seconds:.1f}s.")
+    if t.files_skipped:
+        logger.info(f"Merges: {t.files_skipped} identical file(s) / "
+                    f"{t.bytes_skipped // (1024 * 1024)} MB not copied again.")
+
+
+def _root_jobs(plan):
+    """Unfinished jobs that belong to this plan's library root / drop folder."""
+    roots = [plan["library_path"], plan.get("drop_path") or plan["library_path"]]
+    return {
+        source: job for source, job in jobs.load_unfinished().items()
+        if _is_below(source, roots) or (job.final_path and _is_below(job.final_path, roots))
+    }
+
+
+def execute_plan(library_path: str, plan, tree=None, workers=1):
+    """
+    Applies a plan from build_plan in phase order, after finishing interrupted books.
+    Returns the MoveStats of this cycle.
+    """
+    cycle_moves = mover.MoveStats()
+    with mover.collect_into(cycle_moves):
+        _execute_phases(library_path, plan, tree, workers)
+    _log_move_totals(cycle_moves)
+    return cycle_moves
+
+
+def _execute_phases(library_path, plan, tree, workers):
+    started = time.time()
+    unfinished = _root_jobs(plan)
+    if unfinished:
+        logger.info(f"Found {len(unfinished)} unfinished job(s) from an earlier cycle.")
+        with run_history.phase("resume"):
+            resume_jobs(library_path, unfinished, workers)
+    if stop_event.is_set():
+        return
+
+    logger.info("Scanning for TAKEDOWN content...")
+    with run_history.phase("phase0"):
+        execute_phase(library_path, plan, 0)
+    if stop_event.is_set():
+        return
+
+    with run_history.phase("phase1"):
+        execute_phase(library_path, plan, 1, unfinished, workers=workers)
+    if stop_event.is_set():
+        return
+
+    with run_history.phase("phase2"):
+        execute_phase(library_path, plan, 2, unfinished, tree, workers)
+
+    # Phase 3: Maintenance
+    with run_history.phase("maintenance"):
+        if not stop_event.is_set():
+            cleanup_metadata_files(library_path)
+        if not stop_event.is_set():
+            try:
+                embedded_covers.extract_missing_covers(library_path, tree, since=started)
+            except Exception as e:
+                logger.error(f"Embedded cover extraction failed: {e}")
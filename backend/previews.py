@@ -0,0 +1,76 @@
+"""
+Low-bitrate audio previews for checking a placed book over slow links.
+
+A preview is the first N minutes of a track or of a whole book folder
+(tracks in name order), re-encoded once to 32 kbps mono MP3 and kept in a
+size-bounded cache next to metadata.db. The key covers every source
+track's path, mtime and size, so a re-placed book gets a fresh preview.
+"""
+import os
+import subprocess
+import tempfile
+import throttle
+from database import DB_PATH
+from renamer_core import logger
+from thumbnails import FileCache
+
+PREVIEW_CACHE_DIR = os.getenv("PREVIEW_CACHE_DIR", os.path.join(os.path.dirname(DB_PATH) or ".", "previews"))
+PREVIEW_CACHE_MAX_BYTES = int(os.getenv("PREVIEW_CACHE_MAX_MB", "512")) * 1024 * 1024
+PREVIEW_BITRATE = os.getenv("PREVIEW_BITRATE", "32k")
+PREVIEW_MINUTES = int(os.getenv("PREVIEW_MINUTES", "5"))
+PREVIEW_MAX_MINUTES = 30
+
+
+def preview_tracks(path):
+    """The MP3s a preview of path is cut from: the file itself or the folder's tracks."""
+    if os.path.isfile(path):
+        return [path]
+    return sorted(
+        os.path.join(path, name) for name in os.listdir(path)
+        if name.lower().endswith(".mp3") and os.path.isfile(os.path.join(path, name))
+    )
+
+
+def make_preview(tracks, dst_path, minutes):
+    """Encodes the first `minutes` of the concatenated tracks. Returns True on success."""
+    # concat demuxer list; single quotes in names are escaped per ffmpeg's quoting rules
+    with tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False, encoding="utf-8") as f:
+        for track in tracks:
+            escaped = os.path.abspath(track).replace("'", "'\\''")
+            f.write(f"file '{escaped}'\n")
+        list_path = f.name
+    cmd = throttle.niced([
+        "ffmpeg", "-v", "error", "-f", "concat", "-safe", "0", "-i", list_path,
+        "-t", str(minutes * 60), "-map", "0:a", "-ac", "1", "-ar", "22050",
+        "-b:a", PREVIEW_BITRATE, "-f", "mp3", "-y", dst_path,
+    ])
+    try:
+        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    except Exception as e:
+        logger.error(f"Preview error for {tracks[0]}: {e}")
+        return False
+    finally:
+        os.remove(list_path)
+    if result.returncode != 0:
+        logger.error(f"FFmpeg error creating preview for {tracks[0]}: {result.stderr}")
+        return False
+    return True
+
+
+class PreviewCache(FileCache):
+    suffix = ".mp3"
+
+    def get(self, path, minutes=PREVIEW_MINUTES):
+        """Cached preview of a track or book folder, or None (no tracks / ffmpeg failed)."""
+        minutes = max(1, min(int(minutes), PREVIEW_MAX_MINUTES))
+        tracks = preview_tracks(path)
+        if not tracks:
+            return None
+        parts = [f"{minutes}", PREVIEW_BITRATE]
+        for track in tracks:
+            st = os.stat(track)
+            parts.append(f"{os.path.abspath(track)}|{st.st_mtime_ns}|{st.st_size}")
+        return self.lookup("|".join(parts), lambda temp_path: make_preview(tracks, temp_path, minutes))
+
+
+preview_cache = PreviewCache(PREVIEW_CACHE_DIR, PREVIEW_CACHE_MAX_BYTES)
@@ -3,13 +3,15 @@ import re
 import logging
 import shutil
 import subprocess
-import zipfile
 import time
-import tempfile
 import threading
 import json
+import collections
 import concurrent.futures
 from sqlalchemy.orm import Session
+import covers
+import mover
+import throttle
 from database import SessionLocal
 from models import Book
 
@@ -48,10 +50,14 @@ class RenamerLogger:
             "timestamp": time.time(),
             "level": level,
             "message": message,
+            "pid": os.getpid(),
         }
         # Force immediate print to Docker console
         print(f"{level}: {message}", flush=True)
+        self.deliver(entry)
 
+    def deliver(self, entry):
+        """History and listeners; also used for entries of other worker processes."""
         self.history.append(entry)
         if len(self.history) > 1000:
             self.history.pop(0)
@@ -67,6 +73,16 @@ logger = RenamerLogger()
 
 # Global State
 stop_event = threading.Event()
+# Library roots whose leftovers from before the last restart were cleaned up
+orphans_collected = set()
+
+# Catalog lookups: EANs per IN query (well below SQLite's bound-parameter limit)
+CATALOG_CHUNK_SIZE = 500
+
+# Immutable catalog row for the scanner; no session or identity map attached.
+BookRecord = collections.namedtuple(
+    "BookRecord", ["ean", "author", "title", "takedown", "narrator", "abridged_status"]
+)
 
 
 def sanitize_filename(name):
@@ -109,60 +125,134 @@ def get_image_width(file_path):
         return 0
 
 
-def resize_image_if_needed(file_info):
+def temp_name(file_name, attempt=None):
+    """ffmpeg output next to the original; every queue attempt gets its own (see transcode_queue.Attempt)."""
+    return f"temp_{attempt.tag}_{file_name}" if attempt else f"temp_{file_name}"
+
+
+def run_ffmpeg(cmd, attempt=None):
+    """subprocess.run for ffmpeg; None if the attempt was aborted (ffmpeg is killed)."""
+    if attempt is None:
+        return subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True) as proc:
+        while True:
+            try:
+                stdout, stderr = proc.communicate(timeout=0.5)
+                return subprocess.CompletedProcess(cmd, proc.returncode, stdout, stderr)
+            except subprocess.TimeoutExpired:
+                if attempt.aborted.is_set():
+                    proc.kill()
+                    proc.wait()
+                    return None
+
+
+def replace_original(temp_path, full_path, attempt=None):
+    """Moves the output over the original, unless the attempt lost its lease meanwhile."""
+    if attempt is not None and (attempt.aborted.is_set() or not attempt.confirm()):
+        logger.warning(f"Lease lost; discarding output for {os.path.basename(full_path)}.")
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        return False
+    os.replace(temp_path, full_path)
+    return True
+
+
+def resize_image_if_needed(file_info, attempt=None):
+    """Returns True once the image is known to be within max width."""
     if stop_event.is_set():
-        return
+        return False
     full_path, root, file_name = file_info
     max_width = 600
+    temp_path = os.path.join(root, temp_name(file_name, attempt))
+
+    try:
+        width = covers.resize_cover(full_path, temp_path, max_width)
+        if width > max_width:
+            if not replace_original(temp_path, full_path, attempt):
+                return False
+            logger.info(f"Resized {file_name} ({width}px -> {max_width}px).")
+        return True
+    except covers.UnsupportedImage:
+        pass  # ffmpeg below
+    except Exception as e:
+        logger.error(f"Error resizing {file_name}: {e}")
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        return False
 
     try:
         width = get_image_width(full_path)
         if width == 0 or width <= max_width:
-            return
+            return True
 
         logger.info(f"Resizing image {file_name} ({width}px -> {max_width}px)...")
-        temp_path = os.path.join(root, f"temp_{file_name}")
 
-        cmd = [
+        cmd = throttle.niced([
             "ffmpeg", "-i", full_path, "-vf", f"scale={max_width}:-1",
             "-q:v", "6", "-y", temp_path,
-        ]
-        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        ])
+        result = run_ffmpeg(cmd, attempt)
 
-        if result.returncode == 0:
-            os.replace(temp_path, full_path)
+        if result is not None and result.returncode == 0:
+            if not replace_original(temp_path, full_path, attempt):
+                return False
             logger.info(f"Resized {file_name} successfully.")
+            return True
         else:
-            logger.error(f"FFmpeg error resizing {file_name}: {result.stderr}")
+            if result is None:
+                logger.warning(f"Aborted resizing {file_name} (lease lost).")
+            else:
+                logger.error(f"FFmpeg error resizing {file_name}: {result.stderr}")
             if os.path.exists(temp_path):
                 os.remove(temp_path)
     except Exception as e:
         logger.error(f"Error resizing {file_name}: {e}")
+    return False
+
+
+def log_pause(current):
+    logger.warning(f"System under pressure ({current['source']} {current['value']} > "
+                   f"{current['threshold']}). Pausing transcoding...")
 
 
-def convert_single_file(file_info):
+def log_resume(current):
+    logger.info(f"Pressure back to {current['source']} {current['value']}. Resuming transcoding.")
+
+
+def convert_single_file(file_info, attempt=None):
+    """
+    Returns True once the track is known to be at ~96k. attempt: the queue
+    lease this runs under (transcode_queue.Attempt); aborting it kills ffmpeg.
+    """
     if stop_event.is_set():
-        return
+        return False
     full_path, root, file_name = file_info
-    temp_path = os.path.join(root, f"temp_{file_name}")
+    temp_path = os.path.join(root, temp_name(file_name, attempt))
 
     try:
         bitrate = get_audio_bitrate(full_path)
         if 92000 <= bitrate <= 100000:
-            return
+            return True
 
+        if not throttle.wait_for_capacity(stop_event, log_pause, log_resume):
+            return False
         logger.info(f"Converting {file_name} to 96k (Current: {bitrate})...")
-        cmd = [
+        cmd = throttle.niced([
             "ffmpeg", "-i", full_path, "-codec:a", "libmp3lame",
             "-b:a", "96k", "-y", temp_path,
-        ]
-        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        ])
+        result = run_ffmpeg(cmd, attempt)
 
-        if result.returncode == 0:
-            os.replace(temp_path, full_path)
+        if result is not None and result.returncode == 0:
+            if not replace_original(temp_path, full_path, attempt):
+                return False
             logger.info(f"Converted {file_name} successfully.")
+            return True
         else:
-            logger.error(f"FFmpeg error on {file_name}: {result.stderr}")
+            if result is None:
+                logger.warning(f"Aborted converting {file_name} (lease lost).")
+            else:
+                logger.error(f"FFmpeg error on {file_name}: {result.stderr}")
             if os.path.exists(temp_path):
                 os.remove(temp_path)
 
@@ -170,27 +260,65 @@ def convert_single_file(file_info):
         logger.error(f"Error converting {file_name}: {e}")
         if os.path.exists(temp_path):
             os.remove(temp_path)
+    return False
 
 
-def convert_folder_to_96k(folder_path):
+def convert_folder_to_96k(folder_path, skip=None, on_file_done=None, files=None, workers=1):
+    """
+    Optimizes all tracks and images below folder_path.
+    skip: relative paths already handled (resumed jobs).
+    on_file_done(rel_path) is called for every file that is finished.
+    files: relative paths of the folder's files if already known (skips the walk).
+    workers: parallel transcodes (the library root's budget).
+    """
     logger.info(f"Optimizing folder: {folder_path}...")
+    skip = skip or set()
     mp3_files = []
     image_files = []
 
-    for root, dirs, files in os.walk(folder_path):
-        for file_name in files:
-            lower = file_name.lower()
-            if lower.endswith(".mp3"):
-                mp3_files.append((os.path.join(root, file_name), root, file_name))
-            elif lower.endswith((".jpg", ".jpeg", ".png")):
-                image_files.append((os.path.join(root, file_name), root, file_name))
+    if files is None:
+        files = [
+            os.path.relpath(os.path.join(root, file_name), folder_path)
+            for root, dirs, names in os.walk(folder_path) for file_name in names
+        ]
 
-    workers = 1
-    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
-        if mp3_files:
-            executor.map(convert_single_file, mp3_files)
-        if image_files:
-            executor.map(resize_image_if_needed, image_files)
+    for rel_path in files:
+        if rel_path in skip:
+            continue
+        full_path = os.path.join(folder_path, rel_path)
+        root, file_name = os.path.split(full_path)
+        lower = file_name.lower()
+        if lower.endswith(".mp3"):
+            mp3_files.append((full_path, root, file_name))
+        elif lower.endswith((".jpg", ".jpeg", ".png")):
+            image_files.append((full_path, root, file_name))
+
+    def run(fn, file_info):
+        if fn(file_info) and on_file_done:
+            on_file_done(os.path.relpath(file_info[0], folder_path))
+
+    if os.getenv("TRANSCODE_QUEUE", "0") == "1":
+        # Jobs for local and remote transcode workers (see transcode_queue)
+        from transcode_queue import run_batch
+        items = [("audio", info[0]) for info in mp3_files] + [("image", info[0]) for info in image_files]
+        done = (lambda path: on_file_done(os.path.relpath(path, folder_path))) if on_file_done else None
+        run_batch(items, workers, done)
+        return
+
+    # Covers go to the shared in-process pool and resize while the tracks transcode
+    cover_futures = [covers.cover_pool().submit(run, resize_image_if_needed, info) for info in image_files]
+
+    from batch_transcode import TRANSCODE_BATCH_SIZE, convert_tracks
+    if TRANSCODE_BATCH_SIZE > 1:
+        # Chunks of tracks per ffmpeg process (see batch_transcode)
+        done = (lambda info: on_file_done(os.path.relpath(info[0], folder_path))) if on_file_done else (lambda info: None)
+        convert_tracks(mp3_files, done, workers)
+    else:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            for file_info in mp3_files:
+                executor.submit(run, convert_single_file, file_info)
+
+    concurrent.futures.wait(cover_futures)
 
 
 def normalize_abridged_status(raw_status):
@@ -215,42 +343,6 @@ def normalize_abridged_status(raw_status):
     )
 
 
-def cleanup_takedowns(db: Session, library_path: str):
-    logger.info("Scanning for TAKEDOWN content...")
-    forbidden_books = db.query(Book).filter(Book.takedown == True).all()
-    forbidden_eans = set([b.ean for b in forbidden_books])
-
-    if not forbidden_eans:
-        return
-
-    trash_dir = os.path.join(library_path, "_DUPLICATES_TO_DELETE")
-    os.makedirs(trash_dir, exist_ok=True)
-
-    for root, dirs, files in os.walk(library_path):
-        if stop_event.is_set():
-            return
-        if "_DUPLICATES_TO_DELETE" in root:
-            continue
-
-        found_takedown_ean = None
-        for file_name in files:
-            if file_name.lower().endswith((".jpg", ".jpeg")):
-                name_no_ext = os.path.splitext(file_name)[0]
-                if name_no_ext in forbidden_eans:
-                    found_takedown_ean = name_no_ext
-                    break
-
-        if found_takedown_ean:
-            logger.warning(f"Removing takedown content: {found_takedown_ean} in {root}")
-            target_path = os.path.join(trash_dir, os.path.basename(root))
-            if os.path.exists(target_path):
-                target_path += f"_{int(time.time())}"
-            try:
-                shutil.move(root, target_path)
-            except Exception as e:
-                logger.error(f"Failed to move takedown folder: {e}")
-
-
 def cleanup_metadata_files(library_path):
     """No-op maintenance hook. metadata.json is intentionally kept for ABS imports."""
     return
@@ -276,14 +368,25 @@ def build_final_title(book, safe_title):
 
 
 def merge_folder_contents(src_dir, dst_dir):
-    """Move source contents into destination without creating a second book folder."""
+    """
+    Move source contents into destination without creating a second book folder.
+    Incoming files identical to one already there (same name, or an earlier
+    name_<timestamp> copy) are dropped; only differing content is kept with a
+    timestamp suffix. Returns MoveStats incl. the skipped files/bytes.
+    """
+    stats = mover.MoveStats()
+    file_moves = []
+    dst_names = os.listdir(dst_dir)
     for name in os.listdir(src_dir):
         src_item = os.path.join(src_dir, name)
         dst_item = os.path.join(dst_dir, name)
 
         if os.path.isdir(src_item):
-            os.makedirs(dst_item, exist_ok=True)
-            merge_folder_contents(src_item, dst_item)
+            if not os.path.exists(dst_item):
+                # Subtree is new on the target side: one move instead of file by file
+                stats.add(mover.move_tree(src_item, dst_item))
+                continue
+            stats.add(merge_folder_contents(src_item, dst_item))
             if os.path.exists(src_item):
                 try:
                     os.rmdir(src_item)
@@ -292,43 +395,21 @@ def merge_folder_contents(src_dir, dst_dir):
         else:
             if os.path.exists(dst_item):
                 base, ext = os.path.splitext(name)
+                suffixed = re.compile(rf"^{re.escape(base)}_\d{{8,}}{re.escape(ext)}$")
+                candidates = [dst_item] + [os.path.join(dst_dir, n) for n in dst_names if suffixed.match(n)]
+                skipped = mover.drop_identical(src_item, candidates)
+                if skipped is not None:
+                    stats.add(skipped)
+                    continue
                 dst_item = os.path.join(dst_dir, f"{base}_{int(time.time())}{ext}")
-            shutil.move(src_item, dst_item)
-
+            file_moves.append((src_item, dst_item))
 
-def cleanup_duplicate_suffix_folders(library_path):
-    """Merge legacy duplicate folders like 'Title_1770793951' into 'Title'."""
-    suffix_pattern = re.compile(r"^(.+)_\d{8,}$")
-    merged_count = 0
-
-    for root, dirs, files in os.walk(library_path):
-        if stop_event.is_set():
-            return
-        if "_DUPLICATES_TO_DELETE" in root:
-            continue
-
-        for dir_name in list(dirs):
-            match = suffix_pattern.match(dir_name)
-            if not match:
-                continue
-            base_name = match.group(1)
-            duplicate_path = os.path.join(root, dir_name)
-            base_path = os.path.join(root, base_name)
-            if not os.path.isdir(base_path):
-                continue
-            try:
-                logger.warning(f"Merging duplicate folder '{dir_name}' into '{base_name}'.")
-                merge_folder_contents(duplicate_path, base_path)
-                shutil.rmtree(duplicate_path, ignore_errors=True)
-                merged_count += 1
-            except Exception as dup_err:
-                logger.error(f"Failed to merge duplicate folder '{dir_name}': {dup_err}")
+    stats.add(mover.move_files(file_moves))
+    return stats
 
-    if merged_count > 0:
-        logger.info(f"Maintenance: Merged {merged_count} duplicate folder(s).")
 
-
-def write_metadata_file(folder_path, ean, narrator, abridged_status):
+def build_metadata(ean, narrator, abridged_status):
+    """metadata.json content (as bytes) for a book."""
     metadata = {"isbn": ean}
 
     if abridged_status:
@@ -353,20 +434,42 @@ def write_metadata_file(folder_path, ean, narrator, abridged_status):
         if narrators:
             metadata["narrators"] = narrators
 
+    return json.dumps(metadata, ensure_ascii=False, indent=2).encode("utf-8")
+
+
+def write_metadata_file(folder_path, ean, narrator, abridged_status):
+    """
+    Writes metadata.json atomically (temp file + rename).
+    Returns False without touching the file when the content is already identical.
+    """
+    content = build_metadata(ean, narrator, abridged_status)
     metadata_path = os.path.join(folder_path, "metadata.json")
-    with open(metadata_path, "w", encoding="utf-8") as mf:
-        json.dump(metadata, mf, ensure_ascii=False, indent=2)
+    try:
+        with open(metadata_path, "rb") as mf:
+            if mf.read() == content:
+                return False
+    except FileNotFoundError:
+        pass
+    temp_path = f"{metadata_path}.tmp"
+    with open(temp_path, "wb") as mf:
+        mf.write(content)
+    os.replace(temp_path, metadata_path)
+    return True
 
 
-def process_ean_folder(db: Session, library_path: str, ean: str, source_path: str):
-    if stop_event.is_set():
-        return False
+def book_target_path(library_path, book):
+    """Returns (final_title, final_path) where a catalog book belongs in the library."""
+    safe_author = sanitize_filename(book.author or "Unknown")
+    safe_title = sanitize_filename(book.title or "Unknown")
+    final_title = build_final_title(book, safe_title)
+    return final_title, os.path.join(library_path, safe_author, final_title)
 
-    book = db.query(Book).filter(Book.ean == ean).first()
-    if not book:
-        logger.debug(f"Ignored Unknown EAN folder: {ean}")
-        return False
 
+def move_book_into_place(library_path: str, book, ean: str, source_path: str):
+    """
+    Moves a resolved book into Author/Title, merging if the folder exists.
+    Takedowns go to quarantine instead. Returns the final path (None for takedowns).
+    """
     if book.takedown:
         logger.warning(f"TAKEDOWN {ean}. Deleting.")
         trash_dir = os.path.join(library_path, "_DUPLICATES_TO_DELETE")
@@ -374,103 +477,84 @@ def process_ean_folder(db: Session, library_path: str, ean: str, source_path: st
         target = os.path.join(trash_dir, ean)
         if os.path.exists(target):
             target = f"{target}_{int(time.time())}"
-        shutil.move(source_path, target)
-        return True
-
-    safe_author = sanitize_filename(book.author or "Unknown")
-    safe_title = sanitize_filename(book.title or "Unknown")
-    final_title = build_final_title(book, safe_title)
+        mover.move_tree(source_path, target)
+        return None
 
-    author_dir = os.path.join(library_path, safe_author)
-    final_path = os.path.join(author_dir, final_title)
-    os.makedirs(author_dir, exist_ok=True)
+    final_title, final_path = book_target_path(library_path, book)
+    os.makedirs(os.path.dirname(final_path), exist_ok=True)
 
     if os.path.abspath(source_path) != os.path.abspath(final_path):
         if os.path.exists(final_path):
             logger.warning(f"Target '{final_title}' exists. Merging into existing folder.")
-            merge_folder_contents(source_path, final_path)
+            stats = merge_folder_contents(source_path, final_path)
+            if stats.files_skipped:
+                logger.info(f"Skipped {stats.files_skipped} identical file(s) "
+                            f"({stats.bytes_skipped // (1024 * 1024)} MB) already in '{final_title}'.")
             if os.path.exists(source_path):
                 shutil.rmtree(source_path, ignore_errors=True)
         else:
-            shutil.move(source_path, final_path)
-
-    convert_folder_to_96k(final_path)
+            stats = mover.move_tree(source_path, final_path)
+            if stats.bytes_copied:
+                logger.info(f"Moved {final_title} across devices: {stats.bytes_copied // (1024 * 1024)} MB "
+                            f"in {stats.seconds:.1f}s.")
+    return final_path
+
+
+def lookup_books(db: Session, eans, chunk_size=CATALOG_CHUNK_SIZE):
+    """Resolves EANs with chunked IN queries. Returns {ean: BookRecord} for known EANs."""
+    columns = [getattr(Book, field) for field in BookRecord._fields]
+    eans = sorted(set(eans))
+    records = {}
+    for i in range(0, len(eans), chunk_size):
+        chunk = eans[i:i + chunk_size]
+        for row in db.query(*columns).filter(Book.ean.in_(chunk)):
+            records[row[0]] = BookRecord(*row)
+    return records
+
+
+def run_once(library_path, drop_path=None, workers=1, trigger="manual", root_name=None):
+    """
+    One cycle for one library root. Returns {"summary": plan summary, "moves": MoveStats}
+    (None if the cycle could not run). The cycle is stored in the run history
+    (trigger: "manual" or "scheduler").
+    """
+    # Imported here: the planner and job table build on the helpers above
+    from planner import scan_library, build_plan, execute_plan
+    from jobs import collect_orphans
+    import run_history
 
-    try:
-        write_metadata_file(final_path, ean, book.narrator, book.abridged_status)
-    except Exception as meta_err:
-        logger.warning(f"Could not write metadata.json: {meta_err}")
-
-    logger.info(f"Finished: {os.path.basename(final_path)}")
-    return True
-
-
-def run_once(library_path):
     if not os.path.exists(library_path):
         logger.error(f"Library path not found: {library_path}")
-        return
+        return None
 
-    db: Session = SessionLocal()
+    result = None
+    error = None
+    run = run_history.start_run(library_path, trigger, root_name)
     try:
-        # Phase 0: Security & Pre-Cleanup
-        cleanup_takedowns(db, library_path)
-        cleanup_duplicate_suffix_folders(library_path)
-
-        # Phase 1: Unzip outside library, then move directly into final structure.
-        current_items = os.listdir(library_path)
-        zip_files = [
-            i for i in current_items if os.path.isfile(os.path.join(library_path, i)) and i.lower().endswith(".zip")
-        ]
+        # One directory pass per cycle; every phase works from this snapshot
+        with run_history.phase("scan"):
+            tree = scan_library(library_path)
 
-        if zip_files:
-            logger.info(f"Phase 1: Found {len(zip_files)} zip(s) to extract.")
-            for item in zip_files:
-                if stop_event.is_set():
-                    break
-                item_path = os.path.join(library_path, item)
-                temp_dir = None
-                try:
-                    logger.info(f"Unzipping {item}...")
-                    ean = os.path.splitext(item)[0]
-                    temp_dir = tempfile.mkdtemp(prefix=f"renamer_{ean}_")
-
-                    with zipfile.ZipFile(item_path, "r") as zip_ref:
-                        zip_ref.extractall(temp_dir)
-
-                    flatten_single_subfolder(temp_dir)
-                    processed = process_ean_folder(db, library_path, ean, temp_dir)
-                    if processed:
-                        os.remove(item_path)
-                    else:
-                        logger.warning(f"No DB match for {ean}. Keeping zip '{item}'.")
-                except Exception as e:
-                    logger.error(f"Zip extraction error for {item}: {e}")
-                finally:
-                    if temp_dir and os.path.exists(temp_dir):
-                        shutil.rmtree(temp_dir, ignore_errors=True)
-
-        if stop_event.is_set():
-            return
-
-        # Phase 2: Process existing EAN folders in root.
-        current_items = os.listdir(library_path)
-        ean_folders = [
-            i for i in current_items if os.path.isdir(os.path.join(library_path, i)) and re.match(r"^\d{13}$", i)
-        ]
-
-        if ean_folders:
-            logger.info(f"Phase 2: Processing {len(ean_folders)} book folder(s)...")
-            for item in ean_folders:
-                if stop_event.is_set():
-                    break
-                process_ean_folder(db, library_path, item, os.path.join(library_path, item))
-
-        # Phase 3: Maintenance
-        if not stop_event.is_set():
-            cleanup_metadata_files(library_path)
+        # First cycle after (re)start: nothing is running yet, so leftovers are orphans
+        if library_path not in orphans_collected:
+            try:
+                collect_orphans(library_path, tree)
+            except Exception as e:
+                logger.error(f"Startup cleanup failed: {e}")
+            orphans_collected.add(library_path)
 
+        # The session only lives for the catalog lookup; moves and ffmpeg run without it
+        db: Session = SessionLocal()
+        try:
+            with run_history.phase("plan"):
+                plan = build_plan(db, library_path, tree, drop_path)
+        finally:
+            db.close()
+        moves = execute_plan(library_path, plan, tree, workers)
+        result = {"summary": plan["summary"], "moves": moves}
     except Exception as e:
+        error = str(e)
         logger.error(f"Critical Scan Error: {e}")
-    finally:
-        db.close()
+    run_history.finish_run(run, result, error)
     logger.info("Scan Cycle Complete.")
+    return result
@@ -0,0 +1,197 @@
+"""
+Multiple library roots in one process.
+
+config["library_roots"] is a list of
+    {"name": "disk2", "path": "/mnt/disk2/audiobooks", "drop_path": "/mnt/disk2/incoming", "workers": 2}
+(drop_path and workers optional). Without it the single config["library_path"]
+is the only root. Roots run their cycles concurrently against the shared
+catalog; jobs.claim_ean keeps one EAN from being placed by two roots at once.
+Each root's cycle counters live in root_metrics, so every API worker reports
+the cycles of all of them.
+"""
+import concurrent.futures
+import json
+import time
+import renamer_core
+import run_state
+from database import SessionLocal, engine
+from models import RootMetric
+from renamer_core import logger
+
+_table_ready = False
+
+
+class LibraryRoot:
+    __slots__ = ("name", "path", "drop_path", "workers")
+
+    def __init__(self, name, path, drop_path=None, workers=1):
+        self.name = name
+        self.path = path
+        self.drop_path = drop_path or path
+        self.workers = max(1, int(workers or 1))
+
+    def as_dict(self):
+        return {"name": self.name, "path": self.path, "drop_path": self.drop_path, "workers": self.workers}
+
+
+def parse_roots(config, resolve):
+    """LibraryRoots from the config; resolve maps user paths to internal paths."""
+    entries = config.get("library_roots") or []
+    if not entries:
+        path = resolve(config.get("library_path", ""))
+        return [LibraryRoot("default", path)]
+    roots = []
+    for index, entry in enumerate(entries):
+        drop_path = entry.get("drop_path")
+        roots.append(LibraryRoot(
+            entry.get("name") or f"root{index + 1}",
+            resolve(entry["path"]),
+            resolve(drop_path) if drop_path else None,
+            entry.get("workers", 1),
+        ))
+    return roots
+
+
+class RootMetrics:
+    def __init__(self, root):
+        self.root = root
+        self.running = False
+        self.cycles = 0
+        self.last_started = None
+        self.last_seconds = None
+        self.last_error = None
+        self.last_summary = None
+        self.last_moves = None
+        self.total_seconds = 0.0
+
+    @classmethod
+    def from_row(cls, root, row):
+        metrics = cls(root)
+        metrics.running = bool(row.running)
+        metrics.cycles = row.cycles or 0
+        metrics.last_started = row.last_started
+        metrics.last_seconds = row.last_seconds
+        metrics.last_error = row.last_error
+        metrics.last_summary = json.loads(row.last_summary) if row.last_summary else None
+        metrics.last_moves = json.loads(row.last_moves) if row.last_moves else None
+        metrics.total_seconds = row.total_seconds or 0.0
+        return metrics
+
+    def save(self):
+        ensure_table()
+        db = SessionLocal()
+        try:
+            db.merge(RootMetric(
+                name=self.root.name, path=self.root.path, drop_path=self.root.drop_path,
+                workers=self.root.workers, running=self.running, cycles=self.cycles,
+                last_started=self.last_started, last_seconds=self.last_seconds, last_error=self.last_error,
+                last_summary=json.dumps(self.last_summary) if self.last_summary is not None else None,
+                last_moves=json.dumps(self.last_moves) if self.last_moves is not None else None,
+                total_seconds=self.total_seconds,
+            ))
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            logger.warning(f"[{self.root.name}] Could not store cycle metrics: {e}")
+        finally:
+            db.close()
+
+    def as_dict(self):
+        return {
+            "root": self.root.as_dict(),
+            "running": self.running,
+            "cycles": self.cycles,
+            "last_started": self.last_started,
+            "last_seconds": self.last_seconds,
+            "last_error": self.last_error,
+            "last_summary": self.last_summary,
+            "last_moves": self.last_moves,
+            "total_seconds": round(self.total_seconds, 3),
+        }
+
+
+def ensure_table():
+    global _table_ready
+    if not _table_ready:
+        RootMetric.__table__.create(bind=engine, checkfirst=True)
+        _table_ready = True
+
+
+def metrics_for(root):
+    """Stored metrics of the root; a root whose path changed starts from zero."""
+    ensure_table()
+    db = SessionLocal()
+    try:
+        row = db.get(RootMetric, root.name)
+        if row is None or row.path != root.path:
+            return RootMetrics(root)
+        return RootMetrics.from_row(root, row)
+    finally:
+        db.close()
+
+
+def all_metrics():
+    ensure_table()
+    db = SessionLocal()
+    try:
+        rows = db.query(RootMetric).all()
+    finally:
+        db.close()
+    # A worker that died mid-cycle leaves running set; only a live scan lease counts
+    scanning = run_state.is_running()
+    result = {}
+    for row in rows:
+        metrics = RootMetrics.from_row(LibraryRoot(row.name, row.path, row.drop_path, row.workers), row)
+        metrics.running = metrics.running and scanning
+        result[row.name] = metrics.as_dict()
+    return result
+
+
+def run_root(root, trigger="manual"):
+    metrics = metrics_for(root)
+    metrics.running = True
+    metrics.last_started = time.time()
+    metrics.last_error = None
+    metrics.save()
+    started = time.perf_counter()
+    logger.info(f"[{root.name}] Cycle started ({root.path}, drop: {root.drop_path}, workers: {root.workers}).")
+    try:
+        result = renamer_core.run_once(root.path, root.drop_path, root.workers, trigger, root.name)
+        if result is None:
+            metrics.last_error = "Cycle did not run (path missing or scan error)"
+        else:
+            metrics.last_summary = result["summary"]
+            metrics.last_moves = result["moves"].as_dict()
+    except Exception as e:
+        metrics.last_error = str(e)
+        logger.error(f"[{root.name}] Cycle failed: {e}")
+    finally:
+        metrics.last_seconds = round(time.perf_counter() - started, 3)
+        metrics.total_seconds += metrics.last_seconds
+        metrics.cycles += 1
+        metrics.running = False
+        metrics.save()
+    logger.info(f"[{root.name}] Cycle finished in {metrics.last_seconds}s.")
+
+
+def run_roots(roots, trigger="manual"):
+    """One cycle for every root, concurrently. trigger is stored in the run history."""
+    if len(roots) == 1:
+        run_root(roots[0], trigger)
+        return
+
+    # Startup cleanup first and one root at a time: it deletes work dirs no job
+    # references, which must not race with another root opening a new job.
+    from jobs import collect_orphans
+    for root in roots:
+        if root.path in renamer_core.orphans_collected:
+            continue
+        try:
+            collect_orphans(root.path)
+        except Exception as e:
+            logger.error(f"[{root.name}] Startup cleanup failed: {e}")
+        renamer_core.orphans_collected.add(root.path)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(roots), thread_name_prefix="root") as pool:
+        for future in [pool.submit(run_root, root, trigger) for root in roots]:
+            future.result()
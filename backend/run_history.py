@@ -0,0 +1,225 @@
+"""
+Persistent history of scan cycles.
+
+run_once opens a RunRecorder for its thread; the planner adds phase
+durations (phase()) and one row per book it extracts, places, resumes or
+quarantines (track_book(), note_book()). finish_run() writes the cycle to
+`runs` and its books to `run_books` in one transaction, so the logger's
+in-memory history is no longer the only record of what a cycle did.
+Only the newest RUN_HISTORY_KEEP cycles are kept.
+"""
+import contextlib
+import json
+import os
+import threading
+import time
+from database import SessionLocal, engine
+from models import Run, RunBook
+from renamer_core import logger, stop_event
+
+RUN_HISTORY_KEEP = int(os.getenv("RUN_HISTORY_KEEP", "1000"))
+BOOK_ORDERS = {
+    "seconds": RunBook.seconds.desc(),
+    "transcode": RunBook.transcode_seconds.desc(),
+    "bytes": RunBook.bytes_in.desc(),
+    "processed": RunBook.id.asc(),
+}
+
+_local = threading.local()
+_table_ready = False
+
+
+def ensure_table():
+    global _table_ready
+    if not _table_ready:
+        Run.__table__.create(bind=engine, checkfirst=True)
+        RunBook.__table__.create(bind=engine, checkfirst=True)
+        _table_ready = True
+
+
+class RunRecorder:
+    __slots__ = ("trigger", "root", "library_path", "started_at", "phases", "books", "current_book")
+
+    def __init__(self, library_path, trigger, root=None):
+        self.trigger = trigger
+        self.root = root
+        self.library_path = library_path
+        self.started_at = time.time()
+        self.phases = {}
+        self.books = []
+        self.current_book = None
+
+
+def start_run(library_path, trigger="manual", root=None):
+    """Starts recording a cycle for the calling thread."""
+    run = RunRecorder(library_path, trigger, root)
+    _local.run = run
+    return run
+
+
+def current():
+    return getattr(_local, "run", None)
+
+
+@contextlib.contextmanager
+def phase(name):
+    """Adds the block's duration to the current cycle's phase `name`."""
+    run = current()
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        if run is not None:
+            run.phases[name] = round(run.phases.get(name, 0.0) + time.perf_counter() - started, 3)
+
+
+@contextlib.contextmanager
+def track_book(ean, action, bytes_in=None):
+    """One run_books row for the block; nested blocks belong to the outer book."""
+    run = current()
+    if run is None or run.current_book is not None:
+        yield
+        return
+    entry = {"ean": ean, "action": action, "bytes_in": bytes_in, "bytes_out": None,
+             "transcode_seconds": None, "error": None}
+    run.current_book = entry
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        entry["error"] = str(e)
+        raise
+    finally:
+        entry["seconds"] = round(time.perf_counter() - started, 3)
+        run.current_book = None
+        run.books.append(entry)
+
+
+def note_book(**values):
+    """Sets fields (bytes_out, transcode_seconds, error) of the book being tracked."""
+    run = current()
+    if run is not None and run.current_book is not None:
+        run.current_book.update(values)
+
+
+def note_output(path):
+    """Records the size of the book's final folder."""
+    run = current()
+    if run is not None and run.current_book is not None:
+        note_book(bytes_out=folder_bytes(path))
+
+
+def folder_bytes(path):
+    total = 0
+    for root, _, names in os.walk(path):
+        for name in names:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                continue
+    return total
+
+
+def finish_run(run, result=None, error=None):
+    """Writes the cycle and its books. Returns the run id (None if it could not be stored)."""
+    if current() is run:
+        _local.run = None
+    finished_at = time.time()
+    if error is not None or result is None:
+        status = "error"
+    elif stop_event.is_set():
+        status = "stopped"
+    else:
+        status = "ok"
+
+    ensure_table()
+    db = SessionLocal()
+    try:
+        row = Run(
+            trigger=run.trigger, root=run.root, library_path=run.library_path,
+            started_at=run.started_at, finished_at=finished_at,
+            seconds=round(finished_at - run.started_at, 3), status=status, error=error,
+            phases=json.dumps(run.phases),
+            summary=json.dumps(result["summary"]) if result else None,
+            moves=json.dumps(result["moves"].as_dict()) if result else None,
+            books=len(run.books),
+        )
+        db.add(row)
+        db.flush()
+        db.add_all(RunBook(run_id=row.id, **book) for book in run.books)
+        _prune(db)
+        db.commit()
+        return row.id
+    except Exception as e:
+        db.rollback()
+        logger.warning(f"Could not store run history: {e}")
+        return None
+    finally:
+        db.close()
+
+
+def _prune(db):
+    cutoff = db.query(Run.id).order_by(Run.id.desc()).offset(RUN_HISTORY_KEEP).limit(1).scalar()
+    if cutoff is not None:
+        db.query(RunBook).filter(RunBook.run_id <= cutoff).delete(synchronize_session=False)
+        db.query(Run).filter(Run.id <= cutoff).delete(synchronize_session=False)
+
+
+def run_dict(row):
+    return {
+        "id": row.id,
+        "trigger": row.trigger,
+        "root": row.root,
+        "library_path": row.library_path,
+        "started_at": row.started_at,
+        "finished_at": row.finished_at,
+        "seconds": row.seconds,
+        "status": row.status,
+        "error": row.error,
+        "phases": json.loads(row.phases or "{}"),
+        "summary": json.loads(row.summary) if row.summary else None,
+        "moves": json.loads(row.moves) if row.moves else None,
+        "books": row.books,
+    }
+
+
+def book_dict(row):
+    return {
+        "ean": row.ean,
+        "action": row.action,
+        "bytes_in": row.bytes_in,
+        "bytes_out": row.bytes_out,
+        "seconds": row.seconds,
+        "transcode_seconds": row.transcode_seconds,
+        "error": row.error,
+    }
+
+
+def list_runs(db, limit=50, offset=0, root=None, trigger=None, status=None):
+    """Newest cycles first."""
+    ensure_table()
+    query = db.query(Run)
+    if root:
+        query = query.filter(Run.root == root)
+    if trigger:
+        query = query.filter(Run.trigger == trigger)
+    if status:
+        query = query.filter(Run.status == status)
+    total = query.count()
+    rows = query.order_by(Run.id.desc()).offset(offset).limit(limit).all()
+    return {"total": total, "limit": limit, "offset": offset, "runs": [run_dict(r) for r in rows]}
+
+
+def get_run(db, run_id, limit=100, offset=0, order="seconds"):
+    """The cycle with one page of its books (slowest first by default), or None."""
+    ensure_table()
+    row = db.get(Run, run_id)
+    if row is None:
+        return None
+    query = db.query(RunBook).filter(RunBook.run_id == run_id)
+    books = query.order_by(BOOK_ORDERS[order], RunBook.id.asc()).offset(offset).limit(limit).all()
+    return {
+        **run_dict(row),
+        "books_page": {"total": query.count(), "limit": limit, "offset": offset, "order": order,
+                       "items": [book_dict(b) for b in books]},
+    }
@@ -0,0 +1,292 @@
+"""
+Run coordination shared by all API worker processes.
+
+With UVICORN_WORKERS > 1 every worker imports main.py, so module globals no
+longer describe "the" run. What has to hold across processes lives in
+SQLite instead:
+
+- run_leases: one row per lease ("scan" for cycles and the scans that run
+  instead of one, "scheduler" for the process that fires the cron slots).
+  acquire() succeeds in exactly one process; the holder renews the lease
+  from a background thread, so the lease of a crashed worker runs out after
+  RUN_LEASE_SECONDS.
+- the lease's stop flag: request_stop() on any worker sets it, the holder
+  sees it within POLL_SECONDS and sets its own stop_event.
+- shared_flags: scheduler on/off.
+- bus_events: log entries and "catalog_changed". Every worker tails the
+  table and replays events of other processes to its websocket listeners
+  and catalog snapshot. Only started with more than one worker.
+"""
+import json
+import os
+import threading
+import time
+import uuid
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError, OperationalError
+from database import SessionLocal, engine
+from models import RunLease, SharedFlag, BusEvent
+from renamer_core import logger, stop_event
+
+API_WORKERS = int(os.getenv("UVICORN_WORKERS", "1"))
+LEASE_SECONDS = float(os.getenv("RUN_LEASE_SECONDS", "30"))
+# How often a holder checks its stop flag; the lease is renewed every third of its lifetime
+POLL_SECONDS = 1.0
+BUS_POLL_SECONDS = 0.5
+BUS_KEEP_EVENTS = 2000
+BUS_READ_LIMIT = 500
+
+SCAN = "scan"
+SCHEDULER = "scheduler"
+
+_tables_ready = False
+
+
+def ensure_tables():
+    global _tables_ready
+    if not _tables_ready:
+        for model in (RunLease, SharedFlag, BusEvent):
+            try:
+                model.__table__.create(bind=engine, checkfirst=True)
+            except OperationalError:
+                # Another worker created it between the check and the CREATE
+                model.__table__.create(bind=engine, checkfirst=True)
+        _tables_ready = True
+
+
+class Lease:
+    """A held lease; renewed in the background until release()."""
+
+    def __init__(self, name, kind, token, on_lost=None):
+        self.name = name
+        self.kind = kind
+        self.token = token
+        self.on_lost = on_lost
+        self.lost = False
+        self.released = threading.Event()
+        self.thread = threading.Thread(target=self._keep, daemon=True, name=f"lease-{name}")
+        self.thread.start()
+
+    def _keep(self):
+        renewed = time.time()
+        while not self.released.wait(POLL_SECONDS):
+            try:
+                renewed = self._check(renewed)
+            except Exception as e:
+                logger.warning(f"Could not renew lease '{self.name}': {e}")
+            if self.lost:
+                logger.error(f"Lease '{self.name}' was taken over by another worker.")
+                if self.on_lost:
+                    self.on_lost()
+                return
+
+    def _check(self, renewed):
+        db = SessionLocal()
+        try:
+            row = db.get(RunLease, self.name)
+            if row is None or row.owner != self.token:
+                self.lost = True
+                return renewed
+            if row.stop_requested and not stop_event.is_set():
+                logger.info(f"Stop requested for '{self.kind}' by another worker.")
+                stop_event.set()
+            now = time.time()
+            if now - renewed < LEASE_SECONDS / 3:
+                return renewed
+            updated = db.query(RunLease).filter(RunLease.name == self.name, RunLease.owner == self.token).update(
+                {"expires_at": now + LEASE_SECONDS}, synchronize_session=False)
+            db.commit()
+            self.lost = not updated
+            return now
+        finally:
+            db.close()
+
+    def release(self):
+        self.released.set()
+        db = SessionLocal()
+        try:
+            db.query(RunLease).filter(RunLease.name == self.name, RunLease.owner == self.token).delete(
+                synchronize_session=False)
+            db.commit()
+        finally:
+            db.close()
+
+
+def acquire(name, kind, on_lost=None):
+    """The lease if no live holder has it, else None."""
+    ensure_tables()
+    token = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+    now = time.time()
+    fields = {"owner": token, "kind": kind, "pid": os.getpid(), "acquired_at": now,
+              "expires_at": now + LEASE_SECONDS, "stop_requested": False}
+    db = SessionLocal()
+    try:
+        # Takes over an expired lease, or inserts; a live row makes the insert fail
+        taken = db.query(RunLease).filter(RunLease.name == name, RunLease.expires_at < now).update(
+            fields, synchronize_session=False)
+        if not taken:
+            db.add(RunLease(name=name, **fields))
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        return None
+    finally:
+        db.close()
+    return Lease(name, kind, token, on_lost)
+
+
+def acquire_scan(kind):
+    """The scan lease; losing it stops the local run."""
+    return acquire(SCAN, kind, on_lost=stop_event.set)
+
+
+def holder(name=SCAN):
+    """{"kind", "pid", "acquired_at", "stop_requested"} of the live lease, or None."""
+    ensure_tables()
+    db = SessionLocal()
+    try:
+        row = db.get(RunLease, name)
+        if row is None or row.expires_at < time.time():
+            return None
+        return {"kind": row.kind, "pid": row.pid, "acquired_at": row.acquired_at,
+                "stop_requested": bool(row.stop_requested)}
+    finally:
+        db.close()
+
+
+def is_running():
+    return holder(SCAN) is not None
+
+
+def request_stop():
+    """Flags the running scan to stop, whichever worker runs it."""
+    ensure_tables()
+    db = SessionLocal()
+    try:
+        db.query(RunLease).filter(RunLease.name == SCAN).update({"stop_requested": True}, synchronize_session=False)
+        db.commit()
+    finally:
+        db.close()
+
+
+def get_flag(name, default=False):
+    ensure_tables()
+    db = SessionLocal()
+    try:
+        row = db.get(SharedFlag, name)
+        return default if row is None else bool(row.value)
+    finally:
+        db.close()
+
+
+def set_flag(name, value):
+    ensure_tables()
+    db = SessionLocal()
+    try:
+        db.merge(SharedFlag(name=name, value=bool(value), updated_at=time.time()))
+        db.commit()
+    finally:
+        db.close()
+
+
+class EventBus:
+    """Cross-process events through bus_events; handlers get events of other processes only."""
+
+    def __init__(self):
+        self.pending = []
+        self.lock = threading.Lock()
+        self.handlers = {}
+        self.last_id = 0
+        self.thread = None
+
+    def on(self, kind, handler):
+        self.handlers[kind] = handler
+
+    def publish(self, kind, payload=None):
+        if self.thread is None:
+            return
+        with self.lock:
+            self.pending.append(BusEvent(pid=os.getpid(), kind=kind, payload=json.dumps(payload),
+                                         created_at=time.time()))
+
+    def _forward_log(self, entry):
+        # Replayed entries carry the pid of the process that logged them
+        if entry.get("pid") == os.getpid():
+            self.publish("log", entry)
+
+    def start(self):
+        if self.thread is not None:
+            return
+        ensure_tables()
+        db = SessionLocal()
+        try:
+            self.last_id = db.query(func.max(BusEvent.id)).scalar() or 0
+        finally:
+            db.close()
+        logger.add_listener(self._forward_log)
+        self.thread = threading.Thread(target=self._loop, daemon=True, name="event-bus")
+        self.thread.start()
+
+    def _loop(self):
+        while True:
+            time.sleep(BUS_POLL_SECONDS)
+            try:
+                self._flush()
+                self._poll()
+            except Exception as e:
+                # Not through the logger: its entries would come straight back here
+                print(f"WARNING: Event bus error: {e}", flush=True)
+
+    def _flush(self):
+        with self.lock:
+            events, self.pending = self.pending, []
+        if not events:
+            return
+        db = SessionLocal()
+        try:
+            db.add_all(events)
+            db.flush()
+            newest = events[-1].id
+            if newest % BUS_KEEP_EVENTS < len(events):
+                db.query(BusEvent).filter(BusEvent.id <= newest - BUS_KEEP_EVENTS).delete(synchronize_session=False)
+            db.commit()
+        finally:
+            db.close()
+
+    def _poll(self):
+        db = SessionLocal()
+        try:
+            rows = (db.query(BusEvent).filter(BusEvent.id > self.last_id)
+                    .order_by(BusEvent.id).limit(BUS_READ_LIMIT).all())
+            events = [(r.id, r.pid, r.kind, r.payload) for r in rows]
+        finally:
+            db.close()
+        for event_id, pid, kind, payload in events:
+            self.last_id = event_id
+            handler = self.handlers.get(kind)
+            if pid == os.getpid() or handler is None:
+                continue
+            try:
+                handler(json.loads(payload) if payload else None)
+            except Exception as e:
+                print(f"WARNING: Event bus handler for '{kind}' failed: {e}", flush=True)
+
+
+bus = EventBus()
+
+
+def _rebuild_catalog(_payload):
+    from catalog import rebuild_snapshot
+    rebuild_snapshot()
+
+
+def start_bus():
+    """Starts the event bus if the API runs with several workers."""
+    if API_WORKERS <= 1:
+        return
+    with engine.connect() as conn:
+        # Readers of the other workers do not block the writer
+        conn.exec_driver_sql("PRAGMA journal_mode=WAL")
+    bus.on("log", logger.deliver)
+    bus.on("catalog_changed", _rebuild_catalog)
+    bus.start()
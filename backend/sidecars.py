@@ -0,0 +1,105 @@
+"""
+metadata.json maintenance after catalog syncs.
+
+Every placed book is recorded in `placements` (EAN -> folder). When a sync
+changes a book's narrator or abridged status, rewrite_metadata() rewrites
+just those books' metadata.json, atomically, and leaves files whose
+content is already identical untouched.
+"""
+import os
+import threading
+import time
+from database import SessionLocal, engine
+from models import Placement
+from renamer_core import logger, lookup_books, book_target_path, write_metadata_file, CATALOG_CHUNK_SIZE
+
+_table_ready = False
+_write_lock = threading.Lock()
+
+
+def ensure_table():
+    global _table_ready
+    if not _table_ready:
+        Placement.__table__.create(bind=engine, checkfirst=True)
+        _table_ready = True
+
+
+def record_placement(ean, path):
+    ensure_table()
+    with _write_lock:
+        db = SessionLocal()
+        try:
+            db.merge(Placement(ean=ean, path=path, updated_at=time.time()))
+            db.commit()
+        except Exception as e:
+            logger.warning(f"Could not record placement of {ean}: {e}")
+        finally:
+            db.close()
+
+
+def lookup_placements(db, eans, chunk_size=CATALOG_CHUNK_SIZE):
+    """Returns {ean: path} with chunked IN queries."""
+    ensure_table()
+    eans = sorted(set(eans))
+    paths = {}
+    for i in range(0, len(eans), chunk_size):
+        chunk = eans[i:i + chunk_size]
+        for ean, path in db.query(Placement.ean, Placement.path).filter(Placement.ean.in_(chunk)):
+            paths[ean] = path
+    return paths
+
+
+def placements_below(db, library_path):
+    """Returns {ean: (path, updated_at)} for books placed inside library_path."""
+    ensure_table()
+    prefix = library_path.rstrip(os.sep) + os.sep
+    return {
+        ean: (path, updated_at)
+        for ean, path, updated_at in db.query(Placement.ean, Placement.path, Placement.updated_at)
+        if path and path.startswith(prefix)
+    }
+
+
+def rewrite_metadata(eans, library_paths=()):
+    """
+    Rewrites metadata.json for the given EANs from the current catalog.
+    Books without a recorded placement (placed before it was tracked) are
+    looked up at their Author/Title path in library_paths.
+    Returns counts of written, unchanged and not found books.
+    """
+    result = {"written": 0, "unchanged": 0, "not_found": 0, "failed": 0}
+    if not eans:
+        return result
+
+    db = SessionLocal()
+    try:
+        books = lookup_books(db, eans)
+        paths = lookup_placements(db, books)
+    finally:
+        db.close()
+
+    for ean, book in books.items():
+        folder = paths.get(ean)
+        if not folder or not os.path.isdir(folder):
+            folder = None
+            for library_path in library_paths:
+                _, candidate = book_target_path(library_path, book)
+                if os.path.isdir(candidate):
+                    folder = candidate
+                    record_placement(ean, folder)
+                    break
+        if folder is None:
+            result["not_found"] += 1
+            continue
+        try:
+            if write_metadata_file(folder, ean, book.narrator, book.abridged_status):
+                result["written"] += 1
+            else:
+                result["unchanged"] += 1
+        except OSError as e:
+            logger.warning(f"Could not rewrite metadata.json for {ean}: {e}")
+            result["failed"] += 1
+
+    logger.info(f"metadata.json refresh: {result['written']} rewritten, {result['unchanged']} unchanged, "
+                f"{result['not_found']} not on disk ({len(eans)} changed in catalog).")
+    return result
@@ -0,0 +1,100 @@
+"""
+Load-aware throttling for heavy work (transcodes, cover fallbacks).
+
+Pressure comes from PSI (/proc/pressure/{cpu,io}, "some avg10") where the
+kernel provides it, otherwise from the 1-minute load average per CPU.
+wait_for_capacity() blocks a worker while the host is under pressure and
+lets it continue once pressure drops below RESUME_RATIO of the threshold.
+ffmpeg children are started through nice/ionice.
+"""
+import os
+import shutil
+import threading
+
+PSI_THRESHOLD = float(os.getenv("THROTTLE_PSI_AVG10", "40"))  # % of time stalled
+LOAD_THRESHOLD = float(os.getenv("THROTTLE_LOAD_PER_CPU", "2.0"))
+RESUME_RATIO = 0.8
+POLL_SECONDS = float(os.getenv("THROTTLE_POLL_SECONDS", "15"))
+THROTTLE_ENABLED = os.getenv("THROTTLE_ENABLED", "1") != "0"
+
+# Empty string disables the wrapper
+FFMPEG_NICE = os.getenv("FFMPEG_NICE", "10")
+FFMPEG_IONICE_CLASS = os.getenv("FFMPEG_IONICE_CLASS", "2")  # 1 realtime, 2 best-effort, 3 idle
+FFMPEG_IONICE_LEVEL = os.getenv("FFMPEG_IONICE_LEVEL", "7")
+
+_pause_lock = threading.Lock()
+_paused = False
+
+
+def _read_psi(resource):
+    try:
+        with open(f"/proc/pressure/{resource}") as f:
+            for line in f:
+                if line.startswith("some "):
+                    fields = dict(item.split("=") for item in line.split()[1:])
+                    return float(fields["avg10"])
+    except (OSError, KeyError, ValueError):
+        pass
+    return None
+
+
+def pressure():
+    """Returns {"source", "value", "threshold"} for the current host pressure."""
+    psi = [v for v in (_read_psi("cpu"), _read_psi("io")) if v is not None]
+    if psi:
+        return {"source": "psi", "value": max(psi), "threshold": PSI_THRESHOLD}
+    try:
+        load = os.getloadavg()[0] / (os.cpu_count() or 1)
+    except OSError:
+        load = 0.0
+    return {"source": "loadavg", "value": round(load, 2), "threshold": LOAD_THRESHOLD}
+
+
+def under_pressure(resume=False):
+    if not THROTTLE_ENABLED:
+        return False
+    current = pressure()
+    limit = current["threshold"] * (RESUME_RATIO if resume else 1.0)
+    return current["value"] > limit
+
+
+def is_paused():
+    return _paused
+
+
+def wait_for_capacity(stop_event, on_pause=None, on_resume=None):
+    """
+    Blocks while the host is under pressure. on_pause/on_resume are called
+    once per pause (by whichever worker noticed it). Returns False if
+    stop_event was set while waiting.
+    """
+    global _paused
+    if not under_pressure(resume=_paused):
+        return True
+    with _pause_lock:
+        if not _paused:
+            _paused = True
+            if on_pause:
+                on_pause(pressure())
+    while not stop_event.is_set():
+        if not under_pressure(resume=True):
+            with _pause_lock:
+                if _paused:
+                    _paused = False
+                    if on_resume:
+                        on_resume(pressure())
+            return True
+        stop_event.wait(POLL_SECONDS)
+    return False
+
+
+def niced(cmd):
+    """Prefixes a command with nice/ionice as configured (and installed)."""
+    prefix = []
+    if FFMPEG_IONICE_CLASS and shutil.which("ionice"):
+        prefix += ["ionice", "-c", FFMPEG_IONICE_CLASS]
+        if FFMPEG_IONICE_LEVEL and FFMPEG_IONICE_CLASS in ("1", "2"):
+            prefix += ["-n", FFMPEG_IONICE_LEVEL]
+    if FFMPEG_NICE and shutil.which("nice"):
+        prefix += ["nice", "-n", FFMPEG_NICE]
+    return prefix + list(cmd)
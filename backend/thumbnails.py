@@ -0,0 +1,154 @@
+"""
+On-disk cover thumbnail cache.
+
+Thumbnails are generated once per (path, mtime, size bucket) and kept in
+a cache directory next to metadata.db. The cache is bounded by total
+size; the least recently used thumbnails are evicted first.
+"""
+import collections
+import hashlib
+import os
+import subprocess
+import threading
+import covers
+from database import DB_PATH
+from renamer_core import logger
+
+# Requested widths are rounded up to one of these buckets
+THUMB_BUCKETS = (60, 120, 240, 480)
+
+THUMB_CACHE_DIR = os.getenv("THUMB_CACHE_DIR", os.path.join(os.path.dirname(DB_PATH) or ".", "thumbs"))
+THUMB_CACHE_MAX_BYTES = int(os.getenv("THUMB_CACHE_MAX_MB", "256")) * 1024 * 1024
+
+
+def bucket_for(width):
+    for bucket in THUMB_BUCKETS:
+        if width <= bucket:
+            return bucket
+    return THUMB_BUCKETS[-1]
+
+
+def make_thumbnail(src_path, dst_path, width):
+    """Scales src to `width` (never upscales). Returns True on success."""
+    try:
+        covers.resize_cover(src_path, dst_path, width, force=True, output_format="JPEG")
+        return True
+    except covers.UnsupportedImage:
+        pass  # ffmpeg below
+    except Exception as e:
+        logger.error(f"Thumbnail error for {src_path}: {e}")
+        return False
+
+    cmd = [
+        "ffmpeg", "-v", "error", "-i", src_path,
+        "-vf", f"scale='min({width},iw)':-2", "-frames:v", "1", "-q:v", "5", "-y", dst_path,
+    ]
+    try:
+        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    except Exception as e:
+        logger.error(f"Thumbnail error for {src_path}: {e}")
+        return False
+    if result.returncode != 0:
+        logger.error(f"FFmpeg error creating thumbnail for {src_path}: {result.stderr}")
+        return False
+    return True
+
+
+class FileCache:
+    """
+    Size-bounded directory of generated files, LRU eviction. Subclasses
+    build the key material and the generator; lookup() does the rest.
+    """
+    suffix = ".jpg"
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()  # name -> size, oldest first
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+        self.key_locks = {}
+        self.loaded = False
+
+    def _load(self):
+        """Indexes existing cache files, least recently used first (by atime)."""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        found = []
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if entry.is_file() and entry.name.endswith(self.suffix) and ".tmp" not in entry.name:
+                    st = entry.stat()
+                    found.append((st.st_atime, entry.name, st.st_size))
+        for _, name, size in sorted(found):
+            self.entries[name] = size
+            self.total_bytes += size
+        self.loaded = True
+
+    def _key(self, raw):
+        return hashlib.sha1(raw.encode("utf-8")).hexdigest() + self.suffix
+
+    def _touch(self, name):
+        self.entries.move_to_end(name)
+
+    def _add(self, name, size):
+        self.entries[name] = size
+        self.total_bytes += size
+        while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+            old_name, old_size = self.entries.popitem(last=False)
+            self.total_bytes -= old_size
+            try:
+                os.remove(os.path.join(self.cache_dir, old_name))
+            except OSError:
+                pass
+
+    def lookup(self, raw_key, generate):
+        """
+        Path of the cached file for raw_key; generate(temp_path) -> bool
+        creates it on a miss. Returns None if generation fails.
+        """
+        name = self._key(raw_key)
+        cache_path = os.path.join(self.cache_dir, name)
+
+        with self.lock:
+            if not self.loaded:
+                self._load()
+            if name in self.entries and os.path.exists(cache_path):
+                self._touch(name)
+                return cache_path
+            key_lock = self.key_locks.setdefault(name, threading.Lock())
+
+        # Generate outside the global lock; concurrent requests for the same key wait here
+        with key_lock:
+            if not os.path.exists(cache_path):
+                temp_path = f"{cache_path}.{threading.get_ident()}.tmp{self.suffix}"
+                if not generate(temp_path):
+                    if os.path.exists(temp_path):
+                        os.remove(temp_path)
+                    with self.lock:
+                        self.key_locks.pop(name, None)
+                    return None
+                os.replace(temp_path, cache_path)
+
+        with self.lock:
+            self.key_locks.pop(name, None)
+            if name not in self.entries:
+                self._add(name, os.path.getsize(cache_path))
+            else:
+                self._touch(name)
+        return cache_path
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.entries), "bytes": self.total_bytes, "max_bytes": self.max_bytes}
+
+
+class ThumbnailCache(FileCache):
+    def get(self, src_path, width):
+        """Returns the path of a cached thumbnail for src_path, generating it if needed."""
+        stat_result = os.stat(src_path)
+        bucket = bucket_for(width)
+        raw = f"{os.path.abspath(src_path)}|{stat_result.st_mtime_ns}|{stat_result.st_size}|{bucket}"
+        return self.lookup(raw, lambda temp_path: make_thumbnail(src_path, temp_path, bucket))
+
+
+thumbnail_cache = ThumbnailCache(THUMB_CACHE_DIR, THUMB_CACHE_MAX_BYTES)
@@ -0,0 +1,248 @@
+"""
+Pull-based transcode queue.
+
+With TRANSCODE_QUEUE=1, convert_folder_to_96k does not run ffmpeg itself:
+every track/cover becomes a job here. Local worker threads (the root's
+worker budget) and any number of remote workers (transcode_worker.py, on
+this host or another host sharing the mount) claim jobs over HTTP, hold a
+lease that they extend with heartbeats, and report the result. A job whose
+lease runs out (crashed worker) goes back to the queue and is retried up
+to MAX_ATTEMPTS times. A worker that loses its lease kills ffmpeg and
+discards the output; each attempt writes its own temp file and the lease
+is confirmed once more before the original is replaced.
+"""
+import itertools
+import os
+import threading
+import time
+from renamer_core import logger, stop_event, convert_single_file, resize_image_if_needed
+
+QUEUE_ENABLED = os.getenv("TRANSCODE_QUEUE", "0") == "1"
+LEASE_SECONDS = float(os.getenv("TRANSCODE_LEASE_SECONDS", "60"))
+MAX_ATTEMPTS = int(os.getenv("TRANSCODE_MAX_ATTEMPTS", "3"))
+
+KINDS = {
+    "audio": convert_single_file,
+    "image": resize_image_if_needed,
+}
+
+PENDING = "pending"
+LEASED = "leased"
+DONE = "done"
+FAILED = "failed"
+
+
+class TranscodeJob:
+    __slots__ = ("id", "kind", "path", "state", "worker", "lease_expires", "attempts", "error", "ok", "finished")
+
+    def __init__(self, job_id, kind, path):
+        self.id = job_id
+        self.kind = kind
+        self.path = path
+        self.state = PENDING
+        self.worker = None
+        self.lease_expires = 0.0
+        self.attempts = 0
+        self.error = None
+        self.ok = False
+        self.finished = threading.Event()
+
+    def as_dict(self):
+        return {"id": self.id, "kind": self.kind, "path": self.path, "lease_seconds": LEASE_SECONDS,
+                "attempt": self.attempts}
+
+
+class TranscodeQueue:
+    def __init__(self, lease_seconds=LEASE_SECONDS, max_attempts=MAX_ATTEMPTS):
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.jobs = {}  # id -> job, pending and leased only
+        self.lock = threading.Lock()
+        self.available = threading.Condition(self.lock)
+        self.ids = itertools.count(1)
+        self.workers = {}  # worker id -> last contact
+        self.counters = {"submitted": 0, "done": 0, "failed": 0, "expired": 0}
+
+    def submit(self, kind, path):
+        with self.lock:
+            job = TranscodeJob(next(self.ids), kind, path)
+            self.jobs[job.id] = job
+            self.counters["submitted"] += 1
+            self.available.notify()
+            return job
+
+    def _finish(self, job, ok, error=None):
+        job.state = DONE if ok else FAILED
+        job.ok = ok
+        job.error = error
+        self.jobs.pop(job.id, None)
+        self.counters["done" if ok else "failed"] += 1
+        job.finished.set()
+
+    def _reap(self, now):
+        """Expired leases go back to pending (or fail after max_attempts)."""
+        for job in list(self.jobs.values()):
+            if job.state == LEASED and job.lease_expires < now:
+                self.counters["expired"] += 1
+                logger.warning(f"Transcode lease of job {job.id} ({os.path.basename(job.path)}) "
+                               f"expired on worker {job.worker}.")
+                if job.attempts >= self.max_attempts:
+                    self._finish(job, False, "lease expired too often")
+                else:
+                    job.state = PENDING
+                    job.worker = None
+
+    def claim(self, worker_id, kinds=None, wait=0.0):
+        """Leases the oldest pending job (optionally waiting up to `wait` seconds)."""
+        deadline = time.time() + wait
+        with self.lock:
+            self.workers[worker_id] = time.time()
+            while True:
+                now = time.time()
+                self._reap(now)
+                for job in self.jobs.values():
+                    if job.state == PENDING and (not kinds or job.kind in kinds):
+                        job.state = LEASED
+                        job.worker = worker_id
+                        job.attempts += 1
+                        job.lease_expires = now + self.lease_seconds
+                        return job
+                remaining = deadline - now
+                if remaining <= 0:
+                    return None
+                self.available.wait(min(remaining, self.lease_seconds))
+
+    def heartbeat(self, job_id, worker_id):
+        """Extends a lease. False if the worker no longer holds it."""
+        with self.lock:
+            self.workers[worker_id] = time.time()
+            job = self.jobs.get(job_id)
+            if job is None or job.state != LEASED or job.worker != worker_id:
+                return False
+            job.lease_expires = time.time() + self.lease_seconds
+            return True
+
+    def complete(self, job_id, worker_id, ok, error=None):
+        """Records a result. False if the lease was lost (the job was handed out again)."""
+        with self.lock:
+            self.workers[worker_id] = time.time()
+            job = self.jobs.get(job_id)
+            if job is None or job.state != LEASED or job.worker != worker_id:
+                return False
+            if ok or job.attempts >= self.max_attempts:
+                self._finish(job, ok, error)
+            else:
+                job.state = PENDING
+                job.worker = None
+                job.error = error
+                self.available.notify()
+            return True
+
+    def leased_paths(self):
+        """Paths of the jobs a worker is converting right now."""
+        with self.lock:
+            self._reap(time.time())
+            return {job.path for job in self.jobs.values() if job.state == LEASED}
+
+    def cancel(self, jobs):
+        with self.lock:
+            for job in jobs:
+                if job.id in self.jobs:
+                    self._finish(job, False, "cancelled")
+
+    def stats(self):
+        with self.lock:
+            now = time.time()
+            states = [job.state for job in self.jobs.values()]
+            return {
+                "enabled": QUEUE_ENABLED,
+                "pending": states.count(PENDING),
+                "leased": states.count(LEASED),
+                **self.counters,
+                "workers": {w: round(now - seen, 1) for w, seen in self.workers.items() if now - seen < 600},
+            }
+
+
+queue = TranscodeQueue()
+
+
+class Attempt:
+    """
+    One lease on a job, as seen by the process running it. tag names the
+    attempt's temp file, aborted is set once the lease is lost and confirm()
+    asks the queue whether the lease is still held.
+    """
+    __slots__ = ("tag", "aborted", "confirm")
+
+    def __init__(self, job_id, attempt, confirm):
+        self.tag = f"q{job_id}-{attempt}"
+        self.aborted = threading.Event()
+        self.confirm = confirm
+
+
+def execute_job(kind, path, attempt=None):
+    """Runs one job in this process. Returns True on success."""
+    fn = KINDS[kind]
+    root, file_name = os.path.split(path)
+    return bool(fn((path, root, file_name), attempt))
+
+
+def _heartbeat(job_id, worker_id, attempt, done):
+    """Keeps a local lease alive while the job runs, like transcode_worker does over HTTP."""
+    interval = max(1.0, queue.lease_seconds / 3)
+    while not done.wait(interval):
+        if not queue.heartbeat(job_id, worker_id):
+            attempt.aborted.set()
+            return
+
+
+def _local_worker(worker_id, batch_done):
+    """Pulls jobs (from any batch) until this batch is finished."""
+    while not batch_done.is_set() and not stop_event.is_set():
+        job = queue.claim(worker_id, wait=1.0)
+        if job is None:
+            continue
+        attempt = Attempt(job.id, job.attempts, lambda: queue.heartbeat(job.id, worker_id))
+        done = threading.Event()
+        beat = threading.Thread(target=_heartbeat, args=(job.id, worker_id, attempt, done), daemon=True)
+        beat.start()
+        try:
+            ok, error = execute_job(job.kind, job.path, attempt), None
+        except Exception as e:
+            ok, error = False, str(e)
+        finally:
+            done.set()
+            beat.join()
+        queue.complete(job.id, worker_id, ok, error)
+
+
+def run_batch(items, workers, on_done=None):
+    """
+    Queues (kind, full_path) items, helps with `workers` local threads and
+    waits for all of them. on_done(full_path) is called for every success.
+    """
+    if not items:
+        return
+    jobs = [queue.submit(kind, path) for kind, path in items]
+    batch_done = threading.Event()
+    threads = [
+        threading.Thread(target=_local_worker, args=(f"local-{os.getpid()}-{threading.get_ident()}-{i}", batch_done),
+                         daemon=True)
+        for i in range(max(1, workers))
+    ]
+    for thread in threads:
+        thread.start()
+    try:
+        for job in jobs:
+            while not job.finished.wait(1.0):
+                if stop_event.is_set():
+                    queue.cancel(jobs)
+                    break
+            if job.ok and on_done:
+                on_done(job.path)
+            elif not job.ok and job.error not in (None, "cancelled"):
+                logger.error(f"Transcode job for {os.path.basename(job.path)} failed: {job.error}")
+    finally:
+        batch_done.set()
+        for thread in threads:
+            thread.join()
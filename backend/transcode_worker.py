@@ -0,0 +1,140 @@
+"""
+Remote transcode worker for the pull queue (transcode_queue.py).
+
+Claims jobs from the renamer API, keeps the lease alive with heartbeats
+while ffmpeg runs, and reports the result. A lost lease kills ffmpeg and
+discards its output. The library must be mounted
+on this host; --path-map translates server paths to local ones.
+
+Usage (from backend/):
+    python transcode_worker.py --server http://renamer:8000 --concurrency 2
+    python transcode_worker.py --server http://renamer:8000 --path-map /host_mnt/audiobooks=/mnt/audiobooks
+"""
+import argparse
+import os
+import signal
+import socket
+import threading
+import time
+import requests
+from renamer_core import logger, stop_event
+from transcode_queue import Attempt, execute_job
+
+# Jobs currently running in this process; shutdown waits for these only
+_busy = set()
+
+
+def map_path(path, path_map):
+    for server_prefix, local_prefix in path_map:
+        if path == server_prefix or path.startswith(server_prefix.rstrip("/") + "/"):
+            return local_prefix + path[len(server_prefix):]
+    return path
+
+
+def _confirm(session, server, job, worker_id):
+    """True if the server still has this worker down as the job's holder (extends the lease)."""
+    try:
+        response = session.post(f"{server}/api/transcode/{job['id']}/heartbeat",
+                                json={"worker_id": worker_id}, timeout=10)
+    except requests.RequestException as e:
+        logger.warning(f"Heartbeat for job {job['id']} failed: {e}")
+        return None
+    return response.status_code != 409
+
+
+def _heartbeat(session, server, job, worker_id, attempt, done):
+    """Renews the lease; aborts the attempt on a 409 or once the lease must have run out."""
+    interval = max(1.0, job["lease_seconds"] / 3)
+    renewed = time.time()
+    while not done.wait(interval):
+        held = _confirm(session, server, job, worker_id)
+        if held:
+            renewed = time.time()
+        elif held is False or time.time() - renewed > job["lease_seconds"]:
+            logger.warning(f"Lost lease on job {job['id']}; aborting it, the server will hand it out again.")
+            attempt.aborted.set()
+            return
+
+
+def work_loop(server, worker_id, path_map, kinds=None, poll_seconds=20.0):
+    session = requests.Session()
+    while not stop_event.is_set():
+        try:
+            response = session.post(f"{server}/api/transcode/claim",
+                                    json={"worker_id": worker_id, "kinds": kinds, "wait": poll_seconds},
+                                    timeout=poll_seconds + 10)
+        except requests.RequestException as e:
+            logger.warning(f"Cannot reach {server}: {e}")
+            stop_event.wait(5)
+            continue
+        if response.status_code == 204:
+            continue
+        response.raise_for_status()
+        job = response.json()
+
+        _busy.add(worker_id)
+        # The final replace only happens while the server still confirms the lease
+        attempt = Attempt(job["id"], job["attempt"], lambda: bool(_confirm(session, server, job, worker_id)))
+        done = threading.Event()
+        beat = threading.Thread(target=_heartbeat, args=(session, server, job, worker_id, attempt, done),
+                                daemon=True)
+        beat.start()
+        try:
+            ok, error = execute_job(job["kind"], map_path(job["path"], path_map), attempt), None
+        except Exception as e:
+            ok, error = False, str(e)
+        finally:
+            done.set()
+            beat.join()
+
+        if attempt.aborted.is_set():
+            # The job belongs to another worker now; there is nothing to report
+            _busy.discard(worker_id)
+            continue
+        try:
+            response = session.post(f"{server}/api/transcode/{job['id']}/result",
+                                    json={"worker_id": worker_id, "ok": ok, "error": error}, timeout=10)
+            if response.status_code == 409:
+                logger.warning(f"Result for job {job['id']} rejected (lease expired).")
+        except requests.RequestException as e:
+            # The lease runs out and the job is retried; the file-level bitrate check makes that cheap
+            logger.warning(f"Could not report job {job['id']}: {e}")
+        finally:
+            _busy.discard(worker_id)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Remote transcode worker")
+    parser.add_argument("--server", default=os.getenv("RENAMER_SERVER", "http://localhost:8000"))
+    parser.add_argument("--worker-id", default=f"{socket.gethostname()}-{os.getpid()}")
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--kinds", nargs="*", choices=("audio", "image"), default=None)
+    parser.add_argument("--path-map", action="append", default=[], metavar="SERVER=LOCAL",
+                        help="Translate a server path prefix to a local mount point (repeatable)")
+    args = parser.parse_args()
+
+    path_map = [tuple(item.split("=", 1)) for item in args.path_map]
+    server = args.server.rstrip("/")
+
+    def shutdown(signum, frame):
+        logger.info("Worker stopping after the current job(s)...")
+        stop_event.set()
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    logger.info(f"Transcode worker {args.worker_id} pulling from {server} ({args.concurrency} slot(s)).")
+    threads = [
+        threading.Thread(target=work_loop, args=(server, f"{args.worker_id}-{i}", path_map, args.kinds), daemon=True)
+        for i in range(max(1, args.concurrency))
+    ]
+    for thread in threads:
+        thread.start()
+    # Idle threads may sit in a long-poll claim; only running jobs are waited for
+    while any(t.is_alive() for t in threads):
+        if stop_event.is_set() and not _busy:
+            break
+        time.sleep(0.5)
+
+
+if __name__ == "__main__":
+    main()
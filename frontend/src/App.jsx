@@ -504,7 +504,7 @@ function InventoryView() {
                                     <td className="px-3 py-3 whitespace-nowrap">
                                         <div className="h-10 w-10 rounded bg-slate-800 flex items-center justify-center overflow-hidden">
                                             {book.has_cover && book.relative_cover_path ? (
-                                                <img src={book.relative_cover_path} className="h-full w-full object-cover" loading="lazy" />
+                                                <img src={`${book.relative_cover_path}?thumb=120`} className="h-full w-full object-cover" loading="lazy" />
                                             ) : (
                                                 <span className="text-[10px] text-slate-600">No</span>
                                             )}